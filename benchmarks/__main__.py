@@ -0,0 +1,121 @@
+"""
+Benchmarks for the EmailUser hot paths.
+
+Times user creation, lookup and authentication, the user forms and the
+admin views, with the user table grown to each of the given sizes, and
+writes the results as JSON so runs can be compared::
+
+    PYTHONPATH=src python -m benchmarks --sizes 10000 100000 1000000
+
+The database is an in-memory SQLite one, unless DATABASE_URL says otherwise.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+from datetime import datetime, timezone
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="Numbers of users to run the benchmarks with.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=10,
+        help="Runs of each benchmark, at each size.",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        metavar="NAME",
+        help="Benchmarks to run, all of them by default.",
+    )
+    parser.add_argument(
+        "--fast-hashing",
+        action="store_true",
+        help="Hash passwords with MD5, to time everything but the hasher.",
+    )
+    parser.add_argument(
+        "--settings",
+        default="benchmarks.settings",
+        help="Django settings module, benchmarks.settings by default.",
+    )
+    parser.add_argument(
+        "--output",
+        default="bench_output.json",
+        help="File to write the results to, bench_output.json by default.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ["DJANGO_SETTINGS_MODULE"] = args.settings
+    os.environ.setdefault("DATABASE_URL", "sqlite://:memory:")
+
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.test.utils import override_settings, setup_test_environment
+
+    django.setup()
+    setup_test_environment()
+    if args.fast_hashing:
+        override_settings(
+            PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"]
+        ).enable()
+    call_command("migrate", verbosity=0, interactive=False)
+
+    from .suite import Suite, populate, summarize, timed
+
+    names = args.only or Suite.names()
+    unknown = set(names) - set(Suite.names())
+    if unknown:
+        sys.exit("Unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+
+    suite = Suite()
+    results = []
+    for size in sorted(args.sizes):
+        populate(size)
+        suite.setup(size)
+        for name in names:
+            result = summarize(name, size, timed(lambda: suite.run(name), args.repeat))
+            results.append(result)
+            print(
+                "{users:>9} users  {name:<34} median {median_ms:>10.3f} ms  "
+                "min {min_ms:>10.3f} ms".format(**result),
+                flush=True,
+            )
+
+    with open(args.output, "w") as output:
+        json.dump(
+            {
+                "date": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "database": settings.DATABASES["default"]["ENGINE"],
+                "auth_user_model": settings.AUTH_USER_MODEL,
+                "fast_hashing": args.fast_hashing,
+                "repeat": args.repeat,
+                "results": results,
+            },
+            output,
+            indent=2,
+        )
+        output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
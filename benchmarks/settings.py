@@ -0,0 +1,8 @@
+from test_settings.settings import *  # NOQA: F401, F403
+
+# The DEBUG query log would grow with every row the benchmarks insert.
+DEBUG = False
+
+# Time the library defaults, whatever the test settings enable.
+CUSTOM_USER_EMAIL_CASE_INSENSITIVE = False
+CUSTOM_USER_ADMIN_SEARCH = "contains"
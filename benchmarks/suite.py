@@ -0,0 +1,159 @@
+import itertools
+import statistics
+import time
+
+from django.contrib.auth import authenticate, get_user_model
+from django.contrib.auth.hashers import make_password
+from django.test import Client
+from django.urls import reverse
+
+from custom_user.forms import EmailUserChangeForm, EmailUserCreationForm
+
+PASSWORD = "benchmark-password"
+POPULATE_BATCH_SIZE = 10000
+
+
+def populate(size):
+    """
+    Add users until the user table has at least size rows.
+
+    Rows are bulk inserted with a single precomputed password hash, so
+    growing the table to a million users takes seconds instead of hours.
+
+    :param int size: number of users
+    """
+    user_model = get_user_model()
+    manager = user_model._default_manager
+    password = make_password(PASSWORD)
+    for start in range(manager.count(), size, POPULATE_BATCH_SIZE):
+        stop = min(start + POPULATE_BATCH_SIZE, size)
+        manager.bulk_create(
+            [
+                user_model(email="user%07d@example.com" % i, password=password)
+                for i in range(start, stop)
+            ]
+        )
+
+
+def timed(func, repeat):
+    """
+    Run func repeat times.
+
+    :return list: wall clock time of each run, in milliseconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def summarize(name, users, timings):
+    return {
+        "name": name,
+        "users": users,
+        "runs": len(timings),
+        "min_ms": round(min(timings), 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "mean_ms": round(statistics.mean(timings), 3),
+        "max_ms": round(max(timings), 3),
+    }
+
+
+def change_form_data(user):
+    """
+    Return the POST data the admin change form would submit for user.
+    """
+    form = EmailUserChangeForm(instance=user)
+    return {
+        name: form[name].value()
+        for name in form.fields
+        if form[name].value() is not None
+    }
+
+
+class Suite:
+
+    """
+    The benchmarked operations.
+
+    Each benchmark is a method named bench_<name>, run against a user picked
+    in the middle of the table, so lookups don't hit the first index pages.
+    """
+
+    def __init__(self):
+        self.manager = get_user_model()._default_manager
+        self.emails = ("new%07d@example.com" % i for i in itertools.count())
+        self.client = Client()
+        self.client.force_login(
+            self.manager.create_superuser("bench-admin@example.com", PASSWORD)
+        )
+        opts = get_user_model()._meta
+        self.changelist_url = reverse(
+            "admin:%s_%s_changelist" % (opts.app_label, opts.model_name)
+        )
+
+    @classmethod
+    def names(cls):
+        return [name[len("bench_") :] for name in dir(cls) if name.startswith("bench_")]
+
+    def setup(self, size):
+        """
+        Pick the user the benchmarks run against, for a table of size rows.
+        """
+        self.user = self.manager.get(email="user%07d@example.com" % (size // 2))
+        opts = self.user._meta
+        self.change_url = reverse(
+            "admin:%s_%s_change" % (opts.app_label, opts.model_name),
+            args=(self.user.pk,),
+        )
+        self.change_data = change_form_data(self.user)
+
+    def run(self, name):
+        getattr(self, "bench_" + name)()
+
+    def get(self, url):
+        response = self.client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+
+    def bench_create_user(self):
+        self.manager.create_user(next(self.emails), PASSWORD)
+
+    def bench_create_superuser(self):
+        self.manager.create_superuser(next(self.emails), PASSWORD)
+
+    def bench_get_by_natural_key(self):
+        self.manager.get_by_natural_key(self.user.email)
+
+    def bench_authenticate(self):
+        assert authenticate(email=self.user.email, password=PASSWORD) is not None
+
+    def bench_authenticate_wrong_password(self):
+        assert authenticate(email=self.user.email, password="wrong") is None
+
+    def bench_creation_form_validation(self):
+        form = EmailUserCreationForm(
+            {
+                "email": "signup@example.com",
+                "password1": PASSWORD,
+                "password2": PASSWORD,
+            }
+        )
+        assert form.is_valid(), form.errors
+
+    def bench_creation_form_rendering(self):
+        str(EmailUserCreationForm())
+
+    def bench_change_form_validation(self):
+        form = EmailUserChangeForm(self.change_data, instance=self.user)
+        assert form.is_valid(), form.errors
+
+    def bench_change_form_rendering(self):
+        str(EmailUserChangeForm(instance=self.user))
+
+    def bench_admin_changelist(self):
+        self.get(self.changelist_url)
+
+    def bench_admin_change_view(self):
+        self.get(self.change_url)
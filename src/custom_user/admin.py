@@ -1,10 +1,130 @@
 """Admin definition for EmailUser."""
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import PAGE_VAR, ChangeList
+from django.contrib.auth import get_permission_codename, get_user_model
 from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.models import Permission
+from django.core.exceptions import ValidationError
+from django.http import StreamingHttpResponse
 from django.utils.translation import gettext_lazy as _
+from django.utils.translation import ngettext
 
+from .backends import cached_permission_choices
+from .conf import get_setting
+from .export import export_users
 from .forms import EmailUserChangeForm, EmailUserCreationForm
-from .models import EmailUser
+from .models import EmailUser, EmailUserManager, email_domain
+from .pagination import EstimatedCountPaginator
+from .purge import purge_users
+from .routers import use_primary
+
+KEYSET_VAR = "after"
+
+
+class EmailUserChangeList(ChangeList):
+    """
+    ChangeList with optional keyset pagination on the email ordering.
+
+    With CUSTOM_USER_ADMIN_PAGINATION set to "keyset", pages are requested
+    with the last email of the previous page instead of a page number, so
+    every page is an index range scan instead of an ever growing OFFSET.
+    """
+
+    keyset_value = None
+
+    def get_queryset(self, request, *args, **kwargs):
+        # Like the page number, the keyset position isn't a filter: keep it
+        # out of the params so the search form and the filter, sorting and
+        # search links start again from the first page.
+        if KEYSET_VAR in self.params:
+            self.keyset_value = self.params.pop(KEYSET_VAR)
+        return super().get_queryset(request, *args, **kwargs)
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.next_keyset_value = None
+        # The email is unique, so anything ordered after it doesn't matter.
+        ordering = tuple(self.queryset.query.order_by[:1])
+        self.keyset_pagination = (
+            get_setting("ADMIN_PAGINATION") == "keyset"
+            and ordering in (("email",), ("-email",))
+            and not (self.show_all and self.can_show_all)
+            and self.multi_page
+        )
+        if not self.keyset_pagination:
+            return
+        queryset = self.queryset
+        if self.keyset_value:
+            lookup = "email__lt" if ordering == ("-email",) else "email__gt"
+            queryset = queryset.filter(**{lookup: self.keyset_value})
+        self.result_list = queryset[: self.list_per_page]
+        if len(self.result_list) == self.list_per_page:
+            self.next_keyset_value = self.result_list[self.list_per_page - 1].email
+
+    def first_page_url(self):
+        return self.get_query_string(remove=[PAGE_VAR])
+
+    def next_page_url(self):
+        return self.get_query_string(
+            {KEYSET_VAR: self.next_keyset_value}, remove=[PAGE_VAR]
+        )
+
+
+class PermissionAutocompleteAdmin(admin.ModelAdmin):
+    """
+    Read-only Permission admin backing the user_permissions autocomplete.
+
+    It's hidden from the admin index. Searches are matched against a cached
+    list of permission labels, so they don't join the content types table.
+    """
+
+    search_fields = ("name", "codename")
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related("content_type")
+
+    def get_search_results(self, request, queryset, search_term):
+        bits = search_term.lower().split()
+        if not bits:
+            return queryset, False
+        pks = [
+            pk
+            for pk, label in cached_permission_choices()
+            if all(bit in label.lower() for bit in bits)
+        ]
+        return queryset.filter(pk__in=pks), False
+
+    def has_module_permission(self, request):
+        return False
+
+    def has_view_permission(self, request, obj=None):
+        # Anyone allowed to change users can pick their permissions.
+        opts = get_user_model()._meta
+        return super().has_view_permission(request, obj) or request.user.has_perm(
+            "%s.%s" % (opts.app_label, get_permission_codename("change", opts))
+        )
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+def register_permission_admin(site=admin.site):
+    """
+    Register PermissionAutocompleteAdmin on site, when
+    CUSTOM_USER_ADMIN_AUTOCOMPLETE is enabled and Permission isn't
+    registered yet.
+    """
+    if get_setting("ADMIN_AUTOCOMPLETE") and not site.is_registered(Permission):
+        site.register(Permission, PermissionAutocompleteAdmin)
+
+
+register_permission_admin()
 
 
 @admin.register(EmailUser)
@@ -50,7 +170,115 @@ class EmailUserAdmin(UserAdmin):
     list_filter = ("is_staff", "is_superuser", "is_active", "groups")
     search_fields = ("email",)
     ordering = ("email",)
-    filter_horizontal = (
-        "groups",
-        "user_permissions",
+    change_list_template = "admin/custom_user/emailuser/change_list.html"
+    paginator = EstimatedCountPaginator
+    actions = ("export_csv", "export_jsonl", "purge_inactive")
+
+    @property
+    def filter_horizontal(self):
+        if get_setting("ADMIN_AUTOCOMPLETE"):
+            return ()
+        return ("groups", "user_permissions")
+
+    @property
+    def autocomplete_fields(self):
+        if get_setting("ADMIN_AUTOCOMPLETE"):
+            return ("groups", "user_permissions")
+        return ()
+
+    @property
+    def show_full_result_count(self):
+        # The unfiltered COUNT(*) can't be estimated, skip it on big tables.
+        return get_setting("ADMIN_COUNT_ESTIMATE_THRESHOLD") is None
+
+    def get_changelist(self, request, **kwargs):
+        return EmailUserChangeList
+
+    def add_view(self, request, form_url="", extra_context=None):
+        try:
+            return super().add_view(request, form_url, extra_context)
+        except ValidationError as error:
+            if getattr(error, "code", None) != "duplicate_email":
+                raise
+            # A user with the same email was created after the form was
+            # validated, validating it again reports it on the form.
+            with use_primary():
+                return super().add_view(request, form_url, extra_context)
+
+    def save_model(self, request, obj, form, change):
+        if change or not isinstance(form, EmailUserCreationForm):
+            return super().save_model(request, obj, form, change)
+        form.save_new_user(obj)
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Search users by email.
+
+        With CUSTOM_USER_ADMIN_SEARCH set to "prefix", the term is matched
+        against the beginning of the email, or against the whole domain if
+        it starts with "@". Both lookups can use an index, unlike the default
+        icontains search.
+        """
+        search_term = search_term.strip()
+        if get_setting("ADMIN_SEARCH") != "prefix" or not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        if search_term.startswith("@"):
+            queryset = queryset.alias(email_domain=email_domain()).filter(
+                email_domain=search_term[1:].lower()
+            )
+        else:
+            queryset = queryset.filter(
+                email__startswith=EmailUserManager.normalize_email(search_term)
+            )
+        return queryset, False
+
+    def _export(self, queryset, export_format, content_type):
+        response = StreamingHttpResponse(
+            export_users(queryset.order_by("pk"), export_format),
+            content_type=content_type,
+        )
+        response["Content-Disposition"] = 'attachment; filename="%s.%s"' % (
+            self.model._meta.model_name,
+            export_format,
+        )
+        return response
+
+    @admin.action(
+        description=_("Export selected %(verbose_name_plural)s as CSV"),
+        permissions=("view",),
+    )
+    def export_csv(self, request, queryset):
+        return self._export(queryset, "csv", "text/csv")
+
+    @admin.action(
+        description=_("Export selected %(verbose_name_plural)s as JSONL"),
+        permissions=("view",),
+    )
+    def export_jsonl(self, request, queryset):
+        return self._export(queryset, "jsonl", "application/jsonl")
+
+    @admin.action(
+        description=_("Purge selected inactive %(verbose_name_plural)s"),
+        permissions=("delete",),
     )
+    def purge_inactive(self, request, queryset):
+        result = purge_users(
+            queryset.filter(is_active=False),
+            time_budget=get_setting("PURGE_TIME_BUDGET"),
+        )
+        self.message_user(
+            request,
+            ngettext(
+                "Deleted %(count)d inactive user.",
+                "Deleted %(count)d inactive users.",
+                result.deleted,
+            )
+            % {"count": result.deleted},
+            messages.SUCCESS,
+        )
+        if not result.complete:
+            self.message_user(
+                request,
+                _("Time budget spent, run the action again to delete the rest."),
+                messages.WARNING,
+            )
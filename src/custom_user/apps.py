@@ -1,5 +1,8 @@
 """App configuration for custom_user."""
 from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 
 
 class CustomUserConfig(AppConfig):
@@ -12,3 +15,72 @@ class CustomUserConfig(AppConfig):
 
     # https://docs.djangoproject.com/en/3.2/releases/3.2/#customizing-type-of-auto-created-primary-keys
     default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        from django.contrib.auth.models import Group, Permission
+
+        from . import checks  # noqa: F401
+        from .last_login import update_last_login
+        from .models import AbstractEmailUser, PermissionSnapshotMixin
+        from .signals import (
+            invalidate_permissions,
+            invalidate_user,
+            rebuild_group_snapshots,
+            rebuild_stashed_snapshots,
+            rebuild_user_snapshot,
+            stash_snapshot_users,
+            stick_user,
+        )
+
+        through_models = [Group.permissions.through]
+        snapshots = False
+        for model in self.apps.get_models():
+            if issubclass(model, AbstractEmailUser):
+                uid = "custom_user.invalidate_user.%s" % model._meta.label
+                post_save.connect(invalidate_user, sender=model, dispatch_uid=uid)
+                post_delete.connect(invalidate_user, sender=model, dispatch_uid=uid)
+                uid = "custom_user.stick_user.%s" % model._meta.label
+                post_save.connect(stick_user, sender=model, dispatch_uid=uid)
+                for through in (model.groups.through, model.user_permissions.through):
+                    m2m_changed.connect(stick_user, sender=through, dispatch_uid=uid)
+                through_models += [
+                    model.groups.through,
+                    model.user_permissions.through,
+                ]
+            if issubclass(model, PermissionSnapshotMixin):
+                snapshots = True
+                uid = "custom_user.rebuild_user_snapshot.%s" % model._meta.label
+                for through in (model.groups.through, model.user_permissions.through):
+                    m2m_changed.connect(
+                        rebuild_user_snapshot, sender=through, dispatch_uid=uid
+                    )
+        for model in through_models:
+            uid = "custom_user.invalidate_permissions.%s" % model._meta.label
+            m2m_changed.connect(invalidate_permissions, sender=model, dispatch_uid=uid)
+        for model in (Group, Permission):
+            uid = "custom_user.invalidate_permissions.%s" % model._meta.label
+            post_save.connect(invalidate_permissions, sender=model, dispatch_uid=uid)
+            post_delete.connect(invalidate_permissions, sender=model, dispatch_uid=uid)
+        if snapshots:
+            uid = "custom_user.rebuild_group_snapshots"
+            m2m_changed.connect(
+                rebuild_group_snapshots,
+                sender=Group.permissions.through,
+                dispatch_uid=uid,
+            )
+            for model in (Group, Permission):
+                uid = "custom_user.rebuild_snapshots.%s" % model._meta.label
+                pre_delete.connect(stash_snapshot_users, sender=model, dispatch_uid=uid)
+                post_delete.connect(
+                    rebuild_stashed_snapshots, sender=model, dispatch_uid=uid
+                )
+            post_save.connect(
+                rebuild_stashed_snapshots,
+                sender=Permission,
+                dispatch_uid="custom_user.rebuild_snapshots.auth.Permission",
+            )
+
+        if issubclass(get_user_model(), AbstractEmailUser):  # pragma: no branch
+            # Replace Django's receiver, connected by django.contrib.auth.
+            user_logged_in.disconnect(dispatch_uid="update_last_login")
+            user_logged_in.connect(update_last_login, dispatch_uid="update_last_login")
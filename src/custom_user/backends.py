@@ -0,0 +1,352 @@
+"""Authentication backends for EmailUser."""
+import functools
+import hashlib
+import random
+import time
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Permission
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied
+from django.utils.module_loading import import_string
+
+from .conf import get_setting
+
+USER_VERSION_KEY = "custom_user:user_version:%s"
+USER_KEY = "custom_user:user:%s:%s"
+PERMISSION_VERSION_KEY = "custom_user:permission_version"
+PERMISSION_KEY = "custom_user:perms:%s:%s:%s:%d"
+PERMISSION_CHOICES_KEY = "custom_user:permission_choices:%s"
+THROTTLE_KEY = "custom_user:throttle:%s:%d"
+SECURITY_STAMP_KEY = "custom_user:security_stamp:%s"
+
+
+def _user_cache():
+    return caches[get_setting("USER_CACHE")]
+
+
+def _version_timeout():
+    # Versions and stamps outlive the entries stored under them, so they
+    # don't stay in the cache forever but none of those entries is orphaned.
+    timeouts = (
+        get_setting("USER_CACHE_TIMEOUT"),
+        get_setting("PERMISSION_CACHE_TIMEOUT"),
+    )
+    if None in timeouts:
+        return None
+    return 2 * max(timeouts)
+
+
+@functools.lru_cache(maxsize=None)
+def _caches_users(paths):
+    return any(
+        issubclass(import_string(path), (CachedModelBackend, SessionSnapshotBackend))
+        for path in paths
+    )
+
+
+def user_cache_used():
+    """
+    Return whether an authentication backend keeps users, permissions or
+    security stamps in the cache, i.e. whether changes have to invalidate
+    them.
+
+    :return bool: CachedModelBackend or SessionSnapshotBackend is configured
+    """
+    return _caches_users(tuple(settings.AUTHENTICATION_BACKENDS))
+
+
+def invalidate_cached_user(pk):
+    """
+    Invalidate the cached copy of the user with the given pk.
+
+    Bumps the user's version counter, so a copy stored by a request that
+    loaded the row before the change is never read again, and changes its
+    security stamp.
+
+    :param pk: user primary key
+    """
+    cache = _user_cache()
+    version_key = USER_VERSION_KEY % pk
+    try:
+        previous = cache.incr(version_key) - 1
+    except ValueError:
+        # Without a counter, copies are stored under version 0. It starts
+        # from a random value, so copies stored under the versions of a
+        # counter that expired aren't read again.
+        previous = 0
+        if not cache.add(version_key, random.randrange(1, 2**31), _version_timeout()):
+            previous = cache.incr(version_key) - 1
+    cache.delete_many([USER_KEY % (pk, previous), SECURITY_STAMP_KEY % pk])
+
+
+def invalidate_cached_permissions():
+    """
+    Invalidate the cached permissions of every user.
+
+    Sets a new global permission version, entries stored under the previous
+    one are never read again and expire on their own.
+    """
+    _user_cache().set(PERMISSION_VERSION_KEY, uuid4().hex, _version_timeout())
+
+
+def _permission_version(cache):
+    version = cache.get(PERMISSION_VERSION_KEY)
+    if version is None:
+        cache.add(PERMISSION_VERSION_KEY, uuid4().hex, _version_timeout())
+        version = cache.get(PERMISSION_VERSION_KEY)
+    return version
+
+
+def security_stamp(pk):
+    """
+    Return the security stamp of the user with the given pk.
+
+    The stamp changes whenever the user is saved or deleted, whenever
+    groups or permissions change, and when the cache loses it, so a value
+    stored along with user data tells whether that data may be stale.
+
+    :param pk: user primary key
+    :return str: stamp
+    """
+    cache = _user_cache()
+    key = SECURITY_STAMP_KEY % pk
+    values = cache.get_many([key, PERMISSION_VERSION_KEY])
+    if key not in values:
+        cache.add(key, uuid4().hex, _version_timeout())
+        values[key] = cache.get(key)
+    if PERMISSION_VERSION_KEY not in values:
+        values[PERMISSION_VERSION_KEY] = _permission_version(cache)
+    return "%s:%s" % (values[key], values[PERMISSION_VERSION_KEY])
+
+
+def cached_permission_choices():
+    """
+    Return the (pk, label) of every Permission.
+
+    Cached under the global permission version, so the list is rebuilt only
+    when permissions change.
+
+    :return list: (pk, label) tuples
+    """
+    cache = _user_cache()
+    key = PERMISSION_CHOICES_KEY % _permission_version(cache)
+    choices = cache.get(key)
+    if choices is None:
+        choices = [
+            (permission.pk, str(permission))
+            for permission in Permission.objects.select_related("content_type")
+        ]
+        cache.set(key, choices, get_setting("PERMISSION_CACHE_TIMEOUT"))
+    return choices
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend that keeps users and their permissions in the cache.
+
+    AuthenticationMiddleware calls get_user() on every request, so this
+    avoids the user query on most requests. Entries are invalidated when the
+    user is saved or deleted, so deactivations take effect immediately.
+
+    Permissions are shared between requests and keyed by a global version
+    that changes whenever groups or permissions are modified.
+    """
+
+    def get_user(self, user_id):
+        """
+        Return the active user with the given pk, from the cache if possible.
+
+        :param user_id: user primary key
+        :return custom_user.models.EmailUser user: user or None
+        """
+        cache = _user_cache()
+        key = USER_KEY % (user_id, cache.get(USER_VERSION_KEY % user_id, 0))
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is None:
+                return None
+            cache.set(key, user, get_setting("USER_CACHE_TIMEOUT"))
+        return user if self.user_can_authenticate(user) else None
+
+    def _get_permissions(self, user_obj, obj, from_name):
+        """
+        Return the permissions of user_obj from from_name, using the cache.
+
+        :param user_obj: user
+        :param obj: object to check permissions on, not supported
+        :param str from_name: either "user" or "group"
+        :return set: permission strings
+        """
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        perm_cache_name = "_%s_perm_cache" % from_name
+        if not hasattr(user_obj, perm_cache_name):
+            setattr(
+                user_obj, perm_cache_name, self._load_permissions(user_obj, from_name)
+            )
+        return getattr(user_obj, perm_cache_name)
+
+    def _load_permissions(self, user_obj, from_name):
+        """
+        Return the permissions of user_obj from from_name, from the cache or
+        the database.
+        """
+        cache = _user_cache()
+        key = PERMISSION_KEY % (
+            _permission_version(cache),
+            from_name,
+            user_obj.pk,
+            user_obj.is_superuser,
+        )
+        perms = cache.get(key)
+        if perms is None:
+            perms = super()._get_permissions(user_obj, None, from_name)
+            cache.set(key, perms, get_setting("PERMISSION_CACHE_TIMEOUT"))
+        return perms
+
+
+class ThrottledModelBackend(ModelBackend):
+    """
+    ModelBackend that limits failed logins per email and per IP address.
+
+    Failures are counted in the cache over a sliding window. Once a limit is
+    reached, attempts are rejected before the password is hashed, so a
+    credential stuffing attack can't use much CPU, and before any other
+    backend is tried. Successful logins clear the counter of their email.
+    """
+
+    def get_client_ip(self, request):
+        """
+        Return the IP address the request comes from.
+
+        Uses REMOTE_ADDR, override this if the site is behind a proxy.
+
+        :param request: HttpRequest
+        :return str: IP address, or None if unknown
+        """
+        return request.META.get("REMOTE_ADDR")
+
+    def _throttle_prefix(self, scope, ident):
+        return "%s:%s" % (scope, hashlib.sha256(ident.encode()).hexdigest())
+
+    def _throttles(self, request, username):
+        """
+        Return the (cache key prefix, limit) of the counters of an attempt.
+        """
+        idents = [("email", username.lower(), get_setting("THROTTLE_EMAIL_LIMIT"))]
+        ip = self.get_client_ip(request) if request is not None else None
+        if ip:
+            idents.append(("ip", ip, get_setting("THROTTLE_IP_LIMIT")))
+        return [
+            (self._throttle_prefix(scope, ident), limit)
+            for scope, ident, limit in idents
+            if limit is not None
+        ]
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        """
+        Authenticate like ModelBackend, unless too many attempts failed.
+
+        :raise PermissionDenied: too many failed attempts, for the email or
+            the IP address, during the window
+        """
+        if username is None:
+            username = kwargs.get(get_user_model().USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        cache = _user_cache()
+        window = get_setting("THROTTLE_WINDOW")
+        bucket, elapsed = divmod(time.time(), window)
+        bucket = int(bucket)
+        throttles = self._throttles(request, username)
+        counts = cache.get_many(
+            [
+                THROTTLE_KEY % (prefix, b)
+                for prefix, limit in throttles
+                for b in (bucket - 1, bucket)
+            ]
+        )
+        for prefix, limit in throttles:
+            # Weigh the previous bucket by how much of it is still in the
+            # window, which approximates a sliding window with two counters.
+            previous = counts.get(THROTTLE_KEY % (prefix, bucket - 1), 0)
+            current = counts.get(THROTTLE_KEY % (prefix, bucket), 0)
+            if previous * (1 - elapsed / window) + current >= limit:
+                raise PermissionDenied
+        user = super().authenticate(request, username, password, **kwargs)
+        if user is None:
+            for prefix, limit in throttles:
+                key = THROTTLE_KEY % (prefix, bucket)
+                cache.add(key, 0, 2 * window)
+                try:
+                    cache.incr(key)
+                except ValueError:  # pragma: no cover
+                    # Expired between add() and incr().
+                    cache.set(key, 1, 2 * window)
+        else:
+            prefix = self._throttle_prefix("email", username.lower())
+            cache.delete_many(
+                [THROTTLE_KEY % (prefix, b) for b in (bucket - 1, bucket)]
+            )
+        return user
+
+
+class SnapshotModelBackend(ModelBackend):
+    """
+    ModelBackend that reads permissions from the permission snapshot stored
+    in the user row, for models with PermissionSnapshotMixin.
+
+    Checking a permission then needs no query. Superusers and users whose
+    snapshot was never built fall back to the ModelBackend queries.
+    """
+
+    def get_all_permissions(self, user_obj, obj=None):
+        """
+        Return the permissions of user_obj, from its snapshot if possible.
+
+        :param user_obj: user
+        :param obj: object to check permissions on, not supported
+        :return set: permission strings
+        """
+        snapshot = getattr(user_obj, "permission_snapshot", None)
+        if (
+            snapshot is None
+            or user_obj.is_superuser
+            or not user_obj.is_active
+            or obj is not None
+        ):
+            return super().get_all_permissions(user_obj, obj)
+        if not hasattr(user_obj, "_perm_cache"):
+            user_obj._perm_cache = set(snapshot)
+        return user_obj._perm_cache
+
+
+class SessionSnapshotBackend(ModelBackend):
+    """
+    ModelBackend whose users are served from a snapshot stored in their
+    session by SessionSnapshotMiddleware.
+
+    The snapshot holds the pk, the email, the active, staff and superuser
+    flags and the user's security stamp. It is used until the stamp
+    changes, so requests that only need those fields don't load the user.
+    """
+
+    snapshot_fields = ("email", "is_active", "is_staff", "is_superuser")
+
+    def make_snapshot(self, user, stamp):
+        """
+        Return the snapshot of user stored in the session.
+
+        :param user: user just loaded from the database
+        :param str stamp: security stamp read before loading the user
+        :return dict: JSON serializable snapshot
+        """
+        snapshot = {name: getattr(user, name) for name in self.snapshot_fields}
+        snapshot["pk"] = user._meta.pk.value_to_string(user)
+        snapshot["stamp"] = stamp
+        return snapshot
@@ -0,0 +1,57 @@
+"""System checks for custom_user."""
+from django.contrib.auth import get_user_model
+from django.core import checks
+from django.db import connections
+
+from .models import AbstractEmailUser
+from .operations import AddCaseInsensitiveEmailIndex, AddEmailDomainIndex
+
+MISSING_INDEX_IDS = {
+    AddCaseInsensitiveEmailIndex: "custom_user.W001",
+    AddEmailDomainIndex: "custom_user.W002",
+}
+
+
+@checks.register(checks.Tags.database)
+def check_email_indexes(app_configs=None, databases=None, **kwargs):
+    """
+    Warn about the indexes of enabled settings that the database lacks.
+
+    The index operations only run with the settings of the migrate command,
+    so a setting enabled after migrating leaves the table without its index.
+    Like every database check, it only runs for the given databases, e.g.
+    with ``manage.py check --database default``.
+    """
+    model = get_user_model()
+    if not issubclass(model, AbstractEmailUser) or (
+        app_configs is not None and model._meta.app_config not in app_configs
+    ):
+        return []
+    errors = []
+    for alias in databases or ():
+        connection = connections[alias]
+        if model._meta.db_table not in connection.introspection.table_names():
+            # Not migrated yet, the migrations will create the indexes.
+            continue
+        for operation_class, check_id in MISSING_INDEX_IDS.items():
+            operation = operation_class(model_name=model._meta.model_name)
+            if (
+                operation.enabled()
+                and operation.allow_migrate_model(alias, model)
+                and not operation.index_exists(connection, model)
+            ):
+                errors.append(
+                    checks.Warning(
+                        "Index %s is missing from database %r."
+                        % (operation.index_name(model), alias),
+                        hint=(
+                            "Its setting was probably enabled after migrating. "
+                            "Migrate %s back to before the migration with %s, "
+                            "then migrate again."
+                            % (model._meta.app_label, operation_class.__name__)
+                        ),
+                        obj=model,
+                        id=check_id,
+                    )
+                )
+    return errors
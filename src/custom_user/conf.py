@@ -0,0 +1,66 @@
+"""Optional settings for custom_user, with their default values."""
+from django.conf import settings
+
+DEFAULTS = {
+    # Match emails case-insensitively on login and signup. Requires the
+    # LOWER(email) unique index, created by migrate when this is enabled.
+    "EMAIL_CASE_INSENSITIVE": False,
+    # Threads used by the async API (acreate_user...) to hash passwords.
+    "ASYNC_HASHER_WORKERS": 4,
+    # Seconds during which a new login doesn't update last_login again.
+    # None updates it on every login, like Django.
+    "LAST_LOGIN_PRECISION": None,
+    # Number of last_login updates buffered and written with a single bulk
+    # UPDATE. 0 writes each one immediately.
+    "LAST_LOGIN_BUFFER_SIZE": 0,
+    # Search mode of EmailUserAdmin: "contains" uses icontains on the email,
+    # "prefix" matches the beginning of the email or an "@domain" exactly,
+    # both of which can use an index.
+    "ADMIN_SEARCH": "contains",
+    # Pagination of EmailUserAdmin: "offset" uses page numbers, "keyset" uses
+    # "next" links that seek on the email index, with the same cost on every
+    # page. Only applies when the changelist is ordered by email.
+    "ADMIN_PAGINATION": "offset",
+    # Number of rows above which EmailUserAdmin shows the planner's estimate
+    # instead of running COUNT(*). None always counts.
+    "ADMIN_COUNT_ESTIMATE_THRESHOLD": None,
+    # Use autocomplete widgets for groups and user_permissions in
+    # EmailUserAdmin, instead of rendering every choice in the page.
+    "ADMIN_AUTOCOMPLETE": False,
+    # Cache alias and timeout (in seconds) used by CachedModelBackend.
+    "USER_CACHE": "default",
+    "USER_CACHE_TIMEOUT": 300,
+    # Timeout (in seconds) of the permissions cached by CachedModelBackend.
+    "PERMISSION_CACHE_TIMEOUT": 3600,
+    # Failed logins allowed by ThrottledModelBackend during THROTTLE_WINDOW
+    # seconds, for each email and each IP address. None disables the limit.
+    "THROTTLE_EMAIL_LIMIT": 5,
+    "THROTTLE_IP_LIMIT": 50,
+    "THROTTLE_WINDOW": 300,
+    # Rehash passwords using an outdated hasher in a background thread,
+    # instead of during the login, and the number of upgrades that can wait.
+    "BACKGROUND_PASSWORD_UPGRADE": False,
+    "PASSWORD_UPGRADE_QUEUE_SIZE": 1000,
+    # Databases used by EmailUserRouter: reads of users, groups and
+    # permissions go to a random replica, unless the user was written in the
+    # last REPLICA_STICKY_SECONDS. Writes go to the primary.
+    "PRIMARY_DATABASE": "default",
+    "REPLICA_DATABASES": [],
+    "REPLICA_STICKY_SECONDS": 10,
+    # Seconds after which purge_inactive_users and the purge admin action
+    # stop starting new chunks. None deletes every inactive user.
+    "PURGE_TIME_BUDGET": 30,
+    # Dotted paths of the callables timing the instrumented user operations,
+    # see custom_user.instrumentation.
+    "INSTRUMENTATION_SUBSCRIBERS": [],
+}
+
+
+def get_setting(name):
+    """
+    Return the value of the CUSTOM_USER_<name> setting.
+
+    :param str name: setting name without the CUSTOM_USER_ prefix
+    :return: the configured value or its default
+    """
+    return getattr(settings, "CUSTOM_USER_" + name, DEFAULTS[name])
@@ -0,0 +1,79 @@
+"""Streaming export of EmailUsers."""
+import csv
+import json
+
+from django.db.models import prefetch_related_objects
+
+from .models import _chunked
+
+EXPORT_FIELDS = (
+    "email",
+    "is_active",
+    "is_staff",
+    "is_superuser",
+    "last_login",
+    "date_joined",
+)
+EXPORT_FORMATS = ("csv", "jsonl")
+
+
+def export_rows(queryset, chunk_size=2000):
+    """
+    Yield a dict for every user in queryset, with their group names.
+
+    Users are streamed with iterator() and the groups are prefetched per
+    chunk, so memory use and queries per chunk don't depend on the size of
+    the queryset.
+
+    :param QuerySet queryset: users to export
+    :param int chunk_size: number of users fetched per query
+    """
+    users = queryset.only(*EXPORT_FIELDS).iterator(chunk_size=chunk_size)
+    for chunk in _chunked(users, chunk_size):
+        prefetch_related_objects(chunk, "groups")
+        for user in chunk:
+            row = {field: getattr(user, field) for field in EXPORT_FIELDS}
+            row["groups"] = sorted(group.name for group in user.groups.all())
+            yield row
+
+
+class _Echo:
+    """File-like object that returns what is written, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def _format_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def export_csv(rows):
+    """Yield CSV lines for rows, starting with a header."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS + ("groups",))
+    for row in rows:
+        values = [_format_value(row[field]) for field in EXPORT_FIELDS]
+        yield writer.writerow(values + [";".join(row["groups"])])
+
+
+def export_jsonl(rows):
+    """Yield one JSON document per line for rows."""
+    for row in rows:
+        row = {key: _format_value(value) for key, value in row.items()}
+        yield json.dumps(row) + "\n"
+
+
+def export_users(queryset, export_format, chunk_size=2000):
+    """
+    Return an iterator of the lines of the export of queryset.
+
+    :param QuerySet queryset: users to export
+    :param str export_format: "csv" or "jsonl"
+    :param int chunk_size: number of users fetched per query
+    :raise ValueError: unknown format
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: %s" % export_format)
+    formatter = export_csv if export_format == "csv" else export_jsonl
+    return formatter(export_rows(queryset, chunk_size))
@@ -3,8 +3,11 @@ from django import forms
 from django.contrib.auth import get_user_model, password_validation
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
 from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
 from django.utils.translation import gettext_lazy as _
 
+from .routers import use_primary
+
 
 class EmailUserCreationForm(forms.ModelForm):
     """
@@ -45,14 +48,12 @@ class EmailUserCreationForm(forms.ModelForm):
         # Since EmailUser.email is unique, this check is redundant,
         # but it sets a nicer error message than the ORM. See #13147.
         email = self.cleaned_data["email"]
-        try:
-            get_user_model()._default_manager.get(email=email)
-        except get_user_model().DoesNotExist:
-            return email
-        raise ValidationError(
-            self.error_messages["duplicate_email"],
-            code="duplicate_email",
-        )
+        if get_user_model()._default_manager.filter_by_email(email).exists():
+            raise ValidationError(
+                self.error_messages["duplicate_email"],
+                code="duplicate_email",
+            )
+        return email
 
     def clean_password2(self):
         """
@@ -81,20 +82,61 @@ class EmailUserCreationForm(forms.ModelForm):
             except ValidationError as error:
                 self.add_error("password2", error)
 
+    def validate_unique(self):
+        # clean_email() already checked the email, with the same case
+        # handling as login, so don't query it a second time.
+        exclude = set(self._get_validation_exclusions()) | {"email"}
+        try:
+            self.instance.validate_unique(exclude=exclude)
+        except ValidationError as error:
+            self._update_errors(error)
+
     def save(self, commit=True):
         """
         Save user.
 
-        Save the provided password in hashed format.
+        Save the provided password in hashed format. With commit, the user is
+        saved with save_new_user().
 
         :return custom_user.models.EmailUser: user
+        :raise ValidationError: Email is duplicated
         """
         user = super().save(commit=False)
         user.set_password(self.cleaned_data["password1"])
         if commit:
-            user.save()
+            self.save_new_user(user)
         return user
 
+    def save_new_user(self, user):
+        """
+        Insert user, built by save(commit=False).
+
+        A user created with the same email after clean_email() ran is
+        reported as a duplicate_email error on the form, and raised as a
+        ValidationError with that code. EmailUserAdmin and
+        DuplicateEmailFormMixin turn it into a form error for the response.
+
+        :param custom_user.models.EmailUser user: user to insert
+        :raise ValidationError: Email is duplicated
+        """
+        manager = get_user_model()._default_manager
+        # The concurrent user may not be on the replicas yet, and the atomic
+        # block has to be on the database the user is written to.
+        with use_primary():
+            try:
+                with transaction.atomic(using=manager.db):
+                    user.save()
+                return
+            except IntegrityError:
+                if not manager.filter_by_email(user.email).exists():
+                    raise
+        error = ValidationError(
+            self.error_messages["duplicate_email"],
+            code="duplicate_email",
+        )
+        self.add_error("email", error)
+        raise error
+
 
 class EmailUserChangeForm(forms.ModelForm):
 
@@ -114,6 +156,10 @@ class EmailUserChangeForm(forms.ModelForm):
         ),
     )
 
+    error_messages = {
+        "duplicate_email": _("A user with that email already exists."),
+    }
+
     class Meta:
         model = get_user_model()
         exclude = ()
@@ -128,3 +174,25 @@ class EmailUserChangeForm(forms.ModelForm):
             user_permissions.queryset = user_permissions.queryset.select_related(
                 "content_type"
             )
+
+    def clean_email(self):
+        """
+        Clean form email.
+
+        :return str email: cleaned email
+        :raise ValidationError: Email is used by another user
+        """
+        # Checked here with the same case handling as login, a case variant
+        # of another user's email would only fail on the unique index.
+        email = self.cleaned_data["email"]
+        if (
+            get_user_model()
+            ._default_manager.filter_by_email(email)
+            .exclude(pk=self.instance.pk)
+            .exists()
+        ):
+            raise ValidationError(
+                self.error_messages["duplicate_email"],
+                code="duplicate_email",
+            )
+        return email
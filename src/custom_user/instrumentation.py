@@ -0,0 +1,211 @@
+"""
+Timing hooks around the user hot paths.
+
+Subscribers are the callables listed, as dotted paths, in the
+CUSTOM_USER_INSTRUMENTATION_SUBSCRIBERS setting. Each one is called with the
+event name and the duration of the call in seconds:
+
+* create_user: EmailUserManager._create_user() and _acreate_user(), for
+  users and superusers
+* set_password: AbstractEmailUser.set_password(), which hashes the password
+* get_by_natural_key: EmailUserManager.get_by_natural_key() and
+  aget_by_natural_key()
+* load_permissions: the permission check of a user that loads its
+  permissions from the authentication backends
+* email_user: AbstractEmailUser.email_user() and aemail_user()
+
+Without subscribers, the instrumented functions only pay for an extra call.
+A subscriber raising an exception is logged, it doesn't affect the call.
+"""
+import asyncio
+import functools
+import logging
+import math
+import threading
+import time
+from collections import Counter, deque
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+_subscribers = None
+
+# Attributes where the backends keep the permissions loaded for a user.
+PERMISSION_CACHES = ("_perm_cache", "_user_perm_cache", "_group_perm_cache")
+
+
+def get_subscribers():
+    """
+    Return the subscribers, imported from the setting on first use.
+
+    :return list: callables taking an event name and a duration
+    """
+    global _subscribers
+    if _subscribers is None:
+        _subscribers = [
+            import_string(path) for path in get_setting("INSTRUMENTATION_SUBSCRIBERS")
+        ]
+    return _subscribers
+
+
+@receiver(setting_changed)
+def reset_subscribers(*, setting, **kwargs):
+    global _subscribers
+    if setting == "CUSTOM_USER_INSTRUMENTATION_SUBSCRIBERS":
+        _subscribers = None
+
+
+def report(event, duration):
+    """
+    Report the duration of event to the subscribers, logging their errors.
+
+    :param str event: event name
+    :param float duration: duration in seconds
+    """
+    for subscriber in get_subscribers():
+        try:
+            subscriber(event, duration)
+        except Exception:
+            logger.exception(
+                "Instrumentation subscriber %r failed on %s.", subscriber, event
+            )
+
+
+def instrumented(event):
+    """
+    Decorate a function to report its duration as event to the subscribers.
+
+    Coroutine functions report the duration until they return.
+
+    :param str event: event name
+    """
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not get_subscribers():
+                    return await func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    report(event, time.perf_counter() - start)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not get_subscribers():
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                report(event, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def instrumented_permission_check(method):
+    """
+    Decorate a permission check method of the user model to report
+    load_permissions when the call loads the permissions of the user.
+
+    Works with any backend keeping them in the attributes used by
+    ModelBackend, calls answered from these attributes aren't reported.
+    """
+
+    @functools.wraps(method)
+    def wrapper(user, *args, **kwargs):
+        if not get_subscribers():
+            return method(user, *args, **kwargs)
+        loaded = [name for name in PERMISSION_CACHES if hasattr(user, name)]
+        start = time.perf_counter()
+        try:
+            return method(user, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            if any(
+                hasattr(user, name) for name in PERMISSION_CACHES if name not in loaded
+            ):
+                report("load_permissions", duration)
+
+    return wrapper
+
+
+class InMemoryCollector:
+    """
+    Subscriber counting the calls of each event and keeping their latest
+    durations, to compute latency percentiles.
+
+    Subscribe the module-level collector instance with::
+
+        CUSTOM_USER_INSTRUMENTATION_SUBSCRIBERS = [
+            "custom_user.instrumentation.collector",
+        ]
+    """
+
+    def __init__(self, max_samples=10000):
+        """
+        :param int max_samples: durations kept for each event
+        """
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, event, duration):
+        with self.lock:
+            self.counts[event] += 1
+            if event not in self.samples:
+                self.samples[event] = deque(maxlen=self.max_samples)
+            self.samples[event].append(duration)
+
+    def reset(self):
+        """Forget all the recorded events."""
+        with self.lock:
+            self.counts = Counter()
+            self.samples = {}
+
+    def percentile(self, event, percent):
+        """
+        Return a percentile of the durations of event, by nearest rank.
+
+        :param str event: event name
+        :param float percent: percentile, between 0 and 100
+        :return float: duration in seconds, None if event wasn't recorded
+        """
+        with self.lock:
+            samples = sorted(self.samples.get(event, ()))
+        if not samples:
+            return None
+        rank = math.ceil(percent / 100 * len(samples))
+        return samples[max(rank, 1) - 1]
+
+    def stats(self):
+        """
+        Return the number of calls, p50 and p99 (in seconds) of each event.
+
+        :return dict: {"event": {"count": int, "p50": float, "p99": float}}
+        """
+        with self.lock:
+            counts = dict(self.counts)
+        return {
+            event: {
+                "count": count,
+                "p50": self.percentile(event, 50),
+                "p99": self.percentile(event, 99),
+            }
+            for event, count in counts.items()
+        }
+
+
+collector = InMemoryCollector()
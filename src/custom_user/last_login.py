@@ -0,0 +1,94 @@
+"""Coalesced last_login updates."""
+import threading
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from .conf import get_setting
+
+
+class LastLoginBuffer:
+    """
+    Buffer of last_login timestamps, written with bulk UPDATEs.
+
+    Timestamps are flushed when the buffer holds CUSTOM_USER_LAST_LOGIN_BUFFER_SIZE
+    users, or when CUSTOM_USER_LAST_LOGIN_PRECISION is set and the oldest one
+    is older than that many seconds. Call flush() to write them at any other
+    time, e.g. from a periodic task or at shutdown.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._since = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, pk, last_login):
+        """
+        Buffer the last_login of the user with the given pk.
+
+        :param pk: user primary key
+        :param datetime last_login: login time
+        """
+        with self._lock:
+            if not self._pending:
+                self._since = time.monotonic()
+            self._pending[pk] = last_login
+            full = len(self._pending) >= get_setting("LAST_LOGIN_BUFFER_SIZE")
+            precision = get_setting("LAST_LOGIN_PRECISION")
+            expired = (
+                precision is not None and time.monotonic() - self._since >= precision
+            )
+        if full or expired:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered timestamps.
+
+        :return int: number of users updated
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        model = get_user_model()
+        users = [model(pk=pk, last_login=value) for pk, value in pending.items()]
+        model._default_manager.bulk_update(users, ["last_login"], batch_size=500)
+        return len(users)
+
+
+last_login_buffer = LastLoginBuffer()
+
+
+def flush_last_logins():
+    """Write the buffered last_login timestamps, see LastLoginBuffer."""
+    return last_login_buffer.flush()
+
+
+def update_last_login(sender, user, **kwargs):
+    """
+    Update the last_login of the user logging in, like Django's receiver.
+
+    When CUSTOM_USER_LAST_LOGIN_PRECISION is set, the update is skipped if
+    last_login is more recent than that many seconds, and when
+    CUSTOM_USER_LAST_LOGIN_BUFFER_SIZE is set, it's buffered and written
+    with the logins of other users.
+    """
+    now = timezone.now()
+    precision = get_setting("LAST_LOGIN_PRECISION")
+    if (
+        precision is not None
+        and user.last_login is not None
+        and now - user.last_login < timedelta(seconds=precision)
+    ):
+        return
+    user.last_login = now
+    if get_setting("LAST_LOGIN_BUFFER_SIZE"):
+        last_login_buffer.add(user.pk, now)
+    else:
+        user.save(update_fields=["last_login"])
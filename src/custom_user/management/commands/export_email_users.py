@@ -0,0 +1,37 @@
+"""Management command to export users as CSV or JSONL."""
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from ...export import EXPORT_FORMATS, export_users
+
+
+class Command(BaseCommand):
+    help = "Export users with their flags, dates and groups as CSV or JSONL."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format",
+            choices=EXPORT_FORMATS,
+            default="csv",
+            help="Output format (default: csv).",
+        )
+        parser.add_argument(
+            "--output",
+            help="File to write to (default: stdout).",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help="Number of users fetched per query (default: 2000).",
+        )
+
+    def handle(self, *args, **options):
+        queryset = get_user_model()._default_manager.order_by("pk")
+        lines = export_users(queryset, options["format"], options["chunk_size"])
+        if options["output"]:
+            with open(options["output"], "w", newline="") as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending="")
@@ -0,0 +1,109 @@
+"""Management command to import users from CSV or JSONL."""
+import csv
+import json
+import sys
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from ...export import EXPORT_FORMATS
+from ...models import BULK_CREATED
+
+
+def read_csv(lines):
+    """Yield a record for every CSV row, groups separated by ";"."""
+    for row in csv.DictReader(lines):
+        record = {key: value for key, value in row.items() if value != ""}
+        if "groups" in record:
+            record["groups"] = record["groups"].split(";")
+        yield record
+
+
+def read_jsonl(lines):
+    """Yield a record for every non-empty JSONL line."""
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            raise CommandError("Line %d: invalid JSON (%s)." % (number, error))
+        if not isinstance(record, dict):
+            raise CommandError("Line %d: expected a JSON object." % number)
+        yield record
+
+
+class Command(BaseCommand):
+    help = (
+        "Import users from CSV or JSONL, as written by export_email_users. "
+        "Users whose email already exists are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "input",
+            help='File to read from, "-" for stdin.',
+        )
+        parser.add_argument(
+            "--format",
+            choices=EXPORT_FORMATS,
+            help="Input format (default: guessed from the file extension, csv "
+            "for stdin).",
+        )
+        parser.add_argument(
+            "--hashed-passwords",
+            action="store_true",
+            help="The password column has Django password hashes, stored as-is.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of users inserted per query (default: 1000).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes used to hash passwords (default: 1).",
+        )
+
+    def handle(self, *args, **options):
+        input_format = options["format"]
+        if input_format is None:
+            input_format = "jsonl" if options["input"].endswith(".jsonl") else "csv"
+        reader = read_csv if input_format == "csv" else read_jsonl
+        if options["input"] == "-":
+            counts = self.import_users(reader(sys.stdin), options)
+        else:
+            try:
+                with open(options["input"], newline="") as lines:
+                    counts = self.import_users(reader(lines), options)
+            except OSError as error:
+                raise CommandError(error)
+        self.stdout.write(
+            ", ".join("%s %s" % (counts[status], status) for status in sorted(counts))
+        )
+
+    def import_users(self, records, options):
+        counts = Counter()
+        results = get_user_model()._default_manager.iter_bulk_create_users(
+            records,
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+            hash_passwords=not options["hashed_passwords"],
+        )
+        for line, result in enumerate(results, start=1):
+            counts[result.status] += 1
+            if result.status != BULK_CREATED and options["verbosity"] > 1:
+                self.stderr.write(
+                    "Record %d (%s): %s%s"
+                    % (
+                        line,
+                        result.email,
+                        result.status,
+                        " (%s)" % result.error if result.error else "",
+                    )
+                )
+        return counts
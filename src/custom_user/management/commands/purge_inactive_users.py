@@ -0,0 +1,47 @@
+"""Management command to delete inactive users in chunks."""
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from ...conf import get_setting
+from ...purge import purge_users
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete inactive users, with their group and permission memberships "
+        "and admin log entries, in chunks and within a time budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of users deleted per transaction (default: 1000).",
+        )
+        parser.add_argument(
+            "--time-budget",
+            type=float,
+            default=get_setting("PURGE_TIME_BUDGET"),
+            help=(
+                "Seconds after which no new chunk is started (default: "
+                "CUSTOM_USER_PURGE_TIME_BUDGET)."
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the inactive users.",
+        )
+
+    def handle(self, *args, **options):
+        queryset = get_user_model()._default_manager.filter(is_active=False)
+        if options["dry_run"]:
+            self.stdout.write("%d inactive users" % queryset.count())
+            return
+        result = purge_users(queryset, options["chunk_size"], options["time_budget"])
+        self.stdout.write("%d inactive users deleted" % result.deleted)
+        if not result.complete:
+            self.stdout.write(
+                "Time budget spent, run the command again to delete the rest"
+            )
@@ -0,0 +1,31 @@
+"""Management command to rebuild the permission snapshots of users."""
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import PermissionSnapshotMixin
+
+
+class Command(BaseCommand):
+    help = (
+        "Store the permissions granted to each user, directly or through "
+        "groups, in its permission snapshot."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of users updated per query (default: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        model = get_user_model()
+        if not issubclass(model, PermissionSnapshotMixin):
+            raise CommandError(
+                "%s doesn't use PermissionSnapshotMixin" % model._meta.label
+            )
+        updated = model._default_manager.rebuild_permission_snapshots(
+            options["chunk_size"]
+        )
+        self.stdout.write("%d permission snapshots rebuilt" % updated)
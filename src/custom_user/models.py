@@ -1,20 +1,360 @@
 """User models."""
+import asyncio
+import inspect
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from smtplib import SMTPException
+
+import django
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import (
+    UNUSABLE_PASSWORD_PREFIX,
+    check_password,
+    identify_hasher,
+    make_password,
+)
 from django.contrib.auth.models import (
     AbstractBaseUser,
     BaseUserManager,
+    Group,
+    Permission,
     PermissionsMixin,
 )
-from django.core.mail import send_mail
-from django.db import models
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.mail import EmailMultiAlternatives, get_connection, send_mail
+from django.db import IntegrityError, models, transaction
+from django.db.models import Exists, OuterRef, Prefetch, Q, Value
+from django.db.models.functions import Lower, StrIndex, Substr
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from .conf import get_setting
+from .instrumentation import instrumented, instrumented_permission_check
+
+BULK_CREATED = "created"
+BULK_DUPLICATE = "duplicate"
+BULK_INVALID = "invalid"
+BULK_UPDATED = "updated"
+BULK_UNCHANGED = "unchanged"
+
+BulkCreateResult = namedtuple("BulkCreateResult", ["email", "status", "error"])
+
+# Number of times upsert_users() applies a batch conflicting with
+# concurrent inserts.
+UPSERT_ATTEMPTS = 3
+
+
+def _chunked(iterable, size):
+    """Yield lists of at most size items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _hash_passwords(passwords):
+    """Hash a list of raw passwords. Module level so it can be pickled."""
+    return [make_password(password) for password in passwords]
+
+
+_hasher_executor = None
+_hasher_executor_lock = threading.Lock()
+
+
+def _get_hasher_executor():
+    """Return the thread pool used by the async API to hash passwords."""
+    global _hasher_executor
+    with _hasher_executor_lock:
+        if _hasher_executor is None:
+            _hasher_executor = ThreadPoolExecutor(
+                max_workers=get_setting("ASYNC_HASHER_WORKERS"),
+                thread_name_prefix="custom_user_hasher",
+            )
+    return _hasher_executor
+
+
+async def _ahash_password(password):
+    """
+    Hash a raw password without blocking the event loop.
+
+    hashlib releases the GIL while hashing, so the threads of the pool run
+    in parallel. The pool size bounds the CPU used by concurrent signups.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_hasher_executor(), make_password, password)
+
+
+def email_domain():
+    """Return an expression with the part of the email after the "@"."""
+    return Substr("email", StrIndex("email", Value("@")) + 1)
+
+
+MassMailResult = namedtuple("MassMailResult", ["sent", "failed"])
+
+
+def _permission_names(permissions):
+    return {
+        "%s.%s" % (permission.content_type.app_label, permission.codename)
+        for permission in permissions
+    }
+
+
+def _fill_permission_caches(user):
+    """Fill the ModelBackend caches of user from its prefetched permissions."""
+    if not user.is_active or user.is_superuser:
+        # has_perm() doesn't look at the caches for these users.
+        return
+    user._user_perm_cache = _permission_names(user.user_permissions.all())
+    user._group_perm_cache = _permission_names(
+        permission
+        for group in user.groups.all()
+        for permission in group.permissions.all()
+    )
+    user._perm_cache = user._user_perm_cache | user._group_perm_cache
+
+
+def _render(value, user):
+    """Return value, or value(user) if it's a callable."""
+    return value(user) if callable(value) else value
 
-class EmailUserManager(BaseUserManager):
+
+class EmailUserQuerySet(models.QuerySet):
+    """
+    Custom queryset for EmailUser.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fill_permission_caches = False
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._fill_permission_caches = self._fill_permission_caches
+        return clone
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        if issubclass(self.model, PermissionSnapshotMixin):
+            # New users have no groups or permissions yet.
+            for user in objs:
+                if user.permission_snapshot is None:
+                    user.permission_snapshot = []
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super()._fetch_all()
+        if self._fill_permission_caches and not fetched:
+            for user in self._result_cache:
+                if isinstance(user, AbstractEmailUser):
+                    _fill_permission_caches(user)
+
+    def active(self):
+        """Return the active users."""
+        return self.filter(is_active=True)
+
+    def staff(self):
+        """Return the users that can log into the admin site."""
+        return self.filter(is_staff=True)
+
+    def lean(self, *fields):
+        """
+        Defer the password hash, and the given fields, for listings.
+
+        :param str fields: other fields to defer
+        """
+        return self.defer("password", *fields)
+
+    def with_permissions(self):
+        """
+        Prefetch the groups and permissions of the users.
+
+        The permission caches of PermissionsMixin are filled, so has_perm()
+        and get_all_permissions() don't run any query for these users.
+        """
+        permissions = Permission.objects.select_related("content_type")
+        clone = self.prefetch_related(
+            Prefetch("user_permissions", queryset=permissions),
+            Prefetch("groups__permissions", queryset=permissions),
+        )
+        clone._fill_permission_caches = True
+        return clone
+
+    def users_with_perm(self, perm, is_active=True, include_superusers=True):
+        """
+        Return the users that have the given permission, in a single query.
+
+        Like ModelBackend.with_perm(), permissions granted directly and
+        through groups are checked, superusers are included and inactive
+        users excluded by default.
+
+        :param perm: "app_label.codename" string or Permission
+        :param bool is_active: only active users (None for all users)
+        :param bool include_superusers: include superusers
+        :return QuerySet: users with the permission
+        :raise ValueError: perm isn't in the form app_label.codename
+        """
+        permission_q = Q(group__user=OuterRef("pk")) | Q(user=OuterRef("pk"))
+        if isinstance(perm, Permission):
+            permission_q &= Q(pk=perm.pk)
+        else:
+            try:
+                app_label, codename = perm.split(".")
+            except ValueError:
+                raise ValueError(
+                    "Permission name should be in the form "
+                    "app_label.permission_codename."
+                )
+            permission_q &= Q(codename=codename, content_type__app_label=app_label)
+        user_q = Exists(Permission.objects.filter(permission_q))
+        if include_superusers:
+            user_q |= Q(is_superuser=True)
+        if is_active is not None:
+            user_q &= Q(is_active=is_active)
+        return self.filter(user_q)
+
+    def perms_for_users(self, user_ids):
+        """
+        Return the permissions of many users, in a constant number of queries.
+
+        Gives the same result as calling get_all_permissions() on each user:
+        inactive users have no permissions and superusers have all of them.
+
+        :param iterable user_ids: user primary keys
+        :return dict: set of "app_label.codename" strings by user pk, users
+            that don't exist are left out
+        """
+        users = list(
+            self.filter(pk__in=user_ids).values_list("pk", "is_active", "is_superuser")
+        )
+        perms = {pk: set() for pk, is_active, is_superuser in users}
+        active = [pk for pk, is_active, is_superuser in users if is_active]
+        superusers = {
+            pk for pk, is_active, is_superuser in users if is_active and is_superuser
+        }
+        if superusers:
+            everything = _permission_names(
+                Permission.objects.select_related("content_type")
+            )
+            for pk in superusers:
+                perms[pk] = set(everything)
+        others = [pk for pk in active if pk not in superusers]
+        if others:
+            perms.update(self._granted_permissions(others))
+        return perms
+
+    def _granted_permissions(self, user_ids):
+        """
+        Return the permissions granted to users directly or through their
+        groups, regardless of is_active and is_superuser, in two queries.
+        """
+        perms = {pk: set() for pk in user_ids}
+        for lookup in ("user", "group__user"):
+            granted = Permission.objects.filter(
+                **{"%s__in" % lookup: user_ids}
+            ).values_list(lookup, "content_type__app_label", "codename")
+            for pk, app_label, codename in granted:
+                perms[pk].add("%s.%s" % (app_label, codename))
+        return perms
+
+    def rebuild_permission_snapshots(self, chunk_size=1000):
+        """
+        Store the permissions granted to the users in their
+        permission_snapshot, for models with PermissionSnapshotMixin.
+
+        Walks the queryset in ascending pk ranges of at most chunk_size
+        users, with three queries per range.
+
+        :param int chunk_size: number of users updated per query
+        :return int: number of users updated
+        """
+        queryset = self.order_by("pk")
+        updated = 0
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            pks = list(chunk.values_list("pk", flat=True)[:chunk_size])
+            if not pks:
+                return updated
+            perms = self._granted_permissions(pks)
+            users = [
+                self.model(pk=pk, permission_snapshot=sorted(perms[pk])) for pk in pks
+            ]
+            self.model._base_manager.using(self.db).bulk_update(
+                users, ["permission_snapshot"]
+            )
+            updated += len(users)
+            last_pk = pks[-1]
+
+    def email_users(
+        self,
+        subject,
+        message,
+        from_email=None,
+        html_message=None,
+        chunk_size=500,
+        connection=None,
+    ):
+        """
+        Send an email to every user in the queryset.
+
+        Users are streamed with iterator() and the messages of each chunk are
+        sent through a single connection. A chunk whose connection can't be
+        opened is counted as failed. subject, message and html_message
+        can be callables that take the user and return the text, to
+        personalize each email.
+
+        :param subject: email subject, or a callable returning it
+        :param message: email body, or a callable returning it
+        :param str from_email: sender, DEFAULT_FROM_EMAIL if not set
+        :param html_message: HTML body, or a callable returning it
+        :param int chunk_size: number of users fetched and sent per connection
+        :param connection: email backend to use instead of the default one
+        :return MassMailResult: number of emails sent and failed
+        """
+        sent = failed = 0
+        for chunk in _chunked(self.iterator(chunk_size=chunk_size), chunk_size):
+            backend = connection or get_connection()
+            try:
+                backend.open()
+            except (SMTPException, OSError):
+                # The next chunk tries again with a new connection.
+                failed += len(chunk)
+                continue
+            try:
+                for user in chunk:
+                    email = EmailMultiAlternatives(
+                        _render(subject, user),
+                        _render(message, user),
+                        from_email,
+                        [user.email],
+                        connection=backend,
+                    )
+                    if html_message is not None:
+                        email.attach_alternative(
+                            _render(html_message, user), "text/html"
+                        )
+                    try:
+                        count = backend.send_messages([email]) or 0
+                    except (SMTPException, OSError):
+                        count = 0
+                    sent += count
+                    failed += 1 - count
+            finally:
+                backend.close()
+        return MassMailResult(sent, failed)
+
+
+class EmailUserManager(BaseUserManager.from_queryset(EmailUserQuerySet)):
     """
     Custom manager for EmailUser.
     """
 
+    @instrumented("create_user")
     def _create_user(self, email, password, is_staff, is_superuser, **extra_fields):
         """
         Create and save an EmailUser with the given email and password.
@@ -24,6 +364,17 @@ class EmailUserManager(BaseUserManager):
         :param bool is_staff: whether user staff or not
         :param bool is_superuser: whether user admin or not
         :return custom_user.models.EmailUser user: user
+        :raise ValueError: email is not set
+        """
+        user = self._build_user(email, is_staff, is_superuser, **extra_fields)
+        user.set_password(password)
+        user.save(using=self._db)
+        return user
+
+    def _build_user(self, email, is_staff, is_superuser, **extra_fields):
+        """
+        Return an unsaved EmailUser without password.
+
         :raise ValueError: email is not set
         """
         now = timezone.now()
@@ -31,7 +382,7 @@ class EmailUserManager(BaseUserManager):
             raise ValueError("The given email must be set")
         email = self.normalize_email(email)
         is_active = extra_fields.pop("is_active", True)
-        user = self.model(
+        return self.model(
             email=email,
             is_staff=is_staff,
             is_active=is_active,
@@ -40,8 +391,21 @@ class EmailUserManager(BaseUserManager):
             date_joined=now,
             **extra_fields
         )
-        user.set_password(password)
-        user.save(using=self._db)
+
+    @instrumented("create_user")
+    async def _acreate_user(
+        self, email, password, is_staff, is_superuser, **extra_fields
+    ):
+        """
+        Async version of _create_user().
+
+        The password is hashed in the hasher thread pool, so the event loop
+        isn't blocked and concurrent signups hash in parallel.
+        """
+        user = self._build_user(email, is_staff, is_superuser, **extra_fields)
+        user.password = await _ahash_password(password)
+        user._password = password
+        await sync_to_async(user.save)(using=self._db)
         return user
 
     def create_user(self, email, password=None, **extra_fields):
@@ -74,6 +438,557 @@ class EmailUserManager(BaseUserManager):
 
         return self._create_user(email, password, **extra_fields)
 
+    async def acreate_user(self, email, password=None, **extra_fields):
+        """
+        Async version of create_user().
+
+        :param str email: user email
+        :param str password: user password
+        :return custom_user.models.EmailUser user: regular user
+        """
+        extra_fields.setdefault("is_staff", False)
+        extra_fields.setdefault("is_superuser", False)
+        return await self._acreate_user(email, password, **extra_fields)
+
+    async def acreate_superuser(self, email, password=None, **extra_fields):
+        """
+        Async version of create_superuser().
+
+        :param str email: user email
+        :param str password: user password
+        :return custom_user.models.EmailUser user: admin user
+        """
+        extra_fields.setdefault("is_staff", True)
+        extra_fields.setdefault("is_superuser", True)
+
+        if extra_fields.get("is_staff") is not True:
+            raise ValueError("Superuser must have is_staff=True.")
+        if extra_fields.get("is_superuser") is not True:
+            raise ValueError("Superuser must have is_superuser=True.")
+
+        return await self._acreate_user(email, password, **extra_fields)
+
+    def filter_by_email(self, email):
+        """
+        Return a queryset of the users with the given email.
+
+        When CUSTOM_USER_EMAIL_CASE_INSENSITIVE is enabled, the comparison is
+        done on LOWER(email), so it uses the case-insensitive unique index.
+
+        :param str email: user email
+        :return QuerySet: users matching the email
+        """
+        if get_setting("EMAIL_CASE_INSENSITIVE"):
+            return self.alias(email_lower=Lower("email")).filter(
+                email_lower=Lower(Value(email))
+            )
+        return self.filter(email=email)
+
+    @instrumented("get_by_natural_key")
+    def get_by_natural_key(self, username):
+        """
+        Return the user with the given email, used by authentication backends.
+
+        :param str username: user email
+        :return custom_user.models.EmailUser user: user
+        :raise DoesNotExist: no user with that email
+        """
+        # The hint lets EmailUserRouter read a user written recently from
+        # the primary database.
+        manager = self.db_manager(self._db, hints={"user_email": username})
+        return manager.filter_by_email(username).get()
+
+    @instrumented("get_by_natural_key")
+    async def aget_by_natural_key(self, username):
+        """
+        Async version of get_by_natural_key().
+
+        :param str username: user email
+        :return custom_user.models.EmailUser user: user
+        :raise DoesNotExist: no user with that email
+        """
+        manager = self.db_manager(self._db, hints={"user_email": username})
+        queryset = manager.filter_by_email(username)
+        if hasattr(queryset, "aget"):
+            return await queryset.aget()
+        return await sync_to_async(queryset.get)()  # pragma: no cover
+
+    def bulk_create_users(
+        self, records, batch_size=1000, workers=None, hash_passwords=True
+    ):
+        """
+        Create EmailUsers in batches from an iterable of dicts.
+
+        Each record needs an ``email`` key and may have a ``password`` key and
+        a ``groups`` key with a list of group names, any other key is passed
+        to the model like in create_user(). Records are consumed lazily, so
+        the iterable can be a generator of any size. Passwords are hashed in
+        a pool of worker processes when workers is greater than 1.
+
+        The results of every record are kept until the end, use
+        iter_bulk_create_users() to keep memory flat on large inputs.
+
+        :param iterable records: dicts with the user fields
+        :param int batch_size: number of records inserted per query
+        :param int workers: number of processes used to hash passwords
+        :param bool hash_passwords: False if the passwords are already hashed
+        :return list: one BulkCreateResult per record, in input order
+        """
+        return list(
+            self.iter_bulk_create_users(records, batch_size, workers, hash_passwords)
+        )
+
+    def iter_bulk_create_users(
+        self, records, batch_size=1000, workers=None, hash_passwords=True
+    ):
+        """
+        Like bulk_create_users(), but yield the results of each batch once
+        it is inserted. Nothing is inserted until the results are consumed.
+
+        :return iterator: one BulkCreateResult per record, in input order
+        """
+        executor = None
+        if hash_passwords and workers and workers > 1:
+            # Workers started with spawn or forkserver import this module
+            # from scratch, so Django has to be set up in them first.
+            executor = ProcessPoolExecutor(
+                max_workers=workers, initializer=django.setup
+            )
+        from .routers import use_primary
+
+        try:
+            for batch in _chunked(records, batch_size):
+                # Duplicates are looked up where the batch is inserted.
+                with use_primary():
+                    results = self._bulk_create_batch(
+                        batch, executor, workers, hash_passwords
+                    )
+                yield from results
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _bulk_create_batch(self, batch, executor, workers, hash_passwords):
+        """
+        Validate, hash and insert one batch of records.
+
+        :return list: one BulkCreateResult per record in the batch
+        """
+        now = timezone.now()
+        results = [None] * len(batch)
+        case_insensitive = get_setting("EMAIL_CASE_INSENSITIVE")
+        key = str.lower if case_insensitive else None
+        pending = self._clean_batch_emails(batch, results, key=key)
+        if case_insensitive:
+            existing = self.alias(email_lower=Lower("email")).filter(
+                email_lower__in=list(pending)
+            )
+        else:
+            existing = self.filter(email__in=list(pending))
+        existing = {
+            key(email) if key else email
+            for email in existing.values_list("email", flat=True)
+        }
+        group_ids = self._bulk_group_ids(pending.values())
+        users, indexes, passwords, user_groups = [], [], [], []
+        for email_key, (index, email, fields) in pending.items():
+            if email_key in existing:
+                results[index] = BulkCreateResult(email, BULK_DUPLICATE, None)
+                continue
+            password = fields.pop("password", None)
+            groups = fields.pop("groups", None) or ()
+            fields.setdefault("is_staff", False)
+            fields.setdefault("is_superuser", False)
+            fields.setdefault("is_active", True)
+            fields.setdefault("last_login", now)
+            fields.setdefault("date_joined", now)
+            try:
+                unknown = [name for name in groups if name not in group_ids]
+                if unknown:
+                    raise ValueError("Unknown groups: %s" % ", ".join(unknown))
+                if not (
+                    hash_passwords
+                    or not password
+                    or password.startswith(UNUSABLE_PASSWORD_PREFIX)
+                ):
+                    identify_hasher(password)
+                user = self.model(email=email, **fields)
+                user.clean_fields(exclude=["password"])
+            except (TypeError, ValueError, ValidationError) as error:
+                results[index] = BulkCreateResult(email, BULK_INVALID, error)
+                continue
+            users.append(user)
+            indexes.append(index)
+            passwords.append(password)
+            user_groups.append([group_ids[name] for name in groups])
+
+        if not hash_passwords:
+            hashed = [password or make_password(None) for password in passwords]
+        elif executor is None:
+            hashed = _hash_passwords(passwords)
+        else:
+            size = max(1, -(-len(passwords) // workers))
+            hashed = [
+                password
+                for chunk in executor.map(_hash_passwords, _chunked(passwords, size))
+                for password in chunk
+            ]
+        for user, password in zip(users, hashed):
+            user.password = password
+
+        try:
+            with transaction.atomic(using=self.db):
+                self.bulk_create(users)
+            statuses = [BULK_CREATED] * len(users)
+        except IntegrityError:
+            # A concurrent insert won the race, fall back to one row at a time
+            # so only the conflicting rows are reported as duplicates.
+            statuses = []
+            for user in users:
+                user.pk = None
+                user._state.adding = True
+                try:
+                    with transaction.atomic(using=self.db):
+                        user.save(using=self.db, force_insert=True)
+                    statuses.append(BULK_CREATED)
+                except IntegrityError:
+                    statuses.append(BULK_DUPLICATE)
+        self._bulk_add_groups(
+            [
+                (user, groups)
+                for user, groups, status in zip(users, user_groups, statuses)
+                if groups and status == BULK_CREATED
+            ]
+        )
+        for user, index, status in zip(users, indexes, statuses):
+            results[index] = BulkCreateResult(user.email, status, None)
+        return results
+
+    def upsert_users(self, records, batch_size=1000):
+        """
+        Create or update EmailUsers in batches from an iterable of dicts.
+
+        Records are matched to the stored users by email, case-insensitively
+        with CUSTOM_USER_EMAIL_CASE_INSENSITIVE. New users are inserted with
+        one query per batch. Stored users are compared with their record and
+        only the ones that differ are written, with one query per batch and
+        set of changed fields. A ``groups`` key sets the groups of the user
+        to exactly the given names. A ``password`` key is only used for new
+        users, which get an unusable password without it.
+
+        Each batch runs in a transaction. If it conflicts with users created
+        concurrently, it is read and applied again, up to UPSERT_ATTEMPTS
+        times in all. When every attempt conflicts, nothing is written for
+        the batch and its valid records are reported as BULK_DUPLICATE, with
+        the IntegrityError. Upserting the same records twice writes nothing.
+
+        :param iterable records: dicts with the user fields
+        :param int batch_size: number of records per batch
+        :return list: one BulkCreateResult per record, in input order, with
+            a status of BULK_CREATED, BULK_UPDATED, BULK_UNCHANGED,
+            BULK_DUPLICATE (email repeated in records, or conflicting
+            batch) or BULK_INVALID
+        """
+        # Imported here, the routers need the user model to be loaded.
+        from .routers import use_primary
+
+        results = []
+        for batch in _chunked(records, batch_size):
+            # Batches are diffed against the rows they write, not replicas.
+            with use_primary():
+                for attempt in range(UPSERT_ATTEMPTS):
+                    try:
+                        with transaction.atomic(using=self.db):
+                            batch_results = self._upsert_batch(batch)
+                        break
+                    except IntegrityError as error:
+                        # A concurrent insert won the race, the next attempt
+                        # finds and updates the row it created.
+                        conflict = error
+                else:
+                    batch_results = [None] * len(batch)
+                    key = str.lower if get_setting("EMAIL_CASE_INSENSITIVE") else None
+                    pending = self._clean_batch_emails(batch, batch_results, key=key)
+                    for index, email, fields in pending.values():
+                        batch_results[index] = BulkCreateResult(
+                            email, BULK_DUPLICATE, conflict
+                        )
+            results.extend(batch_results)
+        return results
+
+    def _upsert_batch(self, batch):
+        """
+        Diff one batch of records against the stored users and write them.
+
+        :return list: one BulkCreateResult per record in the batch
+        """
+        from .signals import invalidate_permissions, invalidate_user, stick_user
+
+        now = timezone.now()
+        case_insensitive = get_setting("EMAIL_CASE_INSENSITIVE")
+        key = str.lower if case_insensitive else None
+        results = [None] * len(batch)
+        pending = self._clean_batch_emails(batch, results, key=key)
+        if case_insensitive:
+            stored = self.alias(email_lower=Lower("email")).filter(
+                email_lower__in=list(pending)
+            )
+        else:
+            stored = self.filter(email__in=list(pending))
+        stored = {key(user.email) if key else user.email: user for user in stored}
+        group_ids = self._bulk_group_ids(pending.values())
+
+        new_users, changed, user_groups = [], {}, []
+        statuses = {}
+        for email_key, (index, email, fields) in pending.items():
+            password = fields.pop("password", None)
+            groups = fields.pop("groups", None)
+            user = stored.get(email_key)
+            new = user is None
+            try:
+                unknown = [name for name in groups or () if name not in group_ids]
+                if unknown:
+                    raise ValueError("Unknown groups: %s" % ", ".join(unknown))
+                if new:
+                    fields.setdefault("is_staff", False)
+                    fields.setdefault("is_superuser", False)
+                    fields.setdefault("is_active", True)
+                    fields.setdefault("date_joined", now)
+                    candidate = self.model(email=email, **fields)
+                else:
+                    candidate = self.model(email=user.email, **fields)
+                candidate.clean_fields(exclude=["password"])
+                attnames = [self.model._meta.get_field(name).attname for name in fields]
+            except (TypeError, ValueError, ValidationError, FieldDoesNotExist) as error:
+                results[index] = BulkCreateResult(email, BULK_INVALID, error)
+                continue
+            if new:
+                candidate.password = make_password(password)
+                new_users.append(candidate)
+                statuses[index] = [email, BULK_CREATED]
+                user = candidate
+            else:
+                updated = frozenset(
+                    attname
+                    for attname in attnames
+                    if getattr(candidate, attname) != getattr(user, attname)
+                )
+                for attname in updated:
+                    setattr(user, attname, getattr(candidate, attname))
+                if updated:
+                    changed.setdefault(updated, []).append(user)
+                statuses[index] = [email, BULK_UPDATED if updated else BULK_UNCHANGED]
+            if groups is not None:
+                groups = {group_ids[name] for name in groups}
+                user_groups.append((index, user, groups, new))
+
+        self.bulk_create(new_users)
+        for attnames, users in changed.items():
+            self.bulk_update(users, list(attnames))
+        memberships_changed = self._bulk_set_groups(
+            [(user, groups, new) for index, user, groups, new in user_groups]
+        )
+        for index, user, groups, new in user_groups:
+            if not new and user in memberships_changed:
+                statuses[index][1] = BULK_UPDATED
+
+        # Bulk writes don't send post_save or m2m_changed.
+        for user in memberships_changed.union(*changed.values()):
+            invalidate_user(sender=self.model, instance=user, using=self.db)
+            stick_user(sender=self.model, instance=user, using=self.db)
+        for user in new_users:
+            stick_user(sender=self.model, instance=user, using=self.db)
+        if memberships_changed:
+            through = self.model._meta.get_field("groups").remote_field.through
+            invalidate_permissions(sender=through, using=self.db)
+        for index, (email, status) in statuses.items():
+            results[index] = BulkCreateResult(email, status, None)
+        return results
+
+    def _bulk_set_groups(self, user_groups):
+        """
+        Set the groups of users, with one insert and one delete.
+
+        :param list user_groups: (user, set of group pks, whether the user
+            was just inserted) tuples
+        :return set: existing users whose groups changed
+        """
+        field = self.model._meta.get_field("groups")
+        through = field.remote_field.through
+        user_attname = "%s_id" % field.m2m_field_name()
+        group_attname = "%s_id" % field.m2m_reverse_field_name()
+        current = {}
+        pks = [user.pk for user, groups, new in user_groups if not new]
+        if pks:
+            memberships = (
+                through._default_manager.using(self.db)
+                .filter(**{"%s__in" % user_attname: pks})
+                .values_list("pk", user_attname, group_attname)
+            )
+            for pk, user_pk, group_pk in memberships:
+                current.setdefault(user_pk, {})[group_pk] = pk
+        to_add, to_delete, changed = [], [], set()
+        for user, groups, new in user_groups:
+            existing = {} if new else current.get(user.pk, {})
+            added = [pk for pk in groups if pk not in existing]
+            deleted = [
+                pk for group_pk, pk in existing.items() if group_pk not in groups
+            ]
+            if added:
+                to_add.append((user, added))
+            to_delete.extend(deleted)
+            if not new and (added or deleted):
+                changed.add(user)
+        if to_delete:
+            through._default_manager.using(self.db).filter(pk__in=to_delete).delete()
+        self._bulk_add_groups(to_add)
+        added = {user.pk for user, groups in to_add}
+        self._rebuild_snapshots([user.pk for user in changed if user.pk not in added])
+        return changed
+
+    def get_or_provision(self, email, **defaults):
+        """
+        Return the user with the given email, creating it if needed.
+
+        Looking up an existing user takes a single query. defaults are only
+        used to create the user, like the extra fields of create_user(), and
+        may include a ``password`` (unusable without it) and a ``groups``
+        list of group names. A user created concurrently with the same email
+        is returned instead of raising IntegrityError.
+
+        :param str email: user email
+        :return tuple: (user, created)
+        :raise ValueError: email is not set or a group doesn't exist
+        """
+        # Imported here, the routers need the user model to be loaded.
+        from .routers import use_primary
+
+        email = self.normalize_email(email)
+        try:
+            return self.get_by_natural_key(email), False
+        except self.model.DoesNotExist:
+            pass
+        # Creating the user, and reading one created concurrently that the
+        # replicas may lack, both need the primary.
+        with use_primary():
+            return self._provision(email, defaults)
+
+    def _provision(self, email, defaults):
+        """Create the user for get_or_provision(), see its arguments."""
+        defaults = dict(defaults)
+        password = defaults.pop("password", None)
+        names = defaults.pop("groups", None) or ()
+        groups = list(Group.objects.using(self.db).filter(name__in=names))
+        unknown = set(names) - {group.name for group in groups}
+        if unknown:
+            raise ValueError("Unknown groups: %s" % ", ".join(sorted(unknown)))
+        is_staff = defaults.pop("is_staff", False)
+        is_superuser = defaults.pop("is_superuser", False)
+        try:
+            with transaction.atomic(using=self.db):
+                user = self._create_user(
+                    email, password, is_staff, is_superuser, **defaults
+                )
+                user.groups.add(*groups)
+        except IntegrityError:
+            user = self.filter_by_email(email).first()
+            if user is None:
+                raise
+            return user, False
+        return user, True
+
+    def _clean_batch_emails(self, batch, results, key=None):
+        """
+        Normalize and validate the emails of a batch of records.
+
+        Invalid and repeated emails get their result set in results.
+
+        :param list batch: records
+        :param list results: results of the batch, by record index
+        :param callable key: function returning the key emails are
+            deduplicated by, the email itself by default
+        :return dict: (index, email, other fields) by email key
+        """
+        email_field = self.model._meta.get_field("email")
+        pending = {}
+        for index, record in enumerate(batch):
+            fields = dict(record)
+            email = fields.pop("email", None)
+            try:
+                if not email:
+                    raise ValueError("The given email must be set")
+                email = self.normalize_email(email)
+                email_field.run_validators(email)
+            except (ValueError, ValidationError) as error:
+                results[index] = BulkCreateResult(email, BULK_INVALID, error)
+                continue
+            email_key = key(email) if key else email
+            if email_key in pending:
+                results[index] = BulkCreateResult(email, BULK_DUPLICATE, None)
+                continue
+            pending[email_key] = (index, email, fields)
+        return pending
+
+    def _bulk_group_ids(self, pending):
+        """
+        Return the pks of the groups named in the records, by name.
+
+        :param iterable pending: (index, email, fields) tuples
+        :return dict: group pk by name
+        """
+        names = {
+            name
+            for index, email, fields in pending
+            for name in fields.get("groups") or ()
+        }
+        if not names:
+            return {}
+        return dict(
+            Group.objects.using(self.db)
+            .filter(name__in=names)
+            .values_list("name", "pk")
+        )
+
+    def _bulk_add_groups(self, user_groups):
+        """
+        Insert the group memberships of new users with a single query.
+
+        :param list user_groups: (user, list of group pks) tuples
+        """
+        if not user_groups:
+            return
+        users = [user for user, groups in user_groups]
+        if any(user.pk is None for user in users):
+            # Databases that don't return the pks from bulk_create().
+            pks = dict(
+                self.filter(email__in=[user.email for user in users]).values_list(
+                    "email", "pk"
+                )
+            )
+            for user in users:
+                user.pk = pks[user.email]
+        field = self.model._meta.get_field("groups")
+        through = field.remote_field.through
+        user_attname = "%s_id" % field.m2m_field_name()
+        group_attname = "%s_id" % field.m2m_reverse_field_name()
+        through._default_manager.using(self.db).bulk_create(
+            [
+                through(**{user_attname: user.pk, group_attname: group_pk})
+                for user, groups in user_groups
+                for group_pk in groups
+            ]
+        )
+        self._rebuild_snapshots([user.pk for user in users])
+
+    def _rebuild_snapshots(self, pks):
+        """
+        Rebuild the permission snapshots after bulk writes of memberships,
+        which don't send m2m_changed.
+        """
+        if pks and issubclass(self.model, PermissionSnapshotMixin):
+            users = self.model._default_manager.using(self.db).filter(pk__in=pks)
+            users.rebuild_permission_snapshots()
+
 
 class AbstractEmailUser(AbstractBaseUser, PermissionsMixin):
     """
@@ -128,10 +1043,124 @@ class AbstractEmailUser(AbstractBaseUser, PermissionsMixin):
         """Return the email."""
         return self.email
 
+    def check_password(self, raw_password):
+        """
+        Return whether raw_password is the password of this user.
+
+        With CUSTOM_USER_BACKGROUND_PASSWORD_UPGRADE, a password hashed with
+        an outdated hasher is rehashed and saved in a background thread, so
+        the login only pays for one hash.
+        """
+        if not get_setting("BACKGROUND_PASSWORD_UPGRADE"):
+            return super().check_password(raw_password)
+
+        # Imported here, the backends need the user model to be loaded.
+        from .password_upgrade import password_upgrader
+
+        def setter(raw_password):
+            password_upgrader.submit(self, raw_password)
+
+        return check_password(raw_password, self.password, setter)
+
+    def get_session_auth_fallback_hash(self):
+        """
+        Also accept the sessions opened before a background password upgrade.
+
+        Only called by Django 4.1.8 and later.
+        """
+        from .password_upgrade import previous_session_auth_hash
+
+        yield from super().get_session_auth_fallback_hash()
+        previous = previous_session_auth_hash(self)
+        if previous is not None:
+            yield previous
+
+    @instrumented_permission_check
+    def get_user_permissions(self, obj=None):
+        """Return the permissions granted directly to this user."""
+        return super().get_user_permissions(obj)
+
+    @instrumented_permission_check
+    def get_group_permissions(self, obj=None):
+        """Return the permissions this user has through its groups."""
+        return super().get_group_permissions(obj)
+
+    @instrumented_permission_check
+    def get_all_permissions(self, obj=None):
+        """Return all the permissions of this user."""
+        return super().get_all_permissions(obj)
+
+    @instrumented_permission_check
+    def has_perm(self, perm, obj=None):
+        """Return whether this user has the permission perm."""
+        return super().has_perm(perm, obj)
+
+    @instrumented_permission_check
+    def has_module_perms(self, app_label):
+        """Return whether this user has any permission in app_label."""
+        return super().has_module_perms(app_label)
+
+    @instrumented("set_password")
+    def set_password(self, raw_password):
+        """Hash and set the password, reporting the time it took."""
+        super().set_password(raw_password)
+
+    @instrumented("email_user")
     def email_user(self, subject, message, from_email=None, **kwargs):
         """Send an email to this User."""
         send_mail(subject, message, from_email, [self.email], **kwargs)
 
+    @instrumented("email_user")
+    async def aemail_user(self, subject, message, from_email=None, **kwargs):
+        """Async version of email_user(), sent from a worker thread."""
+        await sync_to_async(send_mail, thread_sensitive=False)(
+            subject, message, from_email, [self.email], **kwargs
+        )
+
+
+_DO_UPDATE_SIGNATURE = inspect.signature(models.Model._do_update)
+
+
+class PermissionSnapshotMixin(models.Model):
+    """
+    Stores the permissions granted to a user, directly or through groups,
+    in its own row.
+
+    Add it to a subclass of AbstractEmailUser and use SnapshotModelBackend
+    to check permissions without querying groups and permissions. Signal
+    receivers rebuild the snapshot when memberships, group permissions or
+    permissions change. None means the snapshot was never built.
+    """
+
+    permission_snapshot = models.JSONField(
+        _("permission snapshot"), null=True, editable=False
+    )
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        """Save the user, with an empty snapshot when it is created."""
+        if self._state.adding and self.permission_snapshot is None:
+            self.permission_snapshot = []
+        super().save(*args, **kwargs)
+
+    def _do_update(self, *args, **kwargs):
+        # The snapshot is only written by the signal receivers, so saving an
+        # instance loaded before a membership change doesn't undo it. Only
+        # the UPDATE leaves it out, save() otherwise behaves as usual. The
+        # arguments are matched by name, their positions are private to
+        # Django.
+        arguments = _DO_UPDATE_SIGNATURE.bind(self, *args, **kwargs).arguments
+        if arguments["update_fields"] is None:
+            arguments["values"] = [
+                value
+                for value in arguments["values"]
+                if value[0].name != "permission_snapshot"
+            ]
+        del arguments["self"]
+        return super()._do_update(**arguments)
+
 
 class EmailUser(AbstractEmailUser):
     """
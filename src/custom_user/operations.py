@@ -0,0 +1,127 @@
+"""Migration operations for EmailUser models."""
+import django
+from django.db.migrations.operations.base import Operation
+from django.db.models import Index, UniqueConstraint
+from django.db.models.functions import Lower
+
+from .conf import get_setting
+from .models import email_domain
+
+
+class EmailIndexOperation(Operation):
+    """
+    Base class for the optional indexes of EmailUser models.
+
+    The index is only created when enabled() returns True, and it doesn't
+    change the migration state, so toggling the related setting never
+    produces new migrations.
+    """
+
+    reversible = True
+    suffix = None
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def deconstruct(self):
+        return self.__class__.__name__, [], {"model_name": self.model_name}
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self._applies(schema_editor, model):
+            self.create_index(schema_editor, model)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        # Drops the index whenever it exists, the setting may have changed
+        # since the forwards migration ran.
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(
+            schema_editor.connection.alias, model
+        ) and self._index_exists(schema_editor, model):
+            schema_editor.execute(
+                schema_editor._delete_index_sql(model, self.index_name(model))
+            )
+
+    def enabled(self):
+        raise NotImplementedError  # pragma: no cover
+
+    def create_index(self, schema_editor, model):
+        raise NotImplementedError  # pragma: no cover
+
+    def index_name(self, model):
+        return "%s_%s" % (model._meta.db_table, self.suffix)
+
+    def index_exists(self, connection, model):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, model._meta.db_table
+            )
+        return self.index_name(model) in constraints
+
+    def _index_exists(self, schema_editor, model):
+        return self.index_exists(schema_editor.connection, model)
+
+    def _applies(self, schema_editor, model):
+        return self.enabled() and self.allow_migrate_model(
+            schema_editor.connection.alias, model
+        )
+
+
+class AddCaseInsensitiveEmailIndex(EmailIndexOperation):
+    """
+    Create a unique index on LOWER(email) for an EmailUser model.
+
+    Only applied when CUSTOM_USER_EMAIL_CASE_INSENSITIVE is enabled. Use it
+    in the migrations of your AbstractEmailUser subclass to get the same
+    behaviour as EmailUser.
+    """
+
+    suffix = "email_ci_uniq"
+
+    def describe(self):
+        return "Create case-insensitive email index on %s" % self.model_name
+
+    def enabled(self):
+        return get_setting("EMAIL_CASE_INSENSITIVE")
+
+    def create_index(self, schema_editor, model):
+        if django.VERSION[:2] < (4, 0):  # pragma: no cover
+            # Django 3.2 doesn't support expressions in UniqueConstraint.
+            quote = schema_editor.quote_name
+            schema_editor.execute(
+                "CREATE UNIQUE INDEX %s ON %s ((LOWER(%s)))"
+                % (
+                    quote(self.index_name(model)),
+                    quote(model._meta.db_table),
+                    quote("email"),
+                )
+            )
+        else:
+            schema_editor.add_constraint(
+                model, UniqueConstraint(Lower("email"), name=self.index_name(model))
+            )
+
+
+class AddEmailDomainIndex(EmailIndexOperation):
+    """
+    Create an index on the domain part of the email for an EmailUser model.
+
+    Only applied when CUSTOM_USER_ADMIN_SEARCH is "prefix", where it backs
+    the "@example.com" searches of EmailUserAdmin.
+    """
+
+    suffix = "email_domain_idx"
+
+    def describe(self):
+        return "Create email domain index on %s" % self.model_name
+
+    def enabled(self):
+        return get_setting("ADMIN_SEARCH") == "prefix"
+
+    def create_index(self, schema_editor, model):
+        schema_editor.add_index(
+            model, Index(email_domain(), name=self.index_name(model))
+        )
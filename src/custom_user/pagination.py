@@ -0,0 +1,67 @@
+"""Pagination helpers for large EmailUser tables."""
+import json
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .conf import get_setting
+
+
+def _estimate_postgresql(cursor, sql, params):
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def _estimate_mysql(cursor, sql, params):
+    cursor.execute("EXPLAIN " + sql, params)
+    columns = [column[0] for column in cursor.description]
+    row = dict(zip(columns, cursor.fetchone()))
+    return int(row["rows"] * float(row.get("filtered") or 100) / 100)
+
+
+ESTIMATORS = {
+    "postgresql": _estimate_postgresql,
+    "mysql": _estimate_mysql,
+}
+
+
+def estimate_count(queryset):
+    """
+    Return the query planner's estimate of the rows in queryset.
+
+    :param QuerySet queryset: queryset to estimate
+    :return int: estimated number of rows, or None if the database doesn't
+        provide estimates
+    """
+    connection = connections[queryset.db]
+    estimator = ESTIMATORS.get(connection.vendor)
+    if estimator is None:
+        return None
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    with connection.cursor() as cursor:
+        return estimator(cursor, sql, params)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that uses the planner's estimate for big querysets.
+
+    When CUSTOM_USER_ADMIN_COUNT_ESTIMATE_THRESHOLD is set and the estimate
+    is above it, the estimate is used instead of running COUNT(*).
+    """
+
+    @cached_property
+    def count(self):
+        """Return the estimated or the exact number of objects."""
+        threshold = get_setting("ADMIN_COUNT_ESTIMATE_THRESHOLD")
+        if threshold is not None and hasattr(self.object_list, "query"):
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate > threshold:
+                self.count_is_estimate = True
+                return estimate
+        self.count_is_estimate = False
+        return super().count
@@ -0,0 +1,129 @@
+"""
+Background upgrade of password hashes.
+
+When the preferred hasher or its iterations change, Django rehashes the
+password on the next successful login, which doubles the hashing time of
+that login and writes the user row. With the
+CUSTOM_USER_BACKGROUND_PASSWORD_UPGRADE setting, AbstractEmailUser hands the
+rehash to a background thread instead, see AbstractEmailUser.check_password().
+"""
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import connections
+
+from .backends import _user_cache, invalidate_cached_user
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+UPGRADED_PASSWORD_KEY = "custom_user:upgraded_password:%s"
+
+
+def upgrade_password(model, pk, encoded, raw_password, using):
+    """
+    Rehash the password of a user with the preferred hasher.
+
+    The row is only updated if its hash is still encoded, so a password
+    changed in the meantime is never overwritten. The session hash of the
+    previous hash is cached, for get_session_auth_fallback_hash() to keep
+    the sessions opened with it.
+
+    :param model: user model
+    :param pk: user primary key
+    :param str encoded: hash checked at login
+    :param str raw_password: password that matched encoded
+    :param str using: database alias
+    :return bool: whether the password was upgraded
+    """
+    password = make_password(raw_password)
+    updated = (
+        model._default_manager.db_manager(using)
+        .filter(pk=pk, password=encoded)
+        .update(password=password)
+    )
+    if updated:
+        previous = model(pk=pk, password=encoded).get_session_auth_hash()
+        _user_cache().set(
+            UPGRADED_PASSWORD_KEY % pk,
+            (previous, password),
+            settings.SESSION_COOKIE_AGE,
+        )
+        invalidate_cached_user(pk)
+    return bool(updated)
+
+
+def previous_session_auth_hash(user):
+    """
+    Return the session hash user had before its password was upgraded.
+
+    :param user: user
+    :return str: session hash, None if the password wasn't upgraded or was
+        changed since
+    """
+    upgraded = _user_cache().get(UPGRADED_PASSWORD_KEY % user.pk)
+    if upgraded is not None and upgraded[1] == user.password:
+        return upgraded[0]
+    return None
+
+
+class PasswordUpgrader:
+    """
+    Upgrades password hashes in a background thread.
+
+    Upgrades wait in a queue of CUSTOM_USER_PASSWORD_UPGRADE_QUEUE_SIZE
+    entries. When it's full, or when the process exits before the thread
+    got to it, the upgrade is dropped and happens on a later login, so every
+    active user is eventually upgraded. Raw passwords are only kept in
+    memory until they are rehashed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = None
+
+    def submit(self, user, raw_password):
+        """
+        Queue the upgrade of the password of user.
+
+        :param user: user whose password was just checked
+        :param str raw_password: password that matched
+        :return bool: False if the queue is full and the upgrade dropped
+        """
+        with self.lock:
+            if self.queue is None:
+                self.queue = queue.Queue(get_setting("PASSWORD_UPGRADE_QUEUE_SIZE"))
+                threading.Thread(
+                    target=self.run, name="custom_user password upgrade", daemon=True
+                ).start()
+        try:
+            self.queue.put_nowait(
+                (type(user), user.pk, user.password, raw_password, user._state.db)
+            )
+        except queue.Full:
+            return False
+        return True
+
+    def run(self):
+        while True:
+            args = self.queue.get()
+            try:
+                upgrade_password(*args)
+            except Exception:
+                logger.exception("Password upgrade of user %s failed", args[1])
+            finally:
+                self.queue.task_done()
+            if self.queue.empty():  # pragma: no branch
+                # Don't hold database connections while idle.
+                connections.close_all()
+
+    def join(self):
+        """Wait until every queued upgrade is done."""
+        if self.queue is not None:
+            self.queue.join()
+
+
+password_upgrader = PasswordUpgrader()
@@ -0,0 +1,87 @@
+"""Chunked deletion of EmailUsers."""
+import time
+from collections import namedtuple
+
+from django.db import router, transaction
+from django.db.models import CASCADE
+from django.db.models.deletion import Collector, get_candidate_relations_to_delete
+
+from .backends import invalidate_cached_user, user_cache_used
+
+PurgeResult = namedtuple("PurgeResult", ["deleted", "complete"])
+
+
+def _delete_chunk(users, pks, using):
+    """
+    Delete the users of the users queryset with the given pks and the rows
+    pointing to them.
+
+    The users are locked and filtered with the queryset again first, so
+    users changed since their pks were read, like reactivated ones, are kept.
+    Rows of many-to-many tables, admin log entries and other rows deleted
+    in cascade without further cascades or signals are deleted with one
+    DELETE each, then the users with another one. If a relation needs more
+    work, like SET_NULL or PROTECT, the chunk goes through Django's deletion
+    collector instead, which then only holds this chunk.
+
+    :return int: number of users deleted
+    """
+    model = users.model
+    locked = model._base_manager.using(using).select_for_update().filter(pk__in=pks)
+    pks = list(locked.values_list("pk", flat=True))
+    pks = list(users.using(using).filter(pk__in=pks).values_list("pk", flat=True))
+    if not pks:
+        return 0
+    collector = Collector(using=using)
+    related = []
+    for field in get_candidate_relations_to_delete(model._meta):
+        queryset = field.related_model._base_manager.using(using).filter(
+            **{"%s__in" % field.field.name: pks}
+        )
+        if field.on_delete is not CASCADE or not collector.can_fast_delete(queryset):
+            queryset = model._base_manager.using(using).filter(pk__in=pks)
+            return queryset.delete()[1].get(model._meta.label, 0)
+        related.append(queryset)
+    for queryset in related:
+        queryset._raw_delete(using)
+    deleted = model._base_manager.using(using).filter(pk__in=pks)._raw_delete(using)
+    # No post_delete was sent.
+    for pk in pks if user_cache_used() else ():
+        invalidate_cached_user(pk)
+        transaction.on_commit(lambda pk=pk: invalidate_cached_user(pk), using=using)
+    return deleted
+
+
+def purge_users(queryset, chunk_size=1000, time_budget=None):
+    """
+    Delete the users of queryset in chunks, within a time budget.
+
+    Walks the queryset in ascending pk ranges of at most chunk_size users,
+    each deleted in its own transaction, so memory use and lock time don't
+    depend on the number of users. Unlike queryset.delete(), users deleted
+    without the deletion collector don't send pre_delete and post_delete.
+
+    :param QuerySet queryset: users to delete
+    :param int chunk_size: number of users deleted per transaction
+    :param float time_budget: seconds after which no new chunk is started,
+        None to delete every user
+    :return PurgeResult: number of users deleted, and whether all of them
+        were deleted
+    """
+    model = queryset.model
+    # The pks may be read from a replica, the users are deleted where they
+    # are written.
+    using = queryset._db or router.db_for_write(model)
+    queryset = queryset.order_by("pk")
+    started = time.monotonic()
+    deleted = 0
+    last_pk = None
+    while time_budget is None or time.monotonic() - started < time_budget:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(chunk.values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            return PurgeResult(deleted, True)
+        with transaction.atomic(using=using):
+            deleted += _delete_chunk(queryset, pks, using)
+        last_pk = pks[-1]
+    return PurgeResult(deleted, False)
@@ -0,0 +1,128 @@
+"""
+Database router sending user reads to replicas.
+
+Reads of the user model, Group, Permission and their many-to-many tables go
+to CUSTOM_USER_REPLICA_DATABASES, writes to CUSTOM_USER_PRIMARY_DATABASE.
+After a user, or its groups and permissions, is written, reads of that user
+stick to the primary for CUSTOM_USER_REPLICA_STICKY_SECONDS, so changes are
+read back even if the replicas lag behind.
+"""
+import hashlib
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.contrib.auth import SESSION_KEY, get_user_model
+from django.contrib.auth.models import Group, Permission
+
+from .backends import _user_cache
+from .conf import get_setting
+
+STICKY_KEY = "custom_user:sticky:%s"
+
+_use_primary = ContextVar("custom_user_use_primary", default=False)
+
+
+def _sticky_keys(pk=None, email=None):
+    keys = []
+    if pk is not None:
+        keys.append(STICKY_KEY % ("pk:%s" % pk))
+    if email:
+        digest = hashlib.sha256(email.lower().encode()).hexdigest()
+        keys.append(STICKY_KEY % ("email:%s" % digest))
+    return keys
+
+
+def stick_to_primary(pk=None, email=None):
+    """
+    Send the reads of a user to the primary database for a while.
+
+    :param pk: user primary key
+    :param str email: user email
+    """
+    _user_cache().set_many(
+        dict.fromkeys(_sticky_keys(pk, email), True),
+        get_setting("REPLICA_STICKY_SECONDS"),
+    )
+
+
+def is_sticky(pk=None, email=None):
+    """
+    Return whether the reads of a user should go to the primary database.
+
+    :param pk: user primary key
+    :param str email: user email
+    :return bool: whether the user was written recently
+    """
+    keys = _sticky_keys(pk, email)
+    return bool(keys and _user_cache().get_many(keys))
+
+
+@contextmanager
+def use_primary():
+    """Send all the reads routed by EmailUserRouter to the primary database."""
+    token = _use_primary.set(True)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+class EmailUserRouter:
+    """
+    Router sending the reads of users, groups and permissions to replicas.
+
+    Reads stick to the primary for users written recently, when the query
+    hints identify them: related managers of a user pass it as "instance",
+    get_by_natural_key() passes "user_email". ReadYourWritesMiddleware does
+    the same for the user of the session.
+    """
+
+    def _routed(self, model):
+        # Many-to-many tables are routed along with the model declaring them.
+        model = model._meta.auto_created or model
+        return model is get_user_model() or model is Group or model is Permission
+
+    def db_for_read(self, model, **hints):
+        replicas = get_setting("REPLICA_DATABASES")
+        if not replicas or not self._routed(model):
+            return None
+        if _use_primary.get():
+            return get_setting("PRIMARY_DATABASE")
+        instance = hints.get("instance")
+        if isinstance(instance, get_user_model()):
+            pk, email = instance.pk, instance.get_username()
+        else:
+            pk, email = hints.get("user_pk"), hints.get("user_email")
+        if is_sticky(pk, email):
+            return get_setting("PRIMARY_DATABASE")
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if self._routed(model):
+            return get_setting("PRIMARY_DATABASE")
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if self._routed(type(obj1)) and self._routed(type(obj2)):
+            return True
+        return None
+
+
+class ReadYourWritesMiddleware:
+    """
+    Send the reads of a request to the primary database when its session
+    user was written recently.
+
+    Place it before AuthenticationMiddleware, so the user itself is loaded
+    from the primary.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if is_sticky(request.session.get(SESSION_KEY)):
+            with use_primary():
+                return self.get_response(request)
+        return self.get_response(request)
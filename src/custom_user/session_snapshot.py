@@ -0,0 +1,118 @@
+"""Request users served from a signed snapshot stored in the session."""
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.core import signing
+from django.utils.functional import SimpleLazyObject, empty
+
+from .backends import SessionSnapshotBackend, security_stamp
+from .conf import get_setting
+
+SNAPSHOT_SESSION_KEY = "_custom_user_snapshot"
+SNAPSHOT_SALT = "custom_user.session_snapshot"
+
+
+class SnapshotUser(SimpleLazyObject):
+    """
+    Lazy user read from a session snapshot.
+
+    The fields of the snapshot, pk, is_authenticated, is_anonymous and
+    get_username() are answered without a query, as well as has_perm() and
+    has_module_perms() for active superusers. Any other attribute, and
+    isinstance() or comparisons, load the user like request.user does.
+    """
+
+    def __init__(self, snapshot, func):
+        fields = dict(snapshot)
+        del fields["stamp"]
+        fields["pk"] = get_user_model()._meta.pk.to_python(fields["pk"])
+        fields["is_authenticated"] = True
+        fields["is_anonymous"] = False
+        self.__dict__["_snapshot"] = fields
+        super().__init__(func)
+
+    def __getattr__(self, name):
+        if self._wrapped is empty and name in self._snapshot:
+            return self._snapshot[name]
+        return super().__getattr__(name)
+
+    def __str__(self):
+        return self.get_username()
+
+    def get_username(self):
+        return getattr(self, get_user_model().USERNAME_FIELD)
+
+    def has_perm(self, perm, obj=None):
+        if self.is_active and self.is_superuser:
+            return True
+        return super().__getattr__("has_perm")(perm, obj)
+
+    def has_module_perms(self, app_label):
+        if self.is_active and self.is_superuser:
+            return True
+        return super().__getattr__("has_module_perms")(app_label)
+
+
+def _snapshot_backend(request):
+    path = request.session.get(BACKEND_SESSION_KEY)
+    if path not in settings.AUTHENTICATION_BACKENDS:
+        return None
+    backend = auth.load_backend(path)
+    return backend if isinstance(backend, SessionSnapshotBackend) else None
+
+
+def _load_user(request, backend, stamp):
+    user = auth.get_user(request)
+    if user.is_authenticated:
+        request.session[SNAPSHOT_SESSION_KEY] = signing.dumps(
+            backend.make_snapshot(user, stamp), salt=SNAPSHOT_SALT
+        )
+    return user
+
+
+def get_user(request):
+    """
+    Return the user of the request, from its session snapshot if the user's
+    security stamp didn't change since it was stored, and it is not older
+    than CUSTOM_USER_USER_CACHE_TIMEOUT seconds.
+
+    Otherwise the user is loaded from the database and, if it was logged in
+    with SessionSnapshotBackend, a new snapshot is stored in the session.
+    """
+    backend = _snapshot_backend(request)
+    if backend is None:
+        return auth.get_user(request)
+    # Read before loading the user, so a change committed in between leaves
+    # a snapshot that is already stale.
+    stamp = security_stamp(request.session[SESSION_KEY])
+    try:
+        # The age bounds how long a stamp missed by a cache not shared with
+        # the process that changed the user keeps being trusted.
+        snapshot = signing.loads(
+            request.session.get(SNAPSHOT_SESSION_KEY, ""),
+            salt=SNAPSHOT_SALT,
+            max_age=get_setting("USER_CACHE_TIMEOUT"),
+        )
+    except signing.BadSignature:
+        snapshot = None
+    if (
+        snapshot is not None
+        and snapshot["pk"] == request.session[SESSION_KEY]
+        and snapshot["stamp"] == stamp
+    ):
+        return SnapshotUser(snapshot, lambda: auth.get_user(request))
+    return _load_user(request, backend, stamp)
+
+
+class SessionSnapshotMiddleware(AuthenticationMiddleware):
+    """
+    AuthenticationMiddleware that serves the users logged in with
+    SessionSnapshotBackend from a snapshot stored in their session.
+
+    Use it instead of AuthenticationMiddleware.
+    """
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_user(request))
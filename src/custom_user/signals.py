@@ -0,0 +1,152 @@
+"""Signal receivers for EmailUser models."""
+import functools
+
+from django.apps import apps
+from django.contrib.auth.models import Group, Permission
+from django.db import transaction
+from django.db.models import Q
+
+from .backends import (
+    invalidate_cached_permissions,
+    invalidate_cached_user,
+    user_cache_used,
+)
+from .conf import get_setting
+from .routers import stick_to_primary
+
+
+def invalidate_user(sender, instance, using, **kwargs):
+    """
+    Invalidate the cached user now and again once the change is committed,
+    when a backend caches users.
+    """
+    if not user_cache_used():
+        return
+    pk = instance.pk
+    invalidate_cached_user(pk)
+    transaction.on_commit(lambda: invalidate_cached_user(pk), using=using)
+
+
+def invalidate_permissions(sender, using, **kwargs):
+    """
+    Invalidate all cached permissions when groups or permissions change, if
+    a backend or the permission autocomplete caches them.
+    """
+    if not user_cache_used() and not get_setting("ADMIN_AUTOCOMPLETE"):
+        return
+    if kwargs.get("action", "post_").startswith("post_"):
+        invalidate_cached_permissions()
+        transaction.on_commit(invalidate_cached_permissions, using=using)
+
+
+def stick_user(sender, instance, using, **kwargs):
+    """
+    Send the reads of users just written to the primary database, now and
+    again once the change is committed, when replicas are configured.
+    """
+    action = kwargs.get("action", "post_")
+    if not get_setting("REPLICA_DATABASES") or not action.startswith("post_"):
+        return
+    if isinstance(instance, (Group, Permission)):
+        # Reverse change, like group.user_set.add(user).
+        users = [{"pk": pk} for pk in kwargs["pk_set"] or ()]
+    else:
+        users = [{"pk": instance.pk, "email": instance.get_username()}]
+    for user in users:
+        stick_to_primary(**user)
+        transaction.on_commit(functools.partial(stick_to_primary, **user), using=using)
+
+
+def _snapshot_models():
+    from .models import PermissionSnapshotMixin
+
+    return [
+        model
+        for model in apps.get_models()
+        if issubclass(model, PermissionSnapshotMixin)
+    ]
+
+
+def _rebuild(model, pks, using):
+    users = model._default_manager.using(using).filter(pk__in=pks)
+    users.rebuild_permission_snapshots()
+
+
+def _stash(instance, using):
+    # Remembers the users of a group or a permission before it is cleared or
+    # deleted, when the rows needed to find them are still there.
+    if isinstance(instance, Group):
+        users = Q(groups=instance)
+    else:
+        users = Q(user_permissions=instance) | Q(groups__permissions=instance)
+    instance._snapshot_users = {
+        model: set(
+            model._default_manager.using(using)
+            .filter(users)
+            .values_list("pk", flat=True)
+        )
+        for model in _snapshot_models()
+    }
+
+
+def _rebuild_stash(instance, using):
+    for model, pks in instance.__dict__.pop("_snapshot_users", {}).items():
+        _rebuild(model, pks, using)
+
+
+def rebuild_user_snapshot(
+    sender, instance, action, reverse, model, pk_set, using, **kwargs
+):
+    """
+    Rebuild the permission snapshot of users whose groups or direct
+    permissions changed.
+    """
+    if reverse and action == "pre_clear":
+        _stash(instance, using)
+    elif not action.startswith("post_"):
+        return
+    elif not reverse:
+        _rebuild(type(instance), [instance.pk], using)
+        instance.refresh_from_db(using=using, fields=["permission_snapshot"])
+    elif action == "post_clear":
+        _rebuild_stash(instance, using)
+    else:
+        # Reverse change, like group.user_set.add(user).
+        _rebuild(model, pk_set, using)
+
+
+def rebuild_group_snapshots(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """
+    Rebuild the permission snapshot of the members of groups whose
+    permissions changed.
+    """
+    if reverse and action == "pre_clear":
+        _stash(instance, using)
+    elif not action.startswith("post_"):
+        return
+    elif reverse and action == "post_clear":
+        _rebuild_stash(instance, using)
+    else:
+        # Either group.permissions.add(...) or permission.group_set.add(...).
+        groups = pk_set if reverse else [instance.pk]
+        for user_model in _snapshot_models():
+            members = user_model._default_manager.using(using).filter(groups__in=groups)
+            _rebuild(user_model, members.values("pk"), using)
+
+
+def stash_snapshot_users(sender, instance, using, **kwargs):
+    """Remember the users of a group or a permission about to be deleted."""
+    _stash(instance, using)
+
+
+def rebuild_stashed_snapshots(sender, instance, using, **kwargs):
+    """
+    Rebuild the permission snapshot of the users of a group or a permission
+    that was deleted, or of a permission that was saved again, in case its
+    codename or content type changed.
+    """
+    if kwargs.get("created"):
+        return
+    if "created" in kwargs:
+        _stash(instance, using)
+    _rebuild_stash(instance, using)
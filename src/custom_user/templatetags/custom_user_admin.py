@@ -0,0 +1,11 @@
+"""Template tags for the EmailUserAdmin templates."""
+from django import template
+from django.contrib.admin.templatetags.admin_list import pagination
+
+register = template.Library()
+
+
+@register.inclusion_tag("admin/custom_user/pagination.html")
+def estimated_pagination(cl):
+    """Like the admin's pagination tag, marking estimated counts with "~"."""
+    return pagination(cl)
@@ -1,23 +1,82 @@
 """EmailUser tests."""
+import asyncio
+import csv
+import functools
+import json
+import multiprocessing
 import os
 import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from io import StringIO
-from unittest import mock
+from smtplib import SMTPException
+from unittest import mock, skipIf, skipUnless
 
 import django
+from django.apps import apps
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from django.contrib import admin
+from django.contrib.admin.models import ADDITION, LogEntry
+from django.contrib.auth import (
+    HASH_SESSION_KEY,
+    SESSION_KEY,
+    authenticate,
+    get_user,
+    get_user_model,
+)
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, make_password
 from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import Group, Permission
+from django.contrib.auth.signals import user_logged_in
+from django.contrib.contenttypes.models import ContentType
 from django.core import mail, management
+from django.core.cache import cache, caches
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, connections, router
+from django.db.models import QuerySet
+from django.db.models.deletion import Collector
+from django.db.models.signals import post_save
 from django.forms.fields import Field
 from django.http import HttpRequest, HttpResponse
-from django.test import TestCase
-from django.test.utils import override_settings
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.translation import gettext as _
+from django.views.generic import CreateView
 
+from .admin import PermissionAutocompleteAdmin, register_permission_admin
+from .backends import CachedModelBackend, _version_timeout, invalidate_cached_user
+from .checks import check_email_indexes
+from .export import export_users
 from .forms import EmailUserChangeForm, EmailUserCreationForm
+from .instrumentation import InMemoryCollector, collector, get_subscribers
+from .last_login import flush_last_logins, last_login_buffer
+from .models import (
+    BULK_CREATED,
+    BULK_DUPLICATE,
+    BULK_INVALID,
+    BULK_UNCHANGED,
+    BULK_UPDATED,
+    UPSERT_ATTEMPTS,
+    BulkCreateResult,
+    PermissionSnapshotMixin,
+)
+from .operations import (
+    AddCaseInsensitiveEmailIndex,
+    AddEmailDomainIndex,
+    EmailIndexOperation,
+)
+from .pagination import ESTIMATORS, EstimatedCountPaginator, estimate_count
+from .password_upgrade import PasswordUpgrader, password_upgrader, upgrade_password
+from .purge import PurgeResult, purge_users
+from .routers import ReadYourWritesMiddleware, is_sticky
+from .session_snapshot import SNAPSHOT_SESSION_KEY, SessionSnapshotMiddleware
+from .views import DuplicateEmailFormMixin
 
 
 class UserTest(TestCase):
@@ -109,6 +168,225 @@ class UserTest(TestCase):
         self.assertEqual(message.to, [user.email])
 
 
+class EmailUserQuerySetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        manager = get_user_model().objects
+        cls.group = Group.objects.create(name="editors")
+        cls.group.permissions.add(Permission.objects.get(codename="change_group"))
+        for i in range(3):
+            user = manager.create_user("user%d@example.com" % i, "password")
+            user.groups.add(cls.group)
+            user.user_permissions.add(Permission.objects.get(codename="add_group"))
+        manager.create_user("staff@example.com", is_staff=True)
+        manager.create_user("inactive@example.com", is_active=False)
+        manager.create_superuser("admin@example.com")
+
+    def test_active_staff(self):
+        manager = get_user_model().objects
+        self.assertEqual(manager.active().count(), 5)
+        self.assertEqual(
+            sorted(manager.staff().values_list("email", flat=True)),
+            ["admin@example.com", "staff@example.com"],
+        )
+        self.assertEqual(manager.active().staff().count(), 2)
+
+    def test_lean(self):
+        users = list(get_user_model().objects.lean("last_login").order_by("pk"))
+        self.assertEqual(users[0].get_deferred_fields(), {"password", "last_login"})
+        self.assertEqual(users[0].email, "user0@example.com")
+
+    def test_with_permissions(self):
+        with self.assertNumQueries(4):
+            users = list(get_user_model().objects.with_permissions().order_by("pk")[:3])
+        with self.assertNumQueries(0):
+            for user in users:
+                self.assertTrue(user.has_perm("auth.add_group"))
+                self.assertTrue(user.has_perm("auth.change_group"))
+                self.assertFalse(user.has_perm("auth.delete_group"))
+                self.assertEqual(
+                    user.get_all_permissions(), {"auth.add_group", "auth.change_group"}
+                )
+
+    def test_with_permissions_chained(self):
+        queryset = get_user_model().objects.with_permissions().filter(is_active=True)
+        users = list(queryset)
+        self.assertEqual(len(users), 5)
+        with self.assertNumQueries(0):
+            list(queryset)
+            for user in users:
+                user.has_perm("auth.add_group")
+
+    def test_with_permissions_values(self):
+        emails = (
+            get_user_model().objects.with_permissions().values_list("email", flat=True)
+        )
+        self.assertEqual(len(emails), 6)
+
+
+class BatchedPermissionsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        manager = get_user_model().objects
+        group = Group.objects.create(name="editors")
+        group.permissions.add(Permission.objects.get(codename="change_group"))
+        cls.direct = manager.create_user("direct@example.com")
+        cls.direct.user_permissions.add(Permission.objects.get(codename="add_group"))
+        cls.member = manager.create_user("member@example.com")
+        cls.member.groups.add(group)
+        cls.inactive = manager.create_user("inactive@example.com", is_active=False)
+        cls.inactive.groups.add(group)
+        cls.admin = manager.create_superuser("admin@example.com")
+        cls.nobody = manager.create_user("nobody@example.com")
+        cls.users = [cls.direct, cls.member, cls.inactive, cls.admin, cls.nobody]
+
+    def emails(self, queryset):
+        return sorted(user.email for user in queryset)
+
+    def test_users_with_perm(self):
+        manager = get_user_model().objects
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.emails(manager.users_with_perm("auth.change_group")),
+                ["admin@example.com", "member@example.com"],
+            )
+        self.assertEqual(
+            self.emails(manager.users_with_perm("auth.add_group")),
+            ["admin@example.com", "direct@example.com"],
+        )
+        self.assertEqual(
+            self.emails(
+                manager.users_with_perm(
+                    "auth.change_group", is_active=None, include_superusers=False
+                )
+            ),
+            ["inactive@example.com", "member@example.com"],
+        )
+        permission = Permission.objects.get(codename="add_group")
+        self.assertEqual(
+            self.emails(manager.users_with_perm(permission, include_superusers=False)),
+            ["direct@example.com"],
+        )
+
+    def test_users_with_perm_matches_has_perm(self):
+        for perm in ("auth.add_group", "auth.change_group", "auth.delete_group"):
+            with self.subTest(perm=perm):
+                self.assertEqual(
+                    self.emails(get_user_model().objects.users_with_perm(perm)),
+                    self.emails(
+                        user
+                        for user in get_user_model().objects.all()
+                        if user.has_perm(perm)
+                    ),
+                )
+
+    def test_users_with_perm_invalid(self):
+        with self.assertRaisesMessage(ValueError, "app_label.permission_codename"):
+            get_user_model().objects.users_with_perm("change_group")
+
+    def test_perms_for_users(self):
+        pks = [user.pk for user in self.users] + [0]
+        with self.assertNumQueries(4):
+            perms = get_user_model().objects.perms_for_users(pks)
+        self.assertEqual(set(perms), {user.pk for user in self.users})
+        for user in get_user_model().objects.all():
+            with self.subTest(email=user.email):
+                self.assertEqual(perms[user.pk], user.get_all_permissions())
+
+    def test_perms_for_users_constant_queries(self):
+        manager = get_user_model().objects
+        with self.assertNumQueries(3):
+            manager.perms_for_users([self.direct.pk])
+        with self.assertNumQueries(3):
+            manager.perms_for_users([self.direct.pk, self.member.pk, self.nobody.pk])
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                manager.perms_for_users([self.inactive.pk]), {self.inactive.pk: set()}
+            )
+
+
+class EmailUsersTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(5):
+            get_user_model().objects.create_user(
+                "user%d@example.com" % i, is_active=bool(i % 2)
+            )
+
+    def test_email_users(self):
+        result = (
+            get_user_model()
+            .objects.all()
+            .email_users("Hello", "Message", "from@example.com")
+        )
+        self.assertEqual(result, (5, 0))
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(mail.outbox[0].from_email, "from@example.com")
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            ["user%d@example.com" % i for i in range(5)],
+        )
+
+    def test_email_users_filtered_and_personalized(self):
+        result = (
+            get_user_model()
+            .objects.filter(is_active=True)
+            .email_users(
+                lambda user: "Hello %s" % user.email,
+                "Message",
+                html_message=lambda user: "<p>%s</p>" % user.email,
+            )
+        )
+        self.assertEqual(result.sent, 2)
+        for message in mail.outbox:
+            self.assertEqual(message.subject, "Hello %s" % message.to[0])
+            self.assertEqual(message.alternatives[0][0], "<p>%s</p>" % message.to[0])
+
+    def test_email_users_one_connection_per_chunk(self):
+        with mock.patch(
+            "custom_user.models.get_connection", wraps=mail.get_connection
+        ) as get_connection:
+            get_user_model().objects.email_users("Hello", "Message", chunk_size=2)
+        self.assertEqual(get_connection.call_count, 3)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_email_users_failures(self):
+        backend = mail.get_connection()
+        sent = []
+
+        def send_messages(messages):
+            if messages[0].to[0] == "user1@example.com":
+                raise SMTPException("rejected")
+            sent.extend(messages)
+            return len(messages)
+
+        with mock.patch.object(backend, "send_messages", send_messages):
+            result = get_user_model().objects.email_users(
+                "Hello", "Message", connection=backend
+            )
+        self.assertEqual(result, (4, 1))
+        self.assertEqual(len(sent), 4)
+
+    def test_email_users_connection_failure(self):
+        backend = mail.get_connection()
+        open_connection = backend.open
+        calls = []
+
+        def flaky_open():
+            calls.append(None)
+            if len(calls) == 1:
+                raise OSError("connection refused")
+            return open_connection()
+
+        with mock.patch.object(backend, "open", flaky_open):
+            result = get_user_model().objects.email_users(
+                "Hello", "Message", chunk_size=2, connection=backend
+            )
+        self.assertEqual(result, (3, 2))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(mail.outbox), 3)
+
+
 class UserManagerTest(TestCase):
     def test_create_user(self):
         email_lowercase = "normal@normal.com"
@@ -197,6 +475,587 @@ class UserManagerTest(TestCase):
         )
 
 
+class UserManagerBulkCreateTest(TestCase):
+    def test_bulk_create_users(self):
+        records = (
+            {"email": "user%d@DOMAIN.COM" % i, "password": "pass%d" % i}
+            for i in range(3)
+        )
+        results = get_user_model().objects.bulk_create_users(records, batch_size=2)
+        self.assertEqual(
+            [(result.email, result.status) for result in results],
+            [("user%d@domain.com" % i, BULK_CREATED) for i in range(3)],
+        )
+        user = get_user_model().objects.get(email="user1@domain.com")
+        self.assertTrue(user.check_password("pass1"))
+        self.assertTrue(user.is_active)
+        self.assertFalse(user.is_staff)
+        self.assertFalse(user.is_superuser)
+        self.assertIsNotNone(user.last_login)
+
+    def test_bulk_create_users_extra_fields(self):
+        get_user_model().objects.bulk_create_users(
+            [{"email": "staff@domain.com", "is_staff": True, "is_active": False}]
+        )
+        user = get_user_model().objects.get(email="staff@domain.com")
+        self.assertTrue(user.is_staff)
+        self.assertFalse(user.is_active)
+        self.assertFalse(user.has_usable_password())
+
+    def test_bulk_create_users_duplicates(self):
+        get_user_model().objects.create_user("existing@domain.com")
+        results = get_user_model().objects.bulk_create_users(
+            [
+                {"email": "existing@DOMAIN.com"},
+                {"email": "new@domain.com"},
+                {"email": "new@DOMAIN.com"},
+            ]
+        )
+        self.assertEqual(
+            [result.status for result in results],
+            [BULK_DUPLICATE, BULK_CREATED, BULK_DUPLICATE],
+        )
+        self.assertEqual(get_user_model().objects.count(), 2)
+
+    def test_bulk_create_users_invalid(self):
+        results = get_user_model().objects.bulk_create_users(
+            [
+                {"password": "nomail"},
+                {"email": "not valid"},
+                {"email": "unknown@domain.com", "unknown_field": 1},
+                {"email": "valid@domain.com"},
+            ]
+        )
+        self.assertEqual(
+            [result.status for result in results],
+            [BULK_INVALID, BULK_INVALID, BULK_INVALID, BULK_CREATED],
+        )
+        self.assertIsInstance(results[0].error, ValueError)
+        self.assertIsInstance(results[2].error, TypeError)
+        self.assertEqual(get_user_model().objects.count(), 1)
+
+    def test_bulk_create_users_workers(self):
+        results = get_user_model().objects.bulk_create_users(
+            [{"email": "user%d@domain.com" % i, "password": "pw"} for i in range(3)],
+            workers=2,
+        )
+        self.assertEqual([result.status for result in results], [BULK_CREATED] * 3)
+        for user in get_user_model().objects.all():
+            self.assertTrue(user.check_password("pw"))
+
+    def test_bulk_create_users_spawned_workers(self):
+        spawn = functools.partial(
+            ProcessPoolExecutor, mp_context=multiprocessing.get_context("spawn")
+        )
+        with mock.patch("custom_user.models.ProcessPoolExecutor", spawn):
+            results = get_user_model().objects.bulk_create_users(
+                [
+                    {"email": "user%d@domain.com" % i, "password": "pw"}
+                    for i in range(2)
+                ],
+                workers=2,
+            )
+        self.assertEqual([result.status for result in results], [BULK_CREATED] * 2)
+        self.assertTrue(get_user_model().objects.first().check_password("pw"))
+
+    def test_iter_bulk_create_users(self):
+        records = ({"email": "user%d@domain.com" % i} for i in range(3))
+        results = get_user_model().objects.iter_bulk_create_users(records, batch_size=2)
+        self.assertEqual(get_user_model().objects.count(), 0)
+        self.assertEqual(next(results).status, BULK_CREATED)
+        self.assertEqual(get_user_model().objects.count(), 2)
+        self.assertEqual(len(list(results)), 2)
+        self.assertEqual(get_user_model().objects.count(), 3)
+
+    def test_bulk_create_users_groups(self):
+        group = Group.objects.create(name="editors")
+        results = get_user_model().objects.bulk_create_users(
+            [
+                {"email": "member@domain.com", "groups": ["editors"]},
+                {"email": "unknown@domain.com", "groups": ["editors", "missing"]},
+            ]
+        )
+        self.assertEqual(
+            [result.status for result in results], [BULK_CREATED, BULK_INVALID]
+        )
+        user = get_user_model().objects.get(email="member@domain.com")
+        self.assertEqual(list(user.groups.all()), [group])
+
+    def test_bulk_create_users_groups_without_returned_pks(self):
+        # Some databases don't set the pks of the objects in bulk_create().
+        group = Group.objects.create(name="editors")
+        manager = get_user_model().objects
+        user = manager.create_user("member@domain.com")
+        manager._bulk_add_groups([(get_user_model()(email=user.email), [group.pk])])
+        self.assertEqual(list(user.groups.all()), [group])
+
+    def test_bulk_create_users_concurrent_duplicate(self):
+        # Simulate a row inserted after the existence check ran.
+        get_user_model().objects.create_user("raced@domain.com")
+        manager = get_user_model().objects
+        with mock.patch.object(manager, "filter", return_value=manager.none()):
+            results = manager.bulk_create_users(
+                [{"email": "raced@domain.com"}, {"email": "other@domain.com"}]
+            )
+        self.assertEqual(
+            [result.status for result in results], [BULK_DUPLICATE, BULK_CREATED]
+        )
+        self.assertTrue(manager.filter(email="other@domain.com").exists())
+
+
+class UserManagerUpsertTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.editors = Group.objects.create(name="editors")
+        cls.admins = Group.objects.create(name="admins")
+        cls.alice = get_user_model().objects.create_user("alice@example.com")
+        cls.alice.groups.add(cls.editors)
+        cls.carol = get_user_model().objects.create_user("carol@example.com")
+
+    def statuses(self, results):
+        return [(result.email, result.status) for result in results]
+
+    def groups(self, email):
+        user = get_user_model().objects.get(email=email)
+        return sorted(user.groups.values_list("name", flat=True))
+
+    def test_upsert_users(self):
+        results = get_user_model().objects.upsert_users(
+            [
+                {"email": "alice@example.com", "is_staff": True, "groups": ["admins"]},
+                {"email": "bob@EXAMPLE.com", "password": "pw", "groups": ["editors"]},
+                {"email": "carol@example.com", "is_active": True},
+                {"email": "alice@example.com"},
+                {"email": "invalid"},
+                {"email": "dave@example.com", "groups": ["unknown"]},
+                {"email": "erin@example.com", "unknown_field": 1},
+            ],
+            batch_size=4,
+        )
+        self.assertEqual(
+            self.statuses(results),
+            [
+                ("alice@example.com", BULK_UPDATED),
+                ("bob@example.com", BULK_CREATED),
+                ("carol@example.com", BULK_UNCHANGED),
+                ("alice@example.com", BULK_DUPLICATE),
+                ("invalid", BULK_INVALID),
+                ("dave@example.com", BULK_INVALID),
+                ("erin@example.com", BULK_INVALID),
+            ],
+        )
+        self.assertIn("unknown", str(results[5].error))
+        self.assertTrue(
+            get_user_model().objects.get(email="alice@example.com").is_staff
+        )
+        self.assertEqual(self.groups("alice@example.com"), ["admins"])
+        self.assertEqual(self.groups("bob@example.com"), ["editors"])
+        bob = get_user_model().objects.get(email="bob@example.com")
+        self.assertTrue(bob.check_password("pw"))
+        self.assertTrue(bob.is_active)
+        self.assertFalse(
+            get_user_model().objects.filter(email="dave@example.com").exists()
+        )
+
+    def test_groups_only(self):
+        results = get_user_model().objects.upsert_users(
+            [{"email": "carol@example.com", "groups": ["editors", "admins"]}]
+        )
+        self.assertEqual(results[0].status, BULK_UPDATED)
+        self.assertEqual(self.groups("carol@example.com"), ["admins", "editors"])
+
+    def test_idempotent(self):
+        def records(count):
+            return [
+                {"email": "user%d@example.com" % i, "groups": ["editors"]}
+                for i in range(count)
+            ]
+
+        get_user_model().objects.upsert_users(records(30))
+        for count in (3, 30):
+            with self.assertNumQueries(5):
+                results = get_user_model().objects.upsert_users(records(count))
+            self.assertEqual({result.status for result in results}, {BULK_UNCHANGED})
+
+    @override_settings(CUSTOM_USER_EMAIL_CASE_INSENSITIVE=True)
+    def test_case_insensitive(self):
+        results = get_user_model().objects.upsert_users(
+            [{"email": "ALICE@example.com", "is_staff": True}]
+        )
+        self.assertEqual(self.statuses(results), [("ALICE@example.com", BULK_UPDATED)])
+        self.assertEqual(get_user_model().objects.get(is_staff=True), self.alice)
+
+    @override_settings(CUSTOM_USER_EMAIL_CASE_INSENSITIVE=False)
+    def test_case_sensitive(self):
+        results = get_user_model().objects.upsert_users(
+            [{"email": "alice@example.com", "is_staff": True}]
+        )
+        self.assertEqual(self.statuses(results), [("alice@example.com", BULK_UPDATED)])
+
+    def test_conflict_retried(self):
+        manager_class = type(get_user_model().objects)
+        upsert_batch = manager_class._upsert_batch
+        calls = []
+
+        def conflicting(manager, batch):
+            calls.append(batch)
+            if len(calls) == 1:
+                raise IntegrityError
+            return upsert_batch(manager, batch)
+
+        with mock.patch.object(manager_class, "_upsert_batch", conflicting):
+            results = get_user_model().objects.upsert_users(
+                [{"email": "dave@example.com"}]
+            )
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(results[0].status, BULK_CREATED)
+
+    def test_conflict_retries_exhausted(self):
+        manager_class = type(get_user_model().objects)
+        error = IntegrityError("conflict")
+        with mock.patch.object(
+            manager_class, "_upsert_batch", side_effect=error
+        ) as upsert_batch:
+            results = get_user_model().objects.upsert_users(
+                [{"email": "dave@example.com"}, {"email": "invalid"}]
+            )
+        self.assertEqual(upsert_batch.call_count, UPSERT_ATTEMPTS)
+        self.assertEqual(
+            results[0], BulkCreateResult("dave@example.com", BULK_DUPLICATE, error)
+        )
+        self.assertEqual(results[1].status, BULK_INVALID)
+        self.assertFalse(
+            get_user_model().objects.filter(email="dave@example.com").exists()
+        )
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=["custom_user.backends.CachedModelBackend"]
+    )
+    def test_invalidates_cached_user(self):
+        cache.clear()
+        backend = CachedModelBackend()
+        self.assertEqual(backend.get_user(self.alice.pk), self.alice)
+        self.assertFalse(backend.get_user(self.alice.pk).has_perm("auth.add_group"))
+        self.admins.permissions.add(Permission.objects.get(codename="add_group"))
+        get_user_model().objects.upsert_users(
+            [{"email": "alice@example.com", "groups": ["admins"]}]
+        )
+        self.assertTrue(backend.get_user(self.alice.pk).has_perm("auth.add_group"))
+        get_user_model().objects.upsert_users(
+            [{"email": "alice@example.com", "is_active": False}]
+        )
+        self.assertIsNone(backend.get_user(self.alice.pk))
+
+    def test_get_or_provision_existing(self):
+        with self.assertNumQueries(1):
+            user, created = get_user_model().objects.get_or_provision(
+                "alice@example.com", is_staff=True
+            )
+        self.assertEqual((user, created), (self.alice, False))
+        self.assertFalse(user.is_staff)
+
+    def test_get_or_provision_new(self):
+        user, created = get_user_model().objects.get_or_provision(
+            "dave@EXAMPLE.com", password="pw", is_staff=True, groups=["editors"]
+        )
+        self.assertTrue(created)
+        self.assertEqual(user.email, "dave@example.com")
+        self.assertTrue(user.is_staff)
+        self.assertTrue(user.check_password("pw"))
+        self.assertEqual(self.groups("dave@example.com"), ["editors"])
+
+    def test_get_or_provision_unknown_group(self):
+        with self.assertRaisesMessage(ValueError, "Unknown groups: unknown"):
+            get_user_model().objects.get_or_provision(
+                "dave@example.com", groups=["unknown"]
+            )
+
+    def test_get_or_provision_race(self):
+        manager = get_user_model().objects
+        with mock.patch.object(
+            type(manager),
+            "get_by_natural_key",
+            side_effect=get_user_model().DoesNotExist,
+        ):
+            user, created = manager.get_or_provision("alice@example.com")
+        self.assertEqual((user, created), (self.alice, False))
+
+    def test_get_or_provision_integrity_error(self):
+        manager = get_user_model().objects
+        with mock.patch.object(
+            type(manager), "_create_user", side_effect=IntegrityError
+        ):
+            with self.assertRaises(IntegrityError):
+                manager.get_or_provision("dave@example.com")
+
+
+class EmailIndexMixin:
+    """
+    Create the optional email indexes for the test case.
+
+    The test settings keep the defaults, so migrate doesn't create them.
+    SQLite can't change the schema inside the test case transaction, so
+    they are created before it starts and dropped after it ends.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        model = get_user_model()
+        cls.index_operations = [
+            operation(model_name=model._meta.model_name)
+            for operation in (AddCaseInsensitiveEmailIndex, AddEmailDomainIndex)
+        ]
+        with connection.schema_editor() as schema_editor:
+            for operation in cls.index_operations:
+                operation.create_index(schema_editor, model)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        model = get_user_model()
+        with connection.schema_editor() as schema_editor:
+            for operation in cls.index_operations:
+                schema_editor.execute(
+                    schema_editor._delete_index_sql(model, operation.index_name(model))
+                )
+
+
+@override_settings(CUSTOM_USER_EMAIL_CASE_INSENSITIVE=True)
+class CaseInsensitiveEmailTest(EmailIndexMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("Foo@example.com", "pass")
+
+    def test_get_by_natural_key(self):
+        manager = get_user_model().objects
+        self.assertEqual(manager.get_by_natural_key("foo@EXAMPLE.com"), self.user)
+        self.assertEqual(manager.get_by_natural_key("FOO@example.com"), self.user)
+
+    @override_settings(CUSTOM_USER_EMAIL_CASE_INSENSITIVE=False)
+    def test_get_by_natural_key_case_sensitive(self):
+        manager = get_user_model().objects
+        self.assertEqual(manager.get_by_natural_key("Foo@example.com"), self.user)
+        with self.assertRaises(get_user_model().DoesNotExist):
+            manager.get_by_natural_key("foo@example.com")
+
+    def test_login(self):
+        self.assertTrue(self.client.login(username="fOO@example.com", password="pass"))
+
+    def test_unique_index(self):
+        with self.assertRaises(IntegrityError):
+            get_user_model().objects.create_user("FOO@example.com")
+
+    def test_creation_form_duplicate(self):
+        form = EmailUserCreationForm(
+            {"email": "foo@example.com", "password1": "pass", "password2": "pass"}
+        )
+        self.assertFalse(form.is_valid())
+        self.assertEqual(
+            form["email"].errors, [str(form.error_messages["duplicate_email"])]
+        )
+
+    def test_change_form_duplicate(self):
+        other = get_user_model().objects.create_user("bar@example.com")
+        data = {
+            "email": "FOO@example.com",
+            "date_joined": "2020-01-01 00:00",
+            "last_login": "",
+        }
+        form = EmailUserChangeForm(data, instance=other)
+        self.assertFalse(form.is_valid())
+        self.assertEqual(
+            form["email"].errors, [str(form.error_messages["duplicate_email"])]
+        )
+        form = EmailUserChangeForm(
+            dict(data, email="FOO@example.com"), instance=self.user
+        )
+        self.assertTrue(form.is_valid(), form.errors)
+
+    def test_bulk_create_users_duplicate(self):
+        records = [{"email": "user%d@example.com" % i} for i in range(50)]
+        records.append({"email": "FOO@example.com"})
+        # The probe, and the insert in a savepoint.
+        with self.assertNumQueries(4):
+            results = get_user_model().objects.bulk_create_users(records)
+        self.assertEqual(results[-1].status, BULK_DUPLICATE)
+        self.assertEqual({result.status for result in results[:-1]}, {BULK_CREATED})
+
+
+@override_settings(
+    CUSTOM_USER_EMAIL_CASE_INSENSITIVE=True, CUSTOM_USER_ADMIN_SEARCH="prefix"
+)
+class AddCaseInsensitiveEmailIndexTest(EmailIndexMixin, TestCase):
+    def setUp(self):
+        self.operation = AddCaseInsensitiveEmailIndex(model_name="emailuser")
+        self.schema_editor = mock.Mock()
+        self.state = mock.Mock()
+        self.state.apps.get_model.return_value = get_user_model()
+
+    def test_deconstruct(self):
+        self.assertEqual(
+            self.operation.deconstruct(),
+            ("AddCaseInsensitiveEmailIndex", [], {"model_name": "emailuser"}),
+        )
+        self.assertIn("emailuser", self.operation.describe())
+
+    def test_database_forwards(self):
+        self.operation.state_forwards("custom_user", self.state)
+        self.operation.database_forwards(
+            "custom_user", self.schema_editor, self.state, self.state
+        )
+        constraint = self.schema_editor.add_constraint.call_args[0][1]
+        self.assertEqual(
+            constraint.name, "%s_email_ci_uniq" % get_user_model()._meta.db_table
+        )
+
+    def test_database_backwards(self):
+        with mock.patch.object(self.operation, "_index_exists", return_value=True):
+            self.operation.database_backwards(
+                "custom_user", self.schema_editor, self.state, self.state
+            )
+        self.assertEqual(self.schema_editor.execute.call_count, 1)
+
+    def test_database_backwards_missing_index(self):
+        # Migrated with the setting disabled, then enabled before migrating
+        # backwards.
+        with mock.patch.object(self.operation, "_index_exists", return_value=False):
+            self.operation.database_backwards(
+                "custom_user", self.schema_editor, self.state, self.state
+            )
+        self.assertFalse(self.schema_editor.execute.called)
+
+    def test_index_exists(self):
+        schema_editor = mock.Mock(connection=connection)
+        self.assertTrue(self.operation._index_exists(schema_editor, get_user_model()))
+        operation = AddCaseInsensitiveEmailIndex(model_name="emailuser")
+        operation.suffix = "missing"
+        self.assertFalse(operation._index_exists(schema_editor, get_user_model()))
+
+    def test_domain_index(self):
+        operation = AddEmailDomainIndex(model_name="emailuser")
+        self.assertIn("domain", operation.describe())
+        operation.database_forwards(
+            "custom_user", self.schema_editor, self.state, self.state
+        )
+        index = self.schema_editor.add_index.call_args[0][1]
+        self.assertEqual(
+            index.name, "%s_email_domain_idx" % get_user_model()._meta.db_table
+        )
+
+    def test_indexes_created(self):
+        table = get_user_model()._meta.db_table
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, table)
+        self.assertIn("%s_email_ci_uniq" % table, constraints)
+        self.assertIn("%s_email_domain_idx" % table, constraints)
+
+    def test_check_missing_indexes(self):
+        self.assertEqual(check_email_indexes(databases=["default"]), [])
+        with mock.patch.object(EmailIndexOperation, "index_exists", return_value=False):
+            errors = check_email_indexes(databases=["default"])
+            self.assertEqual(
+                [error.id for error in errors], ["custom_user.W001", "custom_user.W002"]
+            )
+            self.assertEqual(check_email_indexes(), [])
+            with override_settings(
+                CUSTOM_USER_EMAIL_CASE_INSENSITIVE=False,
+                CUSTOM_USER_ADMIN_SEARCH="contains",
+            ):
+                self.assertEqual(check_email_indexes(databases=["default"]), [])
+            with mock.patch.object(
+                connection.introspection, "table_names", return_value=[]
+            ):
+                self.assertEqual(check_email_indexes(databases=["default"]), [])
+            app_config = apps.get_app_config("auth")
+            self.assertEqual(
+                check_email_indexes([app_config], databases=["default"]), []
+            )
+            with mock.patch("custom_user.checks.get_user_model", return_value=Group):
+                self.assertEqual(check_email_indexes(databases=["default"]), [])
+
+    @override_settings(CUSTOM_USER_EMAIL_CASE_INSENSITIVE=False)
+    def test_disabled(self):
+        self.operation.database_forwards(
+            "custom_user", self.schema_editor, self.state, self.state
+        )
+        self.assertFalse(self.schema_editor.add_constraint.called)
+
+
+class AsyncUserManagerTest(TestCase):
+    async def test_acreate_user(self):
+        user = await get_user_model().objects.acreate_user(
+            "async@DOMAIN.com", "password", is_active=False
+        )
+        self.assertEqual(user.email, "async@domain.com")
+        self.assertTrue(user.check_password("password"))
+        self.assertFalse(user.is_active)
+        self.assertFalse(user.is_staff)
+        self.assertFalse(user.is_superuser)
+        self.assertIsNotNone(user.pk)
+
+    async def test_acreate_superuser(self):
+        user = await get_user_model().objects.acreate_superuser("admin@domain.com")
+        self.assertTrue(user.is_staff)
+        self.assertTrue(user.is_superuser)
+        self.assertFalse(user.has_usable_password())
+
+    async def test_acreate_superuser_errors(self):
+        manager = get_user_model().objects
+        with self.assertRaisesMessage(ValueError, "Superuser must have is_staff=True."):
+            await manager.acreate_superuser("admin@domain.com", is_staff=False)
+        with self.assertRaisesMessage(
+            ValueError, "Superuser must have is_superuser=True."
+        ):
+            await manager.acreate_superuser("admin@domain.com", is_superuser=False)
+
+    async def test_acreate_user_empty_email(self):
+        with self.assertRaisesMessage(ValueError, "The given email must be set"):
+            await get_user_model().objects.acreate_user("")
+
+    async def test_aget_by_natural_key(self):
+        manager = get_user_model().objects
+        user = await manager.acreate_user("natural@domain.com")
+        self.assertEqual(await manager.aget_by_natural_key("natural@domain.com"), user)
+        with self.assertRaises(get_user_model().DoesNotExist):
+            await manager.aget_by_natural_key("missing@domain.com")
+
+    async def test_aemail_user(self):
+        user = get_user_model()(email="async@domain.com")
+        await user.aemail_user("Subject", "Message", "from@domain.com")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["async@domain.com"])
+
+    async def test_concurrent_signups_overlap(self):
+        lock = threading.Lock()
+        active = []
+        overlap = []
+
+        def slow_make_password(password):
+            with lock:
+                active.append(password)
+                overlap.append(len(active))
+            time.sleep(0.1)
+            with lock:
+                active.remove(password)
+            return "hashed$" + password
+
+        with mock.patch("custom_user.models.make_password", slow_make_password):
+            users = await asyncio.gather(
+                *(
+                    get_user_model().objects.acreate_user(
+                        "user%d@domain.com" % i, "pw%d" % i
+                    )
+                    for i in range(3)
+                )
+            )
+        self.assertGreater(max(overlap), 1)
+        self.assertEqual(
+            sorted(user.password for user in users),
+            ["hashed$pw0", "hashed$pw1", "hashed$pw2"],
+        )
+
+
 class MigrationsTest(TestCase):
     def test_makemigrations_no_changes(self):
         with mock.patch("sys.stdout", new_callable=StringIO) as mocked:
@@ -254,6 +1113,956 @@ class TestAuthenticationMiddleware(TestCase):
         self.assertIsNone(self.request.session.session_key)
 
 
+@override_settings(AUTHENTICATION_BACKENDS=["custom_user.backends.CachedModelBackend"])
+class CachedModelBackendTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.backend = CachedModelBackend()
+        self.user = get_user_model().objects.create_user("cached@example.com")
+
+    def test_get_user_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+
+    def test_get_user_invalidated_on_save(self):
+        self.backend.get_user(self.user.pk)
+        self.user.is_staff = True
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.assertTrue(self.backend.get_user(self.user.pk).is_staff)
+
+    def test_get_user_deactivated(self):
+        self.backend.get_user(self.user.pk)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_get_user_deleted(self):
+        pk = self.user.pk
+        self.backend.get_user(pk)
+        self.user.delete()
+        self.assertIsNone(self.backend.get_user(pk))
+
+    def test_get_user_update_bypasses_signals(self):
+        # QuerySet.update() doesn't send post_save, invalidate explicitly.
+        self.backend.get_user(self.user.pk)
+        get_user_model().objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        invalidate_cached_user(self.user.pk)
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_get_user_cached_inactive(self):
+        self.backend.get_user(self.user.pk)
+        self.user.is_active = False
+        cache.set("custom_user:user:%s:1" % self.user.pk, self.user)
+        cache.set("custom_user:user_version:%s" % self.user.pk, 1)
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_version_counter(self):
+        key = "custom_user:user_version:%s" % self.user.pk
+        cache.delete(key)
+        with mock.patch("custom_user.backends.random.randrange", return_value=41):
+            self.user.save()
+        # The second bump, on commit, never runs in a test transaction.
+        self.assertEqual(cache.get(key), 41)
+        self.backend.get_user(self.user.pk)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(cache.get(key), 42)
+        self.assertTrue(self.backend.get_user(self.user.pk).is_staff)
+
+        cache.delete(key)
+
+        def racing_add(key, value, timeout=None, version=None):
+            # Another process created the counter first.
+            cache.set(key, 7, timeout)
+            return False
+
+        with mock.patch.object(caches["default"], "add", racing_add):
+            invalidate_cached_user(self.user.pk)
+        self.assertEqual(cache.get(key), 8)
+
+    def test_version_timeout(self):
+        self.assertEqual(_version_timeout(), 7200)
+        with override_settings(CUSTOM_USER_USER_CACHE_TIMEOUT=None):
+            self.assertIsNone(_version_timeout())
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=["django.contrib.auth.backends.ModelBackend"]
+    )
+    def test_not_configured(self):
+        # Without a caching backend, writes don't touch the cache.
+        with mock.patch("custom_user.backends._user_cache") as user_cache:
+            self.user.save()
+            Group.objects.create(name="editors").user_set.add(self.user)
+            purge_users(get_user_model().objects.filter(pk=self.user.pk))
+        user_cache.assert_not_called()
+
+    def test_middleware(self):
+        self.client.force_login(self.user)
+        request = HttpRequest()
+        request.session = self.client.session
+        AuthenticationMiddleware(lambda req: HttpResponse())(request)
+        self.assertEqual(request.user, self.user)
+
+
+@override_settings(AUTHENTICATION_BACKENDS=["custom_user.backends.CachedModelBackend"])
+class CachedPermissionsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user("perms@example.com")
+        self.group = Group.objects.create(name="editors")
+        self.permission = Permission.objects.get(codename="change_group")
+        self.user.user_permissions.add(Permission.objects.get(codename="add_group"))
+
+    def fresh_user(self):
+        return get_user_model().objects.get(pk=self.user.pk)
+
+    def test_has_perm_cached_across_instances(self):
+        self.assertTrue(self.fresh_user().has_perm("auth.add_group"))
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm("auth.add_group"))
+            self.assertFalse(user.has_perm("auth.change_group"))
+
+    def test_user_permissions_changed(self):
+        self.assertFalse(self.fresh_user().has_perm("auth.change_group"))
+        self.user.user_permissions.add(self.permission)
+        self.assertTrue(self.fresh_user().has_perm("auth.change_group"))
+
+    def test_groups_changed(self):
+        self.group.permissions.add(self.permission)
+        self.assertFalse(self.fresh_user().has_perm("auth.change_group"))
+        self.group.user_set.add(self.user)
+        self.assertTrue(self.fresh_user().has_perm("auth.change_group"))
+
+    def test_group_permissions_changed(self):
+        self.user.groups.add(self.group)
+        self.assertFalse(self.fresh_user().has_perm("auth.change_group"))
+        self.group.permissions.add(self.permission)
+        self.assertTrue(self.fresh_user().has_perm("auth.change_group"))
+
+    def test_group_deleted(self):
+        self.user.groups.add(self.group)
+        self.group.permissions.add(self.permission)
+        self.assertTrue(self.fresh_user().has_perm("auth.change_group"))
+        self.group.delete()
+        self.assertFalse(self.fresh_user().has_perm("auth.change_group"))
+
+    def test_superuser(self):
+        self.assertFalse(self.fresh_user().has_perm("auth.change_group"))
+        self.user.is_superuser = True
+        self.user.save()
+        self.assertTrue(self.fresh_user().has_perm("auth.change_group"))
+
+    def test_missing_version(self):
+        cache.clear()
+        self.assertTrue(self.fresh_user().has_perm("auth.add_group"))
+        self.assertIsNotNone(cache.get("custom_user:permission_version"))
+
+    def test_instance_cache(self):
+        user = self.fresh_user()
+        self.assertEqual(user.get_user_permissions(), {"auth.add_group"})
+        with self.assertNumQueries(0):
+            self.assertEqual(user.get_user_permissions(), {"auth.add_group"})
+
+    def test_inactive_user(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.fresh_user().get_user_permissions(), set())
+
+
+@skipUnless(
+    issubclass(get_user_model(), PermissionSnapshotMixin),
+    "The user model doesn't use PermissionSnapshotMixin",
+)
+class PermissionSnapshotTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.add_group = Permission.objects.get(codename="add_group")
+        cls.change_group = Permission.objects.get(codename="change_group")
+        cls.editors = Group.objects.create(name="editors")
+        cls.editors.permissions.add(cls.change_group)
+        cls.user = get_user_model().objects.create_user("user@example.com")
+        cls.other = get_user_model().objects.create_user("other@example.com")
+
+    def snapshot(self, user):
+        return (
+            get_user_model()
+            .objects.values_list("permission_snapshot", flat=True)
+            .get(pk=user.pk)
+        )
+
+    def test_new_users(self):
+        self.assertEqual(self.user.permission_snapshot, [])
+        self.assertEqual(self.snapshot(self.user), [])
+        get_user_model().objects.bulk_create_users(
+            [
+                {"email": "bulk@example.com"},
+                {"email": "member@example.com", "groups": ["editors"]},
+            ]
+        )
+        user = get_user_model().objects.get(email="bulk@example.com")
+        self.assertEqual(user.permission_snapshot, [])
+        user = get_user_model().objects.get(email="member@example.com")
+        self.assertEqual(user.permission_snapshot, ["auth.change_group"])
+        get_user_model().objects.bulk_create(
+            [get_user_model()(email="set@example.com", permission_snapshot=["a.b"])]
+        )
+        user = get_user_model().objects.get(email="set@example.com")
+        self.assertEqual(user.permission_snapshot, ["a.b"])
+
+    def test_user_changes(self):
+        self.user.groups.add(self.editors)
+        self.assertEqual(self.user.permission_snapshot, ["auth.change_group"])
+        self.user.user_permissions.add(self.add_group)
+        self.assertEqual(
+            self.snapshot(self.user), ["auth.add_group", "auth.change_group"]
+        )
+        self.user.groups.remove(self.editors)
+        self.assertEqual(self.snapshot(self.user), ["auth.add_group"])
+        self.user.user_permissions.clear()
+        self.assertEqual(self.snapshot(self.user), [])
+        self.assertEqual(self.snapshot(self.other), [])
+
+    def test_reverse_changes(self):
+        self.editors.user_set.add(self.user, self.other)
+        self.assertEqual(self.snapshot(self.user), ["auth.change_group"])
+        self.assertEqual(self.snapshot(self.other), ["auth.change_group"])
+        self.editors.user_set.remove(self.other)
+        self.assertEqual(self.snapshot(self.other), [])
+        self.editors.user_set.clear()
+        self.assertEqual(self.snapshot(self.user), [])
+        self.add_group.user_set.add(self.user)
+        self.assertEqual(self.snapshot(self.user), ["auth.add_group"])
+        self.add_group.user_set.clear()
+        self.assertEqual(self.snapshot(self.user), [])
+
+    def test_group_permission_changes(self):
+        self.user.groups.add(self.editors)
+        self.editors.permissions.add(self.add_group)
+        self.assertEqual(
+            self.snapshot(self.user), ["auth.add_group", "auth.change_group"]
+        )
+        self.change_group.group_set.remove(self.editors)
+        self.assertEqual(self.snapshot(self.user), ["auth.add_group"])
+        self.add_group.group_set.clear()
+        self.assertEqual(self.snapshot(self.user), [])
+        self.change_group.group_set.add(self.editors)
+        self.assertEqual(self.snapshot(self.user), ["auth.change_group"])
+        self.editors.permissions.clear()
+        self.assertEqual(self.snapshot(self.user), [])
+        self.assertEqual(self.snapshot(self.other), [])
+
+    def test_deletes(self):
+        self.user.groups.add(self.editors)
+        self.user.user_permissions.add(self.add_group)
+        self.editors.delete()
+        self.assertEqual(self.snapshot(self.user), ["auth.add_group"])
+        self.add_group.delete()
+        self.assertEqual(self.snapshot(self.user), [])
+
+    def test_permission_renamed(self):
+        self.user.user_permissions.add(self.add_group)
+        self.add_group.codename = "create_group"
+        self.add_group.save()
+        self.assertEqual(self.snapshot(self.user), ["auth.create_group"])
+
+    def test_bulk_membership_changes(self):
+        self.user.groups.add(self.editors)
+        get_user_model().objects.upsert_users(
+            [
+                {"email": "user@example.com", "groups": []},
+                {"email": "other@example.com", "groups": ["editors"]},
+                {"email": "new@example.com", "groups": ["editors"]},
+            ]
+        )
+        self.assertEqual(self.snapshot(self.user), [])
+        self.assertEqual(self.snapshot(self.other), ["auth.change_group"])
+        user = get_user_model().objects.get(email="new@example.com")
+        self.assertEqual(user.permission_snapshot, ["auth.change_group"])
+
+    def test_save_keeps_snapshot(self):
+        stale = get_user_model().objects.get(pk=self.user.pk)
+        self.user.groups.add(self.editors)
+        stale.is_staff = True
+        stale.save()
+        self.assertEqual(self.snapshot(self.user), ["auth.change_group"])
+        lean = get_user_model().objects.only("email").get(pk=self.user.pk)
+        lean.email = "renamed@example.com"
+        with self.assertNumQueries(1):
+            lean.save()
+        user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertEqual(user.email, "renamed@example.com")
+        self.assertTrue(user.is_staff)
+        self.assertEqual(user.permission_snapshot, ["auth.change_group"])
+
+    def test_save_behaviour(self):
+        calls = []
+
+        def receiver(sender, instance, created, update_fields, **kwargs):
+            calls.append((created, update_fields))
+
+        post_save.connect(receiver, sender=get_user_model())
+        self.addCleanup(post_save.disconnect, receiver, sender=get_user_model())
+        user = get_user_model().objects.get(pk=self.user.pk)
+        user.save()
+        user.permission_snapshot = ["auth.add_group"]
+        user.save(update_fields=["permission_snapshot"])
+        self.assertEqual(self.snapshot(user), ["auth.add_group"])
+        # Saving a user whose row is missing inserts it, like Model.save().
+        get_user_model().objects.filter(pk=user.pk).delete()
+        user.save()
+        self.assertEqual(self.snapshot(user), ["auth.add_group"])
+        self.assertEqual(
+            calls,
+            [(False, None), (False, frozenset(["permission_snapshot"])), (True, None)],
+        )
+
+    def test_group_renamed(self):
+        # Snapshots hold permission names, renaming a group doesn't change them.
+        self.user.groups.add(self.editors)
+        self.editors.name = "writers"
+        with self.assertNumQueries(1):
+            self.editors.save()
+        self.assertEqual(self.snapshot(self.user), ["auth.change_group"])
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=["custom_user.backends.SnapshotModelBackend"]
+    )
+    def test_backend(self):
+        self.user.groups.add(self.editors)
+        user = get_user_model().objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm("auth.change_group"))
+            self.assertFalse(user.has_perm("auth.add_group"))
+            self.assertTrue(user.has_module_perms("auth"))
+            self.assertEqual(user.get_all_permissions(), {"auth.change_group"})
+        user.is_active = False
+        del user._perm_cache
+        self.assertFalse(user.has_perm("auth.change_group"))
+        get_user_model().objects.update(permission_snapshot=None)
+        user = get_user_model().objects.get(pk=self.user.pk)
+        with self.assertNumQueries(2):
+            self.assertTrue(user.has_perm("auth.change_group"))
+        admin = get_user_model().objects.create_superuser("admin@example.com")
+        self.assertIn("auth.add_group", admin.get_all_permissions())
+
+    def test_command(self):
+        self.user.groups.add(self.editors)
+        self.other.user_permissions.add(self.add_group)
+        get_user_model().objects.update(permission_snapshot=None)
+        output = StringIO()
+        # Per chunk: the pks, direct and group permissions, the update.
+        with self.assertNumQueries(1 + 2 * 4):
+            management.call_command(
+                "rebuild_permission_snapshots", "--chunk-size=1", stdout=output
+            )
+        self.assertEqual(output.getvalue(), "2 permission snapshots rebuilt\n")
+        self.assertEqual(self.snapshot(self.user), ["auth.change_group"])
+        self.assertEqual(self.snapshot(self.other), ["auth.add_group"])
+
+
+@skipIf(
+    issubclass(get_user_model(), PermissionSnapshotMixin),
+    "The user model uses PermissionSnapshotMixin",
+)
+class PermissionSnapshotUnusedTest(TestCase):
+    def test_command(self):
+        with self.assertRaisesMessage(CommandError, "doesn't use"):
+            management.call_command("rebuild_permission_snapshots")
+
+
+def failing_subscriber(event, duration):
+    raise RuntimeError("Subscriber error")
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=["custom_user.backends.CachedModelBackend"],
+    CUSTOM_USER_INSTRUMENTATION_SUBSCRIBERS=["custom_user.instrumentation.collector"],
+)
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        collector.reset()
+
+    def test_events(self):
+        manager = get_user_model().objects
+        user = manager.create_user("user@example.com", "password")
+        manager.create_superuser("admin@example.com")
+        user = manager.get_by_natural_key("user@example.com")
+        user.has_perm("auth.add_group")
+        user.email_user("Subject", "Message")
+        stats = collector.stats()
+        self.assertEqual(
+            {event: stat["count"] for event, stat in stats.items()},
+            {
+                "create_user": 2,
+                "set_password": 2,
+                "get_by_natural_key": 1,
+                "load_permissions": 1,
+                "email_user": 1,
+            },
+        )
+        for stat in stats.values():
+            self.assertGreater(stat["p50"], 0)
+            self.assertGreaterEqual(stat["p99"], stat["p50"])
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=["django.contrib.auth.backends.ModelBackend"]
+    )
+    def test_load_permissions_model_backend(self):
+        user = get_user_model().objects.create_user("user@example.com")
+        self.assertEqual(user.get_user_permissions(), set())
+        self.assertEqual(user.get_group_permissions(), set())
+        self.assertEqual(user.get_all_permissions(), set())
+        self.assertFalse(user.has_module_perms("auth"))
+        self.assertFalse(user.has_perms(["auth.add_group", "auth.change_group"]))
+        # The user and group permissions, then all of them, are loaded once.
+        self.assertEqual(collector.stats()["load_permissions"]["count"], 3)
+        user = get_user_model().objects.get(pk=user.pk)
+        user.is_active = False
+        self.assertFalse(user.has_perm("auth.add_group"))
+        self.assertEqual(collector.stats()["load_permissions"]["count"], 3)
+
+    async def test_async_events(self):
+        manager = get_user_model().objects
+        user = await manager.acreate_user("user@example.com", "password")
+        await manager.aget_by_natural_key("user@example.com")
+        await user.aemail_user("Subject", "Message")
+        self.assertEqual(
+            {event: stat["count"] for event, stat in collector.stats().items()},
+            {"create_user": 1, "get_by_natural_key": 1, "email_user": 1},
+        )
+        with override_settings(CUSTOM_USER_INSTRUMENTATION_SUBSCRIBERS=[]):
+            await manager.aget_by_natural_key("user@example.com")
+        self.assertEqual(collector.stats()["get_by_natural_key"]["count"], 1)
+
+    def test_failing_subscriber(self):
+        with override_settings(
+            CUSTOM_USER_INSTRUMENTATION_SUBSCRIBERS=[
+                "custom_user.tests.failing_subscriber",
+                "custom_user.instrumentation.collector",
+            ]
+        ):
+            with self.assertLogs("custom_user.instrumentation", "ERROR") as logs:
+                with self.assertRaises(get_user_model().DoesNotExist):
+                    get_user_model().objects.get_by_natural_key("missing@example.com")
+        self.assertIn("failed on get_by_natural_key", logs.output[0])
+        self.assertEqual(collector.stats()["get_by_natural_key"]["count"], 1)
+
+    def test_failed_call(self):
+        with self.assertRaises(get_user_model().DoesNotExist):
+            get_user_model().objects.get_by_natural_key("missing@example.com")
+        self.assertEqual(collector.stats()["get_by_natural_key"]["count"], 1)
+
+    def test_no_subscribers(self):
+        with override_settings(CUSTOM_USER_INSTRUMENTATION_SUBSCRIBERS=[]):
+            self.assertEqual(get_subscribers(), [])
+            get_user_model().objects.create_user("user@example.com", "password")
+        self.assertEqual(collector.stats(), {})
+
+    def test_percentiles(self):
+        collector = InMemoryCollector(max_samples=100)
+        self.assertIsNone(collector.percentile("event", 50))
+        for duration in range(200, 0, -1):
+            collector("event", duration)
+        self.assertEqual(collector.percentile("event", 0), 1)
+        self.assertEqual(collector.percentile("event", 50), 50)
+        self.assertEqual(collector.percentile("event", 99), 99)
+        self.assertEqual(collector.percentile("event", 100), 100)
+        self.assertEqual(
+            collector.stats(), {"event": {"count": 200, "p50": 50, "p99": 99}}
+        )
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=["custom_user.backends.ThrottledModelBackend"],
+    CUSTOM_USER_THROTTLE_EMAIL_LIMIT=3,
+    CUSTOM_USER_THROTTLE_IP_LIMIT=5,
+    CUSTOM_USER_THROTTLE_WINDOW=60,
+)
+class ThrottledModelBackendTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("user@example.com", "password")
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch("custom_user.backends.time.time", return_value=6000.0)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def login(self, email="user@example.com", password="wrong", ip="10.0.0.1"):
+        request = RequestFactory().post("/login/", REMOTE_ADDR=ip)
+        return authenticate(request, email=email, password=password)
+
+    def fail(self, times, **kwargs):
+        for attempt in range(times):
+            self.assertIsNone(self.login(**kwargs))
+
+    def test_email_limit(self):
+        self.fail(3)
+        with mock.patch.object(ModelBackend, "authenticate") as backend:
+            self.assertIsNone(self.login(password="password"))
+            self.assertIsNone(self.login(email="USER@example.com", ip="10.0.0.2"))
+        backend.assert_not_called()
+
+    def test_ip_limit(self):
+        for i in range(5):
+            self.fail(1, email="user%d@example.com" % i)
+        self.assertIsNone(self.login(password="password"))
+        self.assertEqual(self.login(password="password", ip="10.0.0.2"), self.user)
+
+    def test_sliding_window(self):
+        self.fail(3)
+        self.time.return_value = 6060.0
+        self.assertIsNone(self.login(password="password"))
+        self.time.return_value = 6090.0
+        self.assertEqual(self.login(password="password"), self.user)
+        self.fail(2)
+        self.time.return_value = 6120.0
+        self.fail(1)
+        self.assertIsNone(self.login(password="password"))
+
+    def test_success_clears_email_counter(self):
+        self.fail(2)
+        self.assertEqual(self.login(password="password"), self.user)
+        self.fail(2)
+        self.assertEqual(self.login(password="password"), self.user)
+
+    @override_settings(CUSTOM_USER_THROTTLE_EMAIL_LIMIT=None)
+    def test_no_limit(self):
+        self.fail(4)
+        self.assertEqual(self.login(password="password"), self.user)
+
+    def test_without_request(self):
+        self.assertIsNone(authenticate(email="user@example.com"))
+        self.assertEqual(
+            authenticate(username="user@example.com", password="password"), self.user
+        )
+        for attempt in range(3):
+            self.assertIsNone(authenticate(email="user@example.com", password="wrong"))
+        self.assertIsNone(authenticate(email="user@example.com", password="password"))
+
+
+@override_settings(
+    CUSTOM_USER_BACKGROUND_PASSWORD_UPGRADE=True,
+    PASSWORD_HASHERS=[
+        "django.contrib.auth.hashers.PBKDF2PasswordHasher",
+        "django.contrib.auth.hashers.MD5PasswordHasher",
+    ],
+)
+class BackgroundPasswordUpgradeTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create(
+            email="user@example.com", password=make_password("password", hasher="md5")
+        )
+
+    def fresh_user(self):
+        return get_user_model().objects.get(pk=self.user.pk)
+
+    def session_user(self):
+        request = HttpRequest()
+        request.session = self.client.session
+        return get_user(request)
+
+    def test_upgrade(self):
+        with mock.patch.object(password_upgrader, "submit") as submit:
+            with mock.patch.object(PBKDF2PasswordHasher, "encode") as encode:
+                self.assertTrue(
+                    self.client.login(email="user@example.com", password="password")
+                )
+        encode.assert_not_called()
+        password_upgrader.submit(*submit.call_args.args)
+        password_upgrader.join()
+        self.assertTrue(self.fresh_user().password.startswith("pbkdf2_sha256$"))
+        self.assertTrue(self.fresh_user().check_password("password"))
+
+    @skipIf(django.VERSION < (4, 1, 8), "Session hash fallbacks need Django 4.1.8")
+    def test_session_kept(self):
+        self.client.login(email="user@example.com", password="password")
+        password_upgrader.join()
+        request = HttpRequest()
+        request.session = self.client.session
+        self.assertEqual(get_user(request), self.user)
+        self.assertEqual(
+            request.session[HASH_SESSION_KEY],
+            self.fresh_user().get_session_auth_hash(),
+        )
+
+    def test_session_ends_on_password_change(self):
+        self.client.login(email="user@example.com", password="password")
+        password_upgrader.join()
+        user = self.fresh_user()
+        user.set_password("new password")
+        user.save()
+        self.assertFalse(self.session_user().is_authenticated)
+
+    def test_password_changed_before_upgrade(self):
+        user = self.fresh_user()
+        self.assertFalse(
+            upgrade_password(
+                type(user), user.pk, "md5$other", "password", user._state.db
+            )
+        )
+        self.assertEqual(self.fresh_user().password, self.user.password)
+
+    def test_queue_full(self):
+        upgrader = PasswordUpgrader()
+        upgrader.join()
+        with override_settings(CUSTOM_USER_PASSWORD_UPGRADE_QUEUE_SIZE=1):
+            with mock.patch.object(upgrader, "run"):
+                self.assertTrue(upgrader.submit(self.user, "password"))
+                self.assertFalse(upgrader.submit(self.user, "password"))
+
+    def test_failure_logged(self):
+        upgrader = PasswordUpgrader()
+        with mock.patch(
+            "custom_user.password_upgrade.upgrade_password", side_effect=ValueError
+        ):
+            with self.assertLogs("custom_user.password_upgrade", "ERROR"):
+                upgrader.submit(self.user, "password")
+                upgrader.join()
+
+    @override_settings(CUSTOM_USER_BACKGROUND_PASSWORD_UPGRADE=False)
+    def test_disabled(self):
+        self.assertTrue(self.user.check_password("password"))
+        self.assertTrue(self.fresh_user().password.startswith("pbkdf2_sha256$"))
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=[
+        "custom_user.backends.SessionSnapshotBackend",
+        "django.contrib.auth.backends.ModelBackend",
+    ]
+)
+class SessionSnapshotTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(
+            "user@example.com", "password", is_staff=True
+        )
+        cls.group = Group.objects.create(name="editors")
+
+    def setUp(self):
+        cache.clear()
+        self.middleware = SessionSnapshotMiddleware(lambda request: HttpResponse())
+        self.login(self.user)
+
+    def login(self, user, backend="custom_user.backends.SessionSnapshotBackend"):
+        self.client.force_login(user, backend=backend)
+        self.session = self.client.session
+        self.assertIn(SESSION_KEY, self.session)
+
+    def get_user(self):
+        request = HttpRequest()
+        request.session = self.session
+        self.middleware(request)
+        return request.user
+
+    def test_snapshot(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_user().email, "user@example.com")
+        self.assertIn(SNAPSHOT_SESSION_KEY, self.session)
+        user = self.get_user()
+        with self.assertNumQueries(0):
+            self.assertEqual(user.pk, self.user.pk)
+            self.assertEqual(user.email, "user@example.com")
+            self.assertEqual(user.get_username(), "user@example.com")
+            self.assertEqual(str(user), "user@example.com")
+            self.assertTrue(user.is_authenticated)
+            self.assertFalse(user.is_anonymous)
+            self.assertTrue(user.is_active)
+            self.assertTrue(user.is_staff)
+            self.assertFalse(user.is_superuser)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.date_joined, self.user.date_joined)
+            self.assertEqual(user, self.user)
+            self.assertTrue(user.is_staff)
+
+    def test_permissions(self):
+        self.user.user_permissions.add(Permission.objects.get(codename="add_group"))
+        self.get_user().email
+        user = self.get_user()
+        self.assertTrue(user.has_perm("auth.add_group"))
+        self.assertFalse(user.has_perm("auth.change_group"))
+        self.assertTrue(user.has_module_perms("auth"))
+        admin = get_user_model().objects.create_superuser("admin@example.com")
+        self.login(admin)
+        self.get_user().email
+        user = self.get_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm("auth.change_group"))
+            self.assertTrue(user.has_module_perms("auth"))
+
+    def test_stamp_changes(self):
+        self.get_user().email
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.get_user().email
+        with self.assertNumQueries(0):
+            self.get_user().email
+        self.user.groups.add(self.group)
+        with self.assertNumQueries(1):
+            self.get_user().email
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.get_user().email
+
+    @override_settings(CUSTOM_USER_USER_CACHE_TIMEOUT=60)
+    def test_expired_snapshot(self):
+        self.get_user().email
+        with mock.patch("django.core.signing.time.time", return_value=time.time() + 59):
+            with self.assertNumQueries(0):
+                self.get_user().email
+        with mock.patch("django.core.signing.time.time", return_value=time.time() + 61):
+            with self.assertNumQueries(1):
+                self.get_user().email
+            with self.assertNumQueries(0):
+                self.get_user().email
+
+    def test_deactivated(self):
+        self.get_user().email
+        self.user.is_active = False
+        self.user.save()
+        self.assertTrue(self.get_user().is_anonymous)
+
+    def test_password_changed(self):
+        self.get_user().email
+        self.user.set_password("new_password")
+        self.user.save()
+        self.assertTrue(self.get_user().is_anonymous)
+        self.assertIsNone(self.session.session_key)
+
+    def test_invalid_snapshot(self):
+        self.session[SNAPSHOT_SESSION_KEY] = "tampered"
+        with self.assertNumQueries(1):
+            self.get_user().email
+        other = get_user_model().objects.create_user("other@example.com")
+        self.session[SESSION_KEY] = str(other.pk)
+        self.session[HASH_SESSION_KEY] = other.get_session_auth_hash()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_user().email, "other@example.com")
+
+    def test_other_backend(self):
+        self.login(self.user, backend="django.contrib.auth.backends.ModelBackend")
+        for attempt in range(2):
+            with self.assertNumQueries(1):
+                self.assertEqual(self.get_user().email, "user@example.com")
+        self.assertNotIn(SNAPSHOT_SESSION_KEY, self.session)
+        self.client.logout()
+        self.session = self.client.session
+        self.assertTrue(self.get_user().is_anonymous)
+
+
+@override_settings(
+    DATABASE_ROUTERS=["custom_user.routers.EmailUserRouter"],
+    CUSTOM_USER_REPLICA_DATABASES=["replica"],
+)
+class EmailUserRouterTest(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user("user@example.com", "password")
+        self.group = Group.objects.create(name="editors")
+
+    def test_reads(self):
+        manager = get_user_model().objects
+        self.assertEqual(manager.get_by_natural_key("user@example.com"), self.user)
+        cache.clear()
+        self.assertEqual(manager.db, "replica")
+        self.assertEqual(Group.objects.db, "replica")
+        self.assertEqual(Permission.objects.db, "replica")
+        self.assertEqual(self.user.groups.all().db, "replica")
+        self.assertEqual(ContentType.objects.db, "default")
+        # The replica database is empty, nothing was replicated.
+        with self.assertRaises(get_user_model().DoesNotExist):
+            manager.get_by_natural_key("user@example.com")
+
+    def test_writes(self):
+        self.assertEqual(self.user._state.db, "default")
+        self.assertEqual(self.group._state.db, "default")
+        self.assertEqual(router.db_for_write(get_user_model()), "default")
+        self.assertEqual(
+            router.db_for_write(get_user_model().groups.through), "default"
+        )
+        self.assertEqual(router.db_for_write(ContentType), "default")
+
+    def test_sticky_after_save(self):
+        cache.clear()
+        self.user.set_password("new password")
+        self.user.save()
+        self.assertTrue(is_sticky(self.user.pk))
+        self.assertTrue(is_sticky(email="USER@example.com"))
+        self.assertEqual(self.user.groups.all().db, "default")
+        self.assertFalse(is_sticky(0))
+        self.assertFalse(is_sticky())
+
+    def test_sticky_after_group_change(self):
+        other = get_user_model().objects.create_user("other@example.com")
+        cache.clear()
+        self.user.groups.add(self.group)
+        self.assertTrue(is_sticky(self.user.pk))
+        self.group.user_set.add(other)
+        self.assertTrue(is_sticky(other.pk))
+        cache.clear()
+        self.group.user_set.clear()
+        self.assertFalse(is_sticky(self.user.pk))
+
+    def test_middleware(self):
+        request = HttpRequest()
+        request.session = {SESSION_KEY: str(self.user.pk)}
+        middleware = ReadYourWritesMiddleware(
+            lambda request: get_user_model().objects.db
+        )
+        self.assertEqual(middleware(request), "default")
+        cache.clear()
+        self.assertEqual(middleware(request), "replica")
+        request.session = {}
+        self.assertEqual(middleware(request), "replica")
+
+    def test_allow_relation(self):
+        content_type = ContentType.objects.get_for_model(Group)
+        self.assertTrue(router.allow_relation(self.user, self.group))
+        self.assertTrue(router.allow_relation(self.user, content_type))
+
+    def test_conflicts_read_primary(self):
+        # The replica database is empty, like one lagging behind the primary.
+        cache.clear()
+        manager = get_user_model().objects
+        self.assertEqual(
+            manager.get_or_provision("user@example.com"), (self.user, False)
+        )
+        cache.clear()
+        password = "VerySecurePassword123!"
+        form = EmailUserCreationForm(
+            {"email": "user@example.com", "password1": password, "password2": password}
+        )
+        self.assertTrue(form.is_valid())
+        with self.assertRaises(ValidationError):
+            form.save()
+        self.assertTrue(form.has_error("email", "duplicate_email"))
+        cache.clear()
+        results = manager.upsert_users([{"email": "user@example.com"}])
+        self.assertEqual([result.status for result in results], [BULK_UNCHANGED])
+        cache.clear()
+        results = manager.bulk_create_users([{"email": "user@example.com"}])
+        self.assertEqual([result.status for result in results], [BULK_DUPLICATE])
+        with connections["replica"].cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM %s" % get_user_model()._meta.db_table)
+            self.assertEqual(cursor.fetchone(), (0,))
+
+    @override_settings(CUSTOM_USER_REPLICA_DATABASES=[])
+    def test_no_replicas(self):
+        cache.clear()
+        self.user.save()
+        self.assertFalse(is_sticky(self.user.pk))
+        self.assertEqual(get_user_model().objects.db, "default")
+
+
+class LastLoginTest(TestCase):
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user("user%d@example.com" % i)
+            for i in range(3)
+        ]
+        self.addCleanup(last_login_buffer.flush)
+
+    def login(self, user):
+        user_logged_in.send(sender=user.__class__, request=None, user=user)
+
+    def test_default_updates_every_login(self):
+        user = self.users[0]
+        with self.assertNumQueries(1):
+            self.login(user)
+        with self.assertNumQueries(1):
+            self.login(user)
+
+    def test_login_view_updates_last_login(self):
+        user = self.users[0]
+        user.set_password("password")
+        user.last_login = None
+        user.save()
+        self.client.login(username=user.email, password="password")
+        user.refresh_from_db()
+        self.assertIsNotNone(user.last_login)
+
+    @override_settings(CUSTOM_USER_LAST_LOGIN_PRECISION=60)
+    def test_precision(self):
+        user = self.users[0]
+        user.last_login = timezone.now() - timezone.timedelta(seconds=30)
+        with self.assertNumQueries(0):
+            self.login(user)
+        user.last_login = timezone.now() - timezone.timedelta(seconds=90)
+        with self.assertNumQueries(1):
+            self.login(user)
+        stored = get_user_model().objects.get(pk=user.pk).last_login
+        self.assertLess(timezone.now() - stored, timezone.timedelta(seconds=60))
+
+    @override_settings(
+        CUSTOM_USER_LAST_LOGIN_PRECISION=60, CUSTOM_USER_LAST_LOGIN_BUFFER_SIZE=3
+    )
+    def test_buffer(self):
+        for user in self.users:
+            user.last_login = None
+        with self.assertNumQueries(0):
+            self.login(self.users[0])
+            self.login(self.users[1])
+        self.assertEqual(len(last_login_buffer), 2)
+        with self.assertNumQueries(1):
+            self.login(self.users[2])
+        self.assertEqual(len(last_login_buffer), 0)
+        for user in self.users:
+            self.assertEqual(
+                get_user_model().objects.get(pk=user.pk).last_login, user.last_login
+            )
+
+    @override_settings(
+        CUSTOM_USER_LAST_LOGIN_PRECISION=60, CUSTOM_USER_LAST_LOGIN_BUFFER_SIZE=10
+    )
+    def test_buffer_flush(self):
+        self.users[0].last_login = None
+        self.login(self.users[0])
+        self.assertEqual(flush_last_logins(), 1)
+        self.assertEqual(flush_last_logins(), 0)
+        self.assertEqual(
+            get_user_model().objects.get(pk=self.users[0].pk).last_login,
+            self.users[0].last_login,
+        )
+
+    @override_settings(
+        CUSTOM_USER_LAST_LOGIN_PRECISION=60, CUSTOM_USER_LAST_LOGIN_BUFFER_SIZE=10
+    )
+    def test_buffer_expired(self):
+        for user in self.users:
+            user.last_login = None
+        self.login(self.users[0])
+        with mock.patch("time.monotonic", return_value=time.monotonic() + 60):
+            with self.assertNumQueries(1):
+                self.login(self.users[1])
+        self.assertEqual(len(last_login_buffer), 0)
+
+    @override_settings(CUSTOM_USER_LAST_LOGIN_BUFFER_SIZE=3)
+    def test_buffer_without_precision(self):
+        # Without a precision, timestamps are only written when the buffer is
+        # full, however old they are.
+        for user in self.users:
+            user.last_login = None
+        with self.assertNumQueries(0):
+            self.login(self.users[0])
+            with mock.patch("time.monotonic", return_value=time.monotonic() + 3600):
+                self.login(self.users[1])
+        with self.assertNumQueries(1):
+            self.login(self.users[2])
+        self.assertEqual(len(last_login_buffer), 0)
+
+
 class TestDataMixin:
     @classmethod
     def setUpTestData(cls):
@@ -284,6 +2093,100 @@ class EmailUserCreationFormTest(TestDataMixin, TestCase):
             [str(form.error_messages["duplicate_email"])],
         )
 
+    def test_duplicate_check_single_query(self):
+        data = {
+            "email": "new@example.com",
+            "password1": self.password,
+            "password2": self.password,
+        }
+        form = EmailUserCreationForm(data)
+        with self.assertNumQueries(1):
+            self.assertTrue(form.is_valid())
+
+    def test_validate_unique_other_fields(self):
+        data = {
+            "email": "new@example.com",
+            "password1": self.password,
+            "password2": self.password,
+        }
+        form = EmailUserCreationForm(data)
+        with mock.patch.object(
+            get_user_model(),
+            "validate_unique",
+            side_effect=ValidationError({NON_FIELD_ERRORS: ["Not unique."]}),
+        ) as validate_unique:
+            self.assertFalse(form.is_valid())
+        self.assertIn("email", validate_unique.call_args[1]["exclude"])
+        self.assertEqual(form.non_field_errors(), ["Not unique."])
+
+    def test_concurrent_duplicate(self):
+        data = {
+            "email": "raced@example.com",
+            "password1": self.password,
+            "password2": self.password,
+        }
+        form = EmailUserCreationForm(data)
+        self.assertTrue(form.is_valid())
+        # Another request creates the same user after validation.
+        get_user_model().objects.create_user("raced@example.com")
+        with self.assertRaises(ValidationError):
+            form.save()
+        self.assertEqual(
+            form["email"].errors, [str(form.error_messages["duplicate_email"])]
+        )
+        self.assertEqual(
+            get_user_model().objects.filter(email="raced@example.com").count(), 1
+        )
+
+    def test_concurrent_duplicate_view(self):
+        class UserCreateView(DuplicateEmailFormMixin, CreateView):
+            form_class = EmailUserCreationForm
+            success_url = "/"
+            template_name = "unused.html"
+
+        data = {
+            "email": "raced@example.com",
+            "password1": self.password,
+            "password2": self.password,
+        }
+        get_user_model().objects.create_user("raced@example.com")
+        with mock.patch.object(
+            EmailUserCreationForm, "clean_email", return_value="raced@example.com"
+        ):
+            response = UserCreateView.as_view()(RequestFactory().post("/", data))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+            response.context_data["form"].has_error("email", "duplicate_email")
+        )
+        response = UserCreateView.as_view()(
+            RequestFactory().post("/", dict(data, email="new@example.com"))
+        )
+        self.assertEqual(response.status_code, 302)
+
+    def test_integrity_error_not_duplicate(self):
+        data = {
+            "email": "new@example.com",
+            "password1": self.password,
+            "password2": self.password,
+        }
+        form = EmailUserCreationForm(data)
+        self.assertTrue(form.is_valid())
+        with mock.patch.object(
+            get_user_model(), "save", side_effect=IntegrityError("other")
+        ):
+            with self.assertRaisesMessage(IntegrityError, "other"):
+                form.save()
+
+        class FailingView:
+            def form_valid(self, form):
+                raise ValidationError("Other")
+
+        class View(DuplicateEmailFormMixin, FailingView):
+            pass
+
+        with self.assertRaisesMessage(ValidationError, "Other"):
+            View().form_valid(form)
+
     def test_invalid_data(self):
         data = {
             "email": "testclient",
@@ -530,6 +2433,21 @@ class EmailUserAdminTest(TestCase):
                 self.app_verbose_name = "Test Custom User Subclass"  # pragma: no cover
             else:
                 self.app_verbose_name = "Test_Custom_User_Subclass"  # pragma: no cover
+        if settings.AUTH_USER_MODEL == "test_custom_user_snapshot.SnapshotEmailUser":
+            self.app_name = "test_custom_user_snapshot"
+            self.model_name = "snapshotemailuser"
+            self.model_verbose_name = "SnapshotEmailUserVerboseName"
+            self.model_verbose_name_plural = "SnapshotEmailUserVerboseNamePlural"
+            if django.VERSION[:2] < (4, 1):
+                self.app_verbose_name = "Test Custom User Snapshot"  # pragma: no cover
+            else:
+                self.app_verbose_name = "Test_Custom_User_Snapshot"  # pragma: no cover
+
+    def test_permission_admin_not_registered(self):
+        # Only registered with CUSTOM_USER_ADMIN_AUTOCOMPLETE.
+        self.assertFalse(admin.site.is_registered(Permission))
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get("/admin/auth/permission/").status_code, 404)
 
     def test_url(self):
         self.assertTrue(
@@ -614,3 +2532,726 @@ class EmailUserAdminTest(TestCase):
             self.client.get(password_change_url).status_code,
             200,
         )
+
+    def test_add_concurrent_duplicate(self):
+        self.client.force_login(self.user)
+        get_user_model().objects.create_user("raced@example.com")
+        clean_email = EmailUserCreationForm.clean_email
+        calls = []
+
+        def racing_clean_email(form):
+            # The first validation runs before the other user is created.
+            calls.append(form)
+            if len(calls) == 1:
+                return form.cleaned_data["email"]
+            return clean_email(form)
+
+        url = reverse("admin:%s_%s_add" % (self.app_name, self.model_name))
+        password = "VerySecurePassword123!"
+        data = {
+            "email": "raced@example.com",
+            "password1": password,
+            "password2": password,
+        }
+        with mock.patch.object(
+            EmailUserCreationForm, "clean_email", racing_clean_email
+        ):
+            response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(
+            response, EmailUserCreationForm.error_messages["duplicate_email"]
+        )
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(
+            get_user_model().objects.filter(email="raced@example.com").count(), 1
+        )
+        model_admin = admin.site._registry[get_user_model()]
+        with mock.patch.object(
+            model_admin, "save_model", side_effect=ValidationError("Other")
+        ):
+            with self.assertRaisesMessage(ValidationError, "Other"):
+                self.client.post(url, dict(data, email="other@example.com"))
+
+    def test_add_and_change(self):
+        self.client.force_login(self.user)
+        url = reverse("admin:%s_%s_add" % (self.app_name, self.model_name))
+        password = "VerySecurePassword123!"
+        response = self.client.post(
+            url,
+            {"email": "new@example.com", "password1": password, "password2": password},
+        )
+        self.assertEqual(response.status_code, 302)
+        user = get_user_model().objects.get(email="new@example.com")
+        self.assertTrue(user.check_password(password))
+        user.is_staff = True
+        model_admin = admin.site._registry[get_user_model()]
+        model_admin.save_model(response.wsgi_request, user, None, True)
+        user.refresh_from_db()
+        self.assertIs(user.is_staff, True)
+
+
+@override_settings(CUSTOM_USER_ADMIN_SEARCH="prefix")
+class EmailUserAdminSearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = get_user_model().objects.create_superuser(
+            "admin@example.com", "password"
+        )
+        for email in ("alice@example.com", "bob@example.org", "example@test.com"):
+            get_user_model().objects.create_user(email)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        opts = get_user_model()._meta
+        self.url = reverse("admin:%s_%s_changelist" % (opts.app_label, opts.model_name))
+
+    def search(self, term):
+        response = self.client.get(self.url, {"q": term})
+        return sorted(user.email for user in response.context["cl"].result_list)
+
+    def test_prefix(self):
+        self.assertEqual(self.search("example"), ["example@test.com"])
+        self.assertEqual(self.search("alice@EXAMPLE"), ["alice@example.com"])
+
+    def test_domain(self):
+        self.assertEqual(
+            self.search("@Example.com"), ["admin@example.com", "alice@example.com"]
+        )
+        self.assertEqual(self.search("@example"), [])
+
+    def test_empty(self):
+        self.assertEqual(len(self.search(" ")), 4)
+
+    @override_settings(CUSTOM_USER_ADMIN_SEARCH="contains")
+    def test_contains(self):
+        self.assertEqual(
+            self.search("example"),
+            [
+                "admin@example.com",
+                "alice@example.com",
+                "bob@example.org",
+                "example@test.com",
+            ],
+        )
+
+
+class EmailUserAdminPaginationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = get_user_model().objects.create_superuser(
+            "admin@example.com", "password"
+        )
+        for i in range(5):
+            get_user_model().objects.create_user("user%d@example.com" % i)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        opts = get_user_model()._meta
+        self.url = reverse("admin:%s_%s_changelist" % (opts.app_label, opts.model_name))
+        patcher = mock.patch.object(
+            admin.site._registry[get_user_model()], "list_per_page", 2
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def emails(self, response):
+        return [user.email for user in response.context["cl"].result_list]
+
+    @override_settings(CUSTOM_USER_ADMIN_PAGINATION="keyset")
+    def test_keyset(self):
+        response = self.client.get(self.url)
+        self.assertEqual(
+            self.emails(response), ["admin@example.com", "user0@example.com"]
+        )
+        self.assertContains(response, "?after=user0%40example.com")
+        response = self.client.get(self.url, {"after": "user0@example.com"})
+        self.assertEqual(
+            self.emails(response), ["user1@example.com", "user2@example.com"]
+        )
+        self.assertContains(response, '<a href="?">')
+        response = self.client.get(self.url, {"after": "user3@example.com"})
+        self.assertEqual(self.emails(response), ["user4@example.com"])
+        self.assertNotContains(response, "?after=")
+
+    @override_settings(CUSTOM_USER_ADMIN_PAGINATION="keyset")
+    def test_keyset_search(self):
+        response = self.client.get(self.url, {"after": "user2@example.com"})
+        self.assertEqual(response.context["cl"].keyset_value, "user2@example.com")
+        self.assertNotContains(response, 'name="after"')
+        # Submitting the search form sends its hidden inputs with the query.
+        data = dict(response.context["cl"].params, q="user")
+        response = self.client.get(self.url, data)
+        self.assertEqual(
+            self.emails(response), ["user0@example.com", "user1@example.com"]
+        )
+        self.assertContains(response, "?after=user1%40example.com&amp;q=user")
+
+    @override_settings(CUSTOM_USER_ADMIN_PAGINATION="keyset")
+    def test_keyset_descending(self):
+        response = self.client.get(self.url, {"o": "-1", "after": "user3@example.com"})
+        self.assertEqual(
+            self.emails(response), ["user2@example.com", "user1@example.com"]
+        )
+
+    @override_settings(CUSTOM_USER_ADMIN_PAGINATION="keyset")
+    def test_keyset_other_ordering(self):
+        response = self.client.get(self.url, {"o": "2", "p": "2"})
+        self.assertEqual(len(self.emails(response)), 2)
+        self.assertFalse(response.context["cl"].keyset_pagination)
+
+    def test_offset(self):
+        response = self.client.get(self.url, {"p": "2"})
+        self.assertEqual(
+            self.emails(response), ["user1@example.com", "user2@example.com"]
+        )
+        self.assertFalse(response.context["cl"].keyset_pagination)
+
+    @override_settings(CUSTOM_USER_ADMIN_COUNT_ESTIMATE_THRESHOLD=3)
+    def test_estimated_count(self):
+        with mock.patch("custom_user.pagination.estimate_count", return_value=1000):
+            response = self.client.get(self.url)
+        self.assertEqual(response.context["cl"].result_count, 1000)
+        self.assertIsNone(response.context["cl"].full_result_count)
+        self.assertContains(response, "~1000 ")
+        self.assertContains(response, "?p=2")
+        with override_settings(CUSTOM_USER_ADMIN_PAGINATION="keyset"):
+            with mock.patch("custom_user.pagination.estimate_count", return_value=1000):
+                response = self.client.get(self.url)
+        self.assertContains(response, "~1000 ")
+
+    def test_exact_count(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, "6 ")
+        self.assertNotContains(response, "~6")
+
+    @override_settings(CUSTOM_USER_ADMIN_COUNT_ESTIMATE_THRESHOLD=3)
+    def test_estimated_count_below_threshold(self):
+        with mock.patch("custom_user.pagination.estimate_count", return_value=2):
+            response = self.client.get(self.url)
+        self.assertEqual(response.context["cl"].result_count, 6)
+
+    @override_settings(CUSTOM_USER_ADMIN_COUNT_ESTIMATE_THRESHOLD=0)
+    def test_paginator(self):
+        queryset = get_user_model().objects.order_by("email")
+        with mock.patch.dict(ESTIMATORS, clear=True):
+            paginator = EstimatedCountPaginator(queryset, 2)
+            self.assertIsNone(estimate_count(queryset))
+            self.assertEqual(paginator.count, 6)
+            self.assertFalse(paginator.count_is_estimate)
+        with mock.patch.dict(ESTIMATORS, {connection.vendor: lambda *args: 42}):
+            paginator = EstimatedCountPaginator(queryset, 2)
+            self.assertEqual(paginator.count, 42)
+            self.assertTrue(paginator.count_is_estimate)
+        self.assertEqual(EstimatedCountPaginator([1, 2, 3], 2).count, 3)
+
+    def test_estimate_postgresql(self):
+        plan = [{"Plan": {"Plan Rows": 1234}}]
+        for row in (plan, json.dumps(plan)):
+            cursor = mock.Mock()
+            cursor.fetchone.return_value = (row,)
+            self.assertEqual(ESTIMATORS["postgresql"](cursor, "SELECT 1", ()), 1234)
+            cursor.execute.assert_called_once_with("EXPLAIN (FORMAT JSON) SELECT 1", ())
+
+    def test_estimate_mysql(self):
+        cursor = mock.Mock()
+        cursor.description = [("id",), ("rows",), ("filtered",)]
+        cursor.fetchone.return_value = (1, 1000, 25.0)
+        self.assertEqual(ESTIMATORS["mysql"](cursor, "SELECT 1", ()), 250)
+        cursor.execute.assert_called_once_with("EXPLAIN SELECT 1", ())
+        cursor.fetchone.return_value = (1, 1000, None)
+        self.assertEqual(ESTIMATORS["mysql"](cursor, "SELECT 1", ()), 1000)
+
+    def test_estimate_count_database(self):
+        # Runs the real EXPLAIN on PostgreSQL and MySQL.
+        estimate = estimate_count(get_user_model().objects.all())
+        self.assertEqual(estimate is not None, connection.vendor in ESTIMATORS)
+        self.assertGreaterEqual(estimate or 0, 0)
+
+
+@override_settings(CUSTOM_USER_ADMIN_AUTOCOMPLETE=True)
+class EmailUserAdminAutocompleteTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Registered on import, when the setting is enabled.
+        register_permission_admin()
+
+    @classmethod
+    def tearDownClass(cls):
+        admin.site.unregister(Permission)
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = get_user_model().objects.create_superuser(
+            "admin@example.com", "password"
+        )
+        cls.staff = get_user_model().objects.create_user(
+            "staff@example.com", is_staff=True
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+        self.opts = get_user_model()._meta
+
+    def autocomplete(self, field_name, term):
+        response = self.client.get(
+            reverse("admin:autocomplete"),
+            {
+                "app_label": self.opts.app_label,
+                "model_name": self.opts.model_name,
+                "field_name": field_name,
+                "term": term,
+            },
+        )
+        return response
+
+    def test_checks(self):
+        model_admin = admin.site._registry[get_user_model()]
+        self.assertEqual(model_admin.check(), [])
+        self.assertEqual(model_admin.filter_horizontal, ())
+
+    def test_change_view(self):
+        url = reverse(
+            "admin:%s_%s_change" % (self.opts.app_label, self.opts.model_name),
+            args=(self.staff.pk,),
+        )
+        response = self.client.get(url)
+        self.assertContains(response, "admin-autocomplete")
+        self.assertNotContains(response, "Can add group")
+
+    def test_permissions_autocomplete(self):
+        response = self.autocomplete("user_permissions", "auth add GROUP")
+        self.assertEqual(
+            [result["text"] for result in response.json()["results"]],
+            [str(Permission.objects.get(codename="add_group"))],
+        )
+        with self.assertNumQueries(4):
+            # Session, user, and a count and a page of permissions.
+            self.autocomplete("user_permissions", "group")
+
+    def test_permissions_autocomplete_empty_term(self):
+        response = self.autocomplete("user_permissions", "")
+        self.assertEqual(len(response.json()["results"]), 20)
+        self.assertTrue(response.json()["pagination"]["more"])
+
+    def test_groups_autocomplete(self):
+        Group.objects.create(name="editors")
+        response = self.autocomplete("groups", "edit")
+        self.assertEqual(response.json()["results"][0]["text"], "editors")
+
+    def test_register_permission_admin(self):
+        site = admin.AdminSite()
+        with override_settings(CUSTOM_USER_ADMIN_AUTOCOMPLETE=False):
+            register_permission_admin(site)
+        self.assertFalse(site.is_registered(Permission))
+        register_permission_admin(site)
+        self.assertIsInstance(site._registry[Permission], PermissionAutocompleteAdmin)
+        # A Permission admin registered by the project is kept.
+        site = admin.AdminSite()
+        site.register(Permission)
+        register_permission_admin(site)
+        self.assertNotIsInstance(
+            site._registry[Permission], PermissionAutocompleteAdmin
+        )
+
+    def test_permission_admin_hidden(self):
+        model_admin = admin.site._registry[Permission]
+        request = HttpRequest()
+        request.user = self.staff
+        self.assertFalse(model_admin.has_module_permission(request))
+        self.assertFalse(model_admin.has_view_permission(request))
+        self.assertFalse(model_admin.has_add_permission(request))
+        self.assertFalse(model_admin.has_change_permission(request))
+        self.assertFalse(model_admin.has_delete_permission(request))
+        self.staff.user_permissions.add(
+            Permission.objects.get(codename="change_%s" % self.opts.model_name)
+        )
+        request.user = get_user_model().objects.get(pk=self.staff.pk)
+        self.assertTrue(model_admin.has_view_permission(request))
+
+
+class QueryBudgetTest(TestCase):
+
+    """
+    Query budgets of the admin views and the user forms.
+
+    Each path must run exactly the number of queries in QUERY_BUDGETS, both
+    before and after adding users, groups and permissions, so a change that
+    adds a query or an N+1 fails here. Paths run once before being measured,
+    so only the steady state counts, not the warm up of the content type
+    cache. Update the budget along with a change that is meant to alter it.
+    """
+
+    QUERY_BUDGETS = {
+        "admin_changelist": 6,
+        "admin_add_view": 6,
+        "admin_change_view": 9,
+        "creation_form_save": 4,
+        "change_form_rendering": 4,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = get_user_model().objects.create_superuser(
+            "admin@example.com", "password"
+        )
+        cls.user = get_user_model().objects.create_user("user@example.com")
+        cls.rows = 0
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        opts = get_user_model()._meta
+        self.url_name = "admin:%s_%s_%%s" % (opts.app_label, opts.model_name)
+
+    def add_rows(self, count=10):
+        """
+        Add users, and groups and permissions granted to self.user.
+        """
+        content_type = ContentType.objects.get_for_model(Group)
+        for i in range(self.rows, self.rows + count):
+            get_user_model().objects.create_user("user%d@example.com" % i)
+            group = Group.objects.create(name="group%d" % i)
+            permission = Permission.objects.create(
+                codename="perm%d" % i, name="Perm %d" % i, content_type=content_type
+            )
+            group.permissions.add(permission)
+            self.user.groups.add(group)
+            self.user.user_permissions.add(permission)
+        self.rows += count
+
+    def assertQueryBudget(self, name, func):
+        func()
+        for attempt in range(2):
+            with CaptureQueriesContext(connection) as context:
+                func()
+            self.assertEqual(
+                len(context),
+                self.QUERY_BUDGETS[name],
+                "%s ran %d queries with %d extra rows, its budget is %d:\n%s"
+                % (
+                    name,
+                    len(context),
+                    self.rows,
+                    self.QUERY_BUDGETS[name],
+                    "\n".join(query["sql"] for query in context.captured_queries),
+                ),
+            )
+            self.add_rows()
+
+    def get(self, url):
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_admin_changelist(self):
+        self.assertQueryBudget(
+            "admin_changelist", lambda: self.get(reverse(self.url_name % "changelist"))
+        )
+
+    def test_admin_add_view(self):
+        self.assertQueryBudget(
+            "admin_add_view", lambda: self.get(reverse(self.url_name % "add"))
+        )
+
+    def test_admin_change_view(self):
+        url = reverse(self.url_name % "change", args=(self.user.pk,))
+        self.assertQueryBudget("admin_change_view", lambda: self.get(url))
+
+    def test_creation_form_save(self):
+        emails = ("new%d@example.com" % i for i in range(3))
+
+        def save():
+            password = "VerySecurePassword123!"
+            form = EmailUserCreationForm(
+                {"email": next(emails), "password1": password, "password2": password}
+            )
+            self.assertTrue(form.is_valid())
+            form.save()
+
+        self.assertQueryBudget("creation_form_save", save)
+
+    def test_change_form_rendering(self):
+        self.assertQueryBudget(
+            "change_form_rendering",
+            lambda: str(EmailUserChangeForm(instance=self.user)),
+        )
+
+
+class ExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = get_user_model().objects.create_superuser(
+            "admin@example.com", "password"
+        )
+        group = Group.objects.create(name="editors")
+        other = Group.objects.create(name="authors")
+        for i in range(4):
+            user = get_user_model().objects.create_user("user%d@example.com" % i)
+            user.groups.add(group, other)
+
+    def test_export_csv_command(self):
+        out = StringIO()
+        with self.assertNumQueries(1 + 3):
+            # One query streaming the users and one per chunk for the groups.
+            management.call_command("export_email_users", "--chunk-size=2", stdout=out)
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]["email"], "admin@example.com")
+        self.assertEqual(rows[0]["groups"], "")
+        self.assertEqual(rows[1]["email"], "user0@example.com")
+        self.assertEqual(rows[1]["groups"], "authors;editors")
+        self.assertEqual(rows[1]["is_active"], "True")
+        self.assertEqual(
+            rows[1]["date_joined"],
+            get_user_model()
+            .objects.get(email="user0@example.com")
+            .date_joined.isoformat(),
+        )
+
+    def test_export_jsonl_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "users.jsonl")
+            management.call_command(
+                "export_email_users", "--format=jsonl", "--output", path
+            )
+            with open(path) as output:
+                rows = [json.loads(line) for line in output]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]["is_superuser"], True)
+        self.assertEqual(rows[4]["groups"], ["authors", "editors"])
+        self.assertNotIn("password", rows[0])
+
+    def test_export_unknown_format(self):
+        with self.assertRaisesMessage(ValueError, "Unknown export format: xml"):
+            export_users(get_user_model().objects.all(), "xml")
+
+    def test_admin_action(self):
+        self.client.force_login(self.admin)
+        opts = get_user_model()._meta
+        url = reverse("admin:%s_%s_changelist" % (opts.app_label, opts.model_name))
+        users = get_user_model().objects.exclude(pk=self.admin.pk)
+        for action, content_type in (
+            ("export_csv", "text/csv"),
+            ("export_jsonl", "application/jsonl"),
+        ):
+            with self.subTest(action=action):
+                response = self.client.post(
+                    url,
+                    {
+                        "action": action,
+                        "_selected_action": [user.pk for user in users],
+                    },
+                )
+                self.assertEqual(response["Content-Type"], content_type)
+                self.assertTrue(response.streaming)
+                content = b"".join(response.streaming_content).decode()
+                self.assertIn("user0@example.com", content)
+                self.assertNotIn("admin@example.com", content)
+
+
+class ImportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.group = Group.objects.create(name="editors")
+        get_user_model().objects.create_user("existing@example.com")
+
+    def write(self, directory, name, content):
+        path = os.path.join(directory, name)
+        with open(path, "w") as output:
+            output.write(content)
+        return path
+
+    def test_import_csv(self):
+        content = (
+            "email,password,is_staff,last_login,groups\n"
+            "new@EXAMPLE.com,secret,True,,editors\n"
+            "existing@example.com,secret,False,,\n"
+            "other@example.com,,,2022-01-02T03:04:05+00:00,\n"
+        )
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write(directory, "users.csv", content)
+            management.call_command("import_email_users", path, stdout=out)
+        self.assertEqual(out.getvalue(), "2 created, 1 duplicate\n")
+        user = get_user_model().objects.get(email="new@example.com")
+        self.assertTrue(user.check_password("secret"))
+        self.assertTrue(user.is_staff)
+        self.assertEqual(list(user.groups.all()), [self.group])
+        other = get_user_model().objects.get(email="other@example.com")
+        self.assertFalse(other.has_usable_password())
+        self.assertEqual(other.last_login.year, 2022)
+
+    def test_import_jsonl_stdin_hashed(self):
+        password = make_password("secret")
+        lines = [
+            json.dumps({"email": "a@example.com", "password": password}),
+            "",
+            json.dumps({"email": "b@example.com", "password": "plain"}),
+            json.dumps({"email": "c@example.com", "password": "!unusable"}),
+            json.dumps({"email": "d@example.com", "groups": ["missing"]}),
+            json.dumps({"email": "e@example.com", "is_active": "maybe"}),
+        ]
+        out, err = StringIO(), StringIO()
+        with mock.patch("sys.stdin", StringIO("\n".join(lines))):
+            management.call_command(
+                "import_email_users",
+                "-",
+                "--format=jsonl",
+                "--hashed-passwords",
+                verbosity=2,
+                stdout=out,
+                stderr=err,
+            )
+        self.assertEqual(out.getvalue(), "2 created, 3 invalid\n")
+        self.assertIn("Record 2 (b@example.com): invalid", err.getvalue())
+        self.assertIn("Unknown groups: missing", err.getvalue())
+        user = get_user_model().objects.get(email="a@example.com")
+        self.assertEqual(user.password, password)
+        self.assertTrue(user.check_password("secret"))
+        user = get_user_model().objects.get(email="c@example.com")
+        self.assertFalse(user.has_usable_password())
+
+    def test_import_exported_users(self):
+        user = get_user_model().objects.get(email="existing@example.com")
+        user.groups.add(self.group)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "users.jsonl")
+            management.call_command(
+                "export_email_users", "--format=jsonl", "--output", path
+            )
+            get_user_model().objects.all().delete()
+            management.call_command("import_email_users", path, stdout=StringIO())
+        user = get_user_model().objects.get(email="existing@example.com")
+        self.assertEqual(list(user.groups.all()), [self.group])
+
+    def test_missing_file(self):
+        with self.assertRaises(management.CommandError):
+            management.call_command("import_email_users", "/missing/users.csv")
+
+    def test_malformed_jsonl(self):
+        valid = json.dumps({"email": "a@example.com"})
+        for content, message in [
+            (valid + "\n\n{broken\n", "Line 3: invalid JSON"),
+            (valid + "\n[1, 2]\n", "Line 2: expected a JSON object."),
+        ]:
+            with self.subTest(content=content), tempfile.TemporaryDirectory() as d:
+                path = self.write(d, "users.jsonl", content)
+                with self.assertRaisesMessage(management.CommandError, message):
+                    management.call_command(
+                        "import_email_users", path, stdout=StringIO()
+                    )
+
+
+class PurgeTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        manager = get_user_model().objects
+        cls.admin = manager.create_superuser("admin@example.com", "password")
+        cls.group = Group.objects.create(name="editors")
+        cls.permission = Permission.objects.get(codename="add_group")
+        cls.inactive = [
+            manager.create_user("inactive%d@example.com" % i, is_active=False)
+            for i in range(5)
+        ]
+        cls.active = manager.create_user("active@example.com")
+        for user in cls.inactive + [cls.active]:
+            user.groups.add(cls.group)
+            user.user_permissions.add(cls.permission)
+            LogEntry.objects.log_action(
+                user.pk, ContentType.objects.get_for_model(Group).pk, None, "", ADDITION
+            )
+
+    def assertPurged(self):
+        self.assertEqual(list(get_user_model().objects.filter(is_active=False)), [])
+        self.assertEqual(list(self.group.user_set.all()), [self.active])
+        self.assertEqual(list(self.permission.user_set.all()), [self.active])
+        self.assertEqual(
+            list(LogEntry.objects.values_list("user", flat=True)), [self.active.pk]
+        )
+
+    def test_purge_users(self):
+        queryset = get_user_model().objects.filter(is_active=False)
+        # Per chunk: the pks, a savepoint, the locked and rechecked pks, the
+        # rows of the groups and user_permissions tables, the log entries,
+        # the users, the release.
+        with self.assertNumQueries(1 + 2 * 9):
+            result = purge_users(queryset, chunk_size=3)
+        self.assertEqual(result, PurgeResult(5, True))
+        self.assertPurged()
+
+    def test_time_budget(self):
+        queryset = get_user_model().objects.filter(is_active=False)
+        with mock.patch("custom_user.purge.time.monotonic", side_effect=[0, 0, 5]):
+            result = purge_users(queryset, chunk_size=2, time_budget=5)
+        self.assertEqual(result, PurgeResult(2, False))
+        self.assertEqual(queryset.count(), 3)
+
+    def test_reactivated_user_kept(self):
+        user = self.inactive[0]
+        select_for_update = QuerySet.select_for_update
+
+        def reactivate(queryset, *args, **kwargs):
+            # The user is reactivated after the pks of its chunk were read.
+            get_user_model().objects.filter(pk=user.pk).update(is_active=True)
+            return select_for_update(queryset, *args, **kwargs)
+
+        queryset = get_user_model().objects.filter(is_active=False)
+        with mock.patch.object(QuerySet, "select_for_update", reactivate):
+            result = purge_users(queryset, chunk_size=1)
+        self.assertEqual(result, PurgeResult(4, True))
+        self.assertEqual(list(user.groups.all()), [self.group])
+        self.assertEqual(LogEntry.objects.filter(user=user).count(), 1)
+
+    def test_collector_fallback(self):
+        with mock.patch.object(Collector, "can_fast_delete", return_value=False):
+            result = purge_users(get_user_model().objects.filter(is_active=False))
+        self.assertEqual(result, PurgeResult(5, True))
+        self.assertPurged()
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=["custom_user.backends.CachedModelBackend"]
+    )
+    def test_invalidates_cached_user(self):
+        cache.clear()
+        user = self.inactive[0]
+        user.is_active = True
+        user.save()
+        backend = CachedModelBackend()
+        self.assertEqual(backend.get_user(user.pk), user)
+        purge_users(get_user_model().objects.filter(pk=user.pk))
+        self.assertIsNone(backend.get_user(user.pk))
+
+    def test_command(self):
+        output = StringIO()
+        management.call_command("purge_inactive_users", "--dry-run", stdout=output)
+        self.assertEqual(output.getvalue(), "5 inactive users\n")
+        output = StringIO()
+        management.call_command(
+            "purge_inactive_users", "--time-budget=0", stdout=output
+        )
+        self.assertEqual(
+            output.getvalue(),
+            "0 inactive users deleted\n"
+            "Time budget spent, run the command again to delete the rest\n",
+        )
+        output = StringIO()
+        management.call_command("purge_inactive_users", "--chunk-size=2", stdout=output)
+        self.assertEqual(output.getvalue(), "5 inactive users deleted\n")
+        self.assertPurged()
+
+    def test_admin_action(self):
+        self.client.force_login(self.admin)
+        opts = get_user_model()._meta
+        url = reverse("admin:%s_%s_changelist" % (opts.app_label, opts.model_name))
+        data = {
+            "action": "purge_inactive",
+            "_selected_action": [user.pk for user in self.inactive + [self.active]],
+        }
+        with override_settings(CUSTOM_USER_PURGE_TIME_BUDGET=0):
+            response = self.client.post(url, data, follow=True)
+        self.assertContains(response, "Deleted 0 inactive users.")
+        self.assertContains(response, "Time budget spent")
+        response = self.client.post(url, data, follow=True)
+        self.assertContains(response, "Deleted 5 inactive users.")
+        self.assertNotContains(response, "Time budget spent")
+        self.assertPurged()
@@ -0,0 +1,20 @@
+"""Helpers for views creating EmailUsers."""
+from django.core.exceptions import ValidationError
+
+
+class DuplicateEmailFormMixin:
+    """
+    Mixin for a CreateView or FormView saving an EmailUserCreationForm.
+
+    A user created with the same email between the validation of the form
+    and its save is reported as a duplicate_email error, rendering the form
+    again instead of failing with a server error.
+    """
+
+    def form_valid(self, form):
+        try:
+            return super().form_valid(form)
+        except ValidationError as error:
+            if getattr(error, "code", None) != "duplicate_email":
+                raise
+            return self.form_invalid(form)
@@ -0,0 +1 @@
+default_app_config = "test_custom_user_snapshot.apps.CustomUserSnapshotConfig"
@@ -0,0 +1,7 @@
+from django.contrib import admin
+
+from custom_user.admin import EmailUserAdmin
+
+from .models import SnapshotEmailUser
+
+admin.site.register(SnapshotEmailUser, EmailUserAdmin)
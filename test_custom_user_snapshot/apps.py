@@ -0,0 +1,6 @@
+from custom_user.apps import CustomUserConfig
+
+
+class CustomUserSnapshotConfig(CustomUserConfig):
+    name = "test_custom_user_snapshot"
+    verbose_name = "Test Custom User Snapshot"
@@ -0,0 +1,7 @@
+from custom_user.models import AbstractEmailUser, PermissionSnapshotMixin
+
+
+class SnapshotEmailUser(PermissionSnapshotMixin, AbstractEmailUser):
+    class Meta(AbstractEmailUser.Meta):
+        verbose_name = "SnapshotEmailUserVerboseName"
+        verbose_name_plural = "SnapshotEmailUserVerboseNamePlural"
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+import custom_user.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("test_custom_user_subclass", "0002_initial_django18"),
+    ]
+
+    operations = [
+        custom_user.operations.AddCaseInsensitiveEmailIndex(
+            model_name="mycustomemailuser",
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+import custom_user.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("test_custom_user_subclass", "0003_email_case_insensitive_index"),
+    ]
+
+    operations = [
+        custom_user.operations.AddEmailDomainIndex(
+            model_name="mycustomemailuser",
+        ),
+    ]
@@ -6,6 +6,8 @@ DEBUG = True
 USE_TZ = True
 DATABASES = {
     "default": env.db(),
+    # Stands in for a read replica in the EmailUserRouter tests.
+    "replica": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"},
 }
 INSTALLED_APPS = [
     "django.contrib.admin",
@@ -0,0 +1,6 @@
+from .settings import *  # NOQA: F403
+
+INSTALLED_APPS += [  # NOQA: F405
+    "test_custom_user_snapshot",
+]
+AUTH_USER_MODEL = "test_custom_user_snapshot.SnapshotEmailUser"